@@ -0,0 +1,84 @@
+"""
+Disk usage and bytes written by slaves keeping plain copies versus slaves
+storing deduplicated chunks, for a data set in which --duplicates of the
+files repeat earlier ones. Files are written through the master operations
+object with slaves in threads, without mounting FUSE.
+
+    python -m benchmarks.chunk_store --files 200 --duplicates 0.5
+"""
+import click
+import logging
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.replication_latency import make_config
+from fs.ChunkedReplicaFSSlave import make_slave
+from fs.ReplicaFSMaster import ReplicaFSMaster
+from fs.SlaveQueue import SlaveQueue
+
+
+def disk_usage(path: str) -> int:
+    total = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            total += os.lstat(os.path.join(directory, name)).st_blocks * 512
+    return total
+
+
+def run(chunk_bytes: int, nbr_slaves: int, files: int, size: int, duplicates: float, seed: int) -> dict:
+    logger = logging.getLogger('replica_fs.bench')
+    rng = random.Random(seed)
+
+    with tempfile.TemporaryDirectory() as root:
+        config = make_config(root, nbr_slaves, slave_chunk_bytes=chunk_bytes)
+        queues = [SlaveQueue() for _ in range(nbr_slaves)]
+        slaves = [make_slave(config, queue=queues[i], slave_n=i, logger=logger) for i in range(nbr_slaves)]
+        master = ReplicaFSMaster(config, queues=queues, nbr_slaves=nbr_slaves)
+
+        contents = []
+        start = time.perf_counter()
+        for i in range(files):
+            if contents and rng.random() < duplicates:
+                data = rng.choice(contents)
+            else:
+                data = rng.randbytes(size)
+                contents.append(data)
+            path = f'/file{i}'
+            fh = master.create(path, 0o644)
+            for offset in range(0, size, 64 * 1024):
+                master.write(path, data[offset:offset + 64 * 1024], offset, fh)
+            master.release(path, fh)
+        elapsed = time.perf_counter() - start
+
+        for slave in slaves:
+            slave.stop()
+        slave = slaves[0]
+        usage = disk_usage(config.slave_backings[0])
+        if chunk_bytes:
+            usage += disk_usage(config.slave_backings[0] + '.chunks')
+            written = slave.chunk_stats()['written_bytes']
+        else:
+            written = files * size
+
+    return {'mb_per_s': files * size / elapsed / 1e6, 'disk_mb': usage / 1e6, 'written_mb': written / 1e6}
+
+
+@click.command()
+@click.option('--nbr-slaves', '-n', default=2, help='Number of slaves')
+@click.option('--files', default=200, help='Files written')
+@click.option('--size', default=1024 * 1024, help='Bytes per file')
+@click.option('--duplicates', default=0.5, help='Fraction of the files repeating an earlier one')
+@click.option('--chunk-bytes', default=64 * 1024, help='Chunk size of the chunked slaves')
+@click.option('--seed', default=0)
+def main(nbr_slaves: int, files: int, size: int, duplicates: float, chunk_bytes: int, seed: int):
+    print(f'slaves={nbr_slaves} files={files} size={size} duplicates={duplicates} chunk_bytes={chunk_bytes}')
+    print('storage   master MB/s  slave disk MB  slave written MB')
+    for name, chunks in (('plain', 0), ('chunked', chunk_bytes)):
+        result = run(chunks, nbr_slaves, files, size, duplicates, seed)
+        print(f'{name:<8} {result["mb_per_s"]:>12.1f} {result["disk_mb"]:>14.1f} {result["written_mb"]:>17.1f}')
+
+
+if __name__ == '__main__':
+    main()
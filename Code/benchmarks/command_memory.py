@@ -0,0 +1,55 @@
+"""
+Memory held by replicated commands waiting in the slave queues. The master
+queues --ops writes sharing one payload to --nbr-slaves queues nobody
+consumes, and the traced allocations are reported per pending operation;
+payload bytes are excluded since every command references the same buffer.
+
+    python -m benchmarks.command_memory --ops 1000000 --nbr-slaves 3
+"""
+import click
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.replication_latency import make_config
+from fs import SlaveOperationCommands
+from fs.ReplicaFSMaster import ReplicaFSMaster
+from fs.SlaveQueue import SlaveQueue
+from fs.config import REPLICATION_ASYNC
+
+
+@click.command()
+@click.option('--nbr-slaves', '-n', default=3, help='Number of slave queues')
+@click.option('--ops', default=1000000, help='Number of pending writes')
+@click.option('--size', default=4096, help='Bytes per write')
+def main(nbr_slaves: int, ops: int, size: int):
+    with tempfile.TemporaryDirectory() as root:
+        # Asynchronous replication without a lag limit: nothing waits for
+        # the queues, which only grow.
+        config = make_config(root, nbr_slaves, replication_mode=REPLICATION_ASYNC)
+        queues = [SlaveQueue() for _ in range(nbr_slaves)]
+        master = ReplicaFSMaster(config, queues=queues, nbr_slaves=nbr_slaves)
+        buf = os.urandom(size)
+
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        for i in range(ops):
+            master._replicate(SlaveOperationCommands.Write('/bench', buf, i * size, None))
+        elapsed = time.perf_counter() - start
+        traced, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        command = SlaveOperationCommands.Write('/bench', buf, 0, None)
+        print(f'ops={ops} slaves={nbr_slaves} size={size}')
+        print(f'command object  {sys.getsizeof(command)} bytes, __dict__: {hasattr(command, "__dict__")}')
+        print(f'traced memory   {traced / 1e6:.1f} MB, {traced / ops:.0f} bytes per pending op')
+        print(f'queue lag       {queues[0].lag()}')
+        print(f'enqueue rate    {ops / elapsed:.0f} ops/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Throughput of small files written and closed by several writer threads
+under each durability policy of the master. Every file is created, written
+and flushed, as close() does, through the master operations object with
+slaves in threads, without mounting FUSE.
+
+    python -m benchmarks.durability --writers 8 --files 200
+"""
+import click
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from benchmarks.replication_latency import make_config, percentile
+from fs.ReplicaFSMaster import ReplicaFSMaster
+from fs.ReplicaFSSlave import ReplicaFSSlave
+from fs.SlaveQueue import SlaveQueue
+from fs.config import DURABILITY_NONE, DURABILITY_POLICIES, SLAVE_DURABILITY_POLICIES
+
+
+def run(policy: str, slave_policy: str, nbr_slaves: int, writers: int, files: int, size: int,
+        group_commit_ms: float) -> dict:
+    logger = logging.getLogger('replica_fs.bench')
+
+    with tempfile.TemporaryDirectory() as root:
+        config = make_config(root, nbr_slaves, durability=policy, slave_durability=slave_policy,
+                             group_commit_ms=group_commit_ms)
+        queues = [SlaveQueue() for _ in range(nbr_slaves)]
+        slaves = [
+            ReplicaFSSlave(config, queue=queues[i], slave_n=i, logger=logger)
+            for i in range(nbr_slaves)
+        ]
+        master = ReplicaFSMaster(config, queues=queues, nbr_slaves=nbr_slaves)
+
+        buf = os.urandom(size)
+        latencies = [[] for _ in range(writers)]
+
+        def write_files(i: int):
+            for j in range(files):
+                path = f'/w{i}_{j}'
+                start = time.perf_counter()
+                fh = master.create(path, 0o644)
+                master.write(path, buf, 0, fh)
+                master.flush(path, fh)
+                master.release(path, fh)
+                latencies[i].append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=write_files, args=(i,)) for i in range(writers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        for slave in slaves:
+            slave.stop()
+
+    samples = [latency for writer in latencies for latency in writer]
+    return {
+        'files_per_s': len(samples) / elapsed,
+        'mb_per_s': len(samples) * size / elapsed / 1e6,
+        'p50_ms': percentile(samples, 0.5) * 1e3,
+        'p99_ms': percentile(samples, 0.99) * 1e3,
+    }
+
+
+@click.command()
+@click.option('--nbr-slaves', '-n', default=1, help='Number of slaves')
+@click.option('--writers', default=8, help='Concurrent writer threads')
+@click.option('--files', default=200, help='Files written and closed per writer')
+@click.option('--size', default=16 * 1024, help='Bytes per file')
+@click.option('--slave-durability', type=click.Choice(SLAVE_DURABILITY_POLICIES), default=DURABILITY_NONE)
+@click.option('--group-commit-ms', default=2.0, help='Window of the group policy')
+def main(nbr_slaves: int, writers: int, files: int, size: int, slave_durability: str, group_commit_ms: float):
+    print(f'slaves={nbr_slaves} writers={writers} files={files} size={size} '
+          f'slave_durability={slave_durability} group_commit_ms={group_commit_ms}')
+    print('policy      files/s    MB/s   p50 ms   p99 ms')
+    for policy in DURABILITY_POLICIES:
+        result = run(policy, slave_durability, nbr_slaves, writers, files, size, group_commit_ms)
+        print(f'{policy:<10} {result["files_per_s"]:>8.0f} {result["mb_per_s"]:>7.1f} '
+              f'{result["p50_ms"]:>8.2f} {result["p99_ms"]:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
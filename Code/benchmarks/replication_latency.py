@@ -0,0 +1,82 @@
+"""
+Per-operation replication latency of the master -> slave command path.
+
+The master and slave operation objects are driven directly, without
+mounting FUSE, so only the replication machinery is measured.
+
+    python -m benchmarks.replication_latency --nbr-slaves 2 --ops 2000
+"""
+import click
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+from fs.ReplicaFSMaster import ReplicaFSMaster
+from fs.ReplicaFSSlave import ReplicaFSSlave
+from fs.SlaveQueue import SlaveQueue
+from fs.config import ReplicaFSConfig, REPLICATION_MODES, REPLICATION_SYNC
+
+
+def make_config(root: str, nbr_slaves: int, **kwargs) -> ReplicaFSConfig:
+    config = ReplicaFSConfig(
+        master_mount_point=os.path.join(root, 'mnt_master'),
+        slave_mount_points=[os.path.join(root, f'mnt_slave_{i}') for i in range(nbr_slaves)],
+        master_backing=os.path.join(root, 'master'),
+        slave_backings=[os.path.join(root, f'slave_{i}') for i in range(nbr_slaves)],
+        nbr_slaves=nbr_slaves,
+        **kwargs,
+    )
+    for path in [config.master_backing] + config.slave_backings:
+        os.makedirs(path)
+    return config
+
+
+def percentile(samples, p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+@click.command()
+@click.option('--nbr-slaves', '-n', default=1, help='Number of slaves')
+@click.option('--ops', default=1000, help='Number of replicated writes')
+@click.option('--size', default=4096, help='Bytes per write')
+@click.option('--replication', type=click.Choice(REPLICATION_MODES), default=REPLICATION_SYNC)
+@click.option('--write-quorum', type=int, default=None)
+@click.option('--coalesce-bytes', default=0, help='Write coalescing limit, with --replication async (0 disables)')
+def main(nbr_slaves: int, ops: int, size: int, replication: str, write_quorum: int, coalesce_bytes: int):
+    logger = logging.getLogger('replica_fs.bench')
+
+    with tempfile.TemporaryDirectory() as root:
+        config = make_config(root, nbr_slaves, replication_mode=replication, write_quorum=write_quorum,
+                             coalesce_bytes=coalesce_bytes)
+        queues = [SlaveQueue() for _ in range(nbr_slaves)]
+        master = ReplicaFSMaster(config, queues=queues, nbr_slaves=nbr_slaves)
+        slaves = [
+            ReplicaFSSlave(config, queue=queues[i], slave_n=i, logger=logger)
+            for i in range(nbr_slaves)
+        ]
+
+        fh = master.create('/bench', 0o644)
+        buf = os.urandom(size)
+        samples = []
+        for i in range(ops):
+            start = time.perf_counter()
+            master.write('/bench', buf, i * size, fh)
+            samples.append(time.perf_counter() - start)
+        master.release('/bench', fh)
+        coalescing = master.coalescing_stats()
+
+        for slave in slaves:
+            slave.stop()
+
+    print(f'slaves={nbr_slaves} ops={ops} size={size} replication={replication}')
+    print(f'mean={statistics.mean(samples) * 1e3:.3f}ms '
+          f'p50={percentile(samples, 0.50) * 1e3:.3f}ms '
+          f'p99={percentile(samples, 0.99) * 1e3:.3f}ms')
+    print(f'coalesced writes: merged={coalescing["merged"]} dispatched={coalescing["dispatched"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Aggregate replicated write throughput with slaves running as threads of the
+master's process versus one process per slave, for 1 up to --nbr-slaves
+slaves. Several writer threads write to their own file through the master
+operations object, without mounting FUSE.
+
+    python -m benchmarks.slave_processes --nbr-slaves 4 --writers 4
+"""
+import click
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from benchmarks.replication_latency import make_config
+from fs.ReplicaFSMaster import ReplicaFSMaster
+from fs.ReplicaFSSlave import ReplicaFSSlave
+from fs.SlaveProcess import SlaveProcessProxy
+from fs.SlaveQueue import SlaveQueue
+from fs.config import REPLICATION_MODES, REPLICATION_SYNC
+
+
+def run(nbr_slaves: int, processes: bool, writers: int, ops: int, size: int, replication: str) -> float:
+    logger = logging.getLogger('replica_fs.bench')
+
+    with tempfile.TemporaryDirectory() as root:
+        config = make_config(root, nbr_slaves, replication_mode=replication, slave_processes=processes)
+        queues = [SlaveQueue() for _ in range(nbr_slaves)]
+        if processes:
+            slaves = [SlaveProcessProxy(config, i, queues[i], mount=False) for i in range(nbr_slaves)]
+            for slave in slaves:
+                slave.start()
+        else:
+            slaves = [ReplicaFSSlave(config, queue=queues[i], slave_n=i, logger=logger) for i in range(nbr_slaves)]
+        master = ReplicaFSMaster(config, queues=queues, nbr_slaves=nbr_slaves)
+
+        buf = os.urandom(size)
+
+        def write_file(i: int):
+            path = f'/bench{i}'
+            fh = master.create(path, 0o644)
+            for j in range(ops):
+                master.write(path, buf, j * size, fh)
+            master.release(path, fh)
+
+        threads = [threading.Thread(target=write_file, args=(i,)) for i in range(writers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        for slave in slaves:
+            slave.stop()
+
+    return writers * ops * size / elapsed / 1e6
+
+
+@click.command()
+@click.option('--nbr-slaves', '-n', default=4, help='Largest number of slaves')
+@click.option('--writers', default=4, help='Concurrent writer threads')
+@click.option('--ops', default=500, help='Writes per writer')
+@click.option('--size', default=64 * 1024, help='Bytes per write')
+@click.option('--replication', type=click.Choice(REPLICATION_MODES), default=REPLICATION_SYNC)
+def main(nbr_slaves: int, writers: int, ops: int, size: int, replication: str):
+    print(f'writers={writers} ops={ops} size={size} replication={replication} cpus={os.cpu_count()}')
+    print('slaves  threads MB/s  processes MB/s')
+    for n in range(1, nbr_slaves + 1):
+        threaded = run(n, False, writers, ops, size, replication)
+        processes = run(n, True, writers, ops, size, replication)
+        print(f'{n:>6}  {threaded:>12.1f}  {processes:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""
+Workload benchmarks against the mounted file system. For every number of
+slaves from 1 to --nbr-slaves, replica_fs.py is started in the foreground,
+the workloads run through the master mount, and the file system is
+unmounted again. Every workload reports ops/s, MB/s and the p50/p99
+latency of its operations; the results are written as JSON and, with
+--baseline, compared against an earlier run.
+
+    python -m benchmarks.suite --nbr-slaves 3 --output run.json
+    python -m benchmarks.suite --nbr-slaves 3 --baseline run.json -- --threads
+
+Arguments after -- are passed on to replica_fs.py. --target runs the
+workloads in an existing directory instead, e.g. the bare backing file
+system for reference.
+"""
+from typing import Callable, Dict, List
+import click
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import constants
+from benchmarks.replication_latency import percentile
+
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOUNT_TIMEOUT = 30
+
+# Compared against the baseline, lower is worse for these and higher is
+# worse for the latencies.
+THROUGHPUT_KEYS = ('ops_per_s', 'mb_per_s')
+LATENCY_KEYS = ('p50_ms', 'p99_ms')
+
+
+class Workload:
+    """Times single operations and accumulates the bytes they moved."""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def timed(self, operation: Callable, *args, nbytes: int = 0):
+        start = time.perf_counter()
+        ret = operation(*args)
+        self.latencies.append(time.perf_counter() - start)
+        self.bytes += nbytes
+        return ret
+
+    def result(self) -> dict:
+        ops = len(self.latencies)
+        return {
+            'ops': ops,
+            'seconds': self.elapsed,
+            'ops_per_s': ops / self.elapsed if self.elapsed else 0.0,
+            'mb_per_s': self.bytes / self.elapsed / 1e6 if self.elapsed else 0.0,
+            'p50_ms': percentile(self.latencies, 0.5) * 1e3 if ops else 0.0,
+            'p99_ms': percentile(self.latencies, 0.99) * 1e3 if ops else 0.0,
+        }
+
+
+def sequential_write(root: str, params: dict, w: Workload):
+    buf = os.urandom(params['block_bytes'])
+    fd = os.open(os.path.join(root, 'sequential'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for _ in range(params['file_bytes'] // len(buf)):
+            w.timed(os.write, fd, buf, nbytes=len(buf))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sequential_read(root: str, params: dict, w: Workload):
+    fd = os.open(os.path.join(root, 'sequential'), os.O_RDONLY)
+    try:
+        while w.timed(os.read, fd, params['block_bytes'], nbytes=params['block_bytes']):
+            pass
+    finally:
+        os.close(fd)
+    # The last, empty read only marks the end of the file.
+    w.latencies.pop()
+    w.bytes -= params['block_bytes']
+
+
+def random_write(root: str, params: dict, w: Workload):
+    rng = random.Random(params['seed'])
+    buf = os.urandom(params['small_bytes'])
+    blocks = params['file_bytes'] // len(buf)
+    fd = os.open(os.path.join(root, 'sequential'), os.O_WRONLY)
+    try:
+        for _ in range(params['random_ops']):
+            w.timed(os.pwrite, fd, buf, rng.randrange(blocks) * len(buf), nbytes=len(buf))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def random_read(root: str, params: dict, w: Workload):
+    rng = random.Random(params['seed'] + 1)
+    size = params['small_bytes']
+    blocks = params['file_bytes'] // size
+    fd = os.open(os.path.join(root, 'sequential'), os.O_RDONLY)
+    try:
+        for _ in range(params['random_ops']):
+            w.timed(os.pread, fd, size, rng.randrange(blocks) * size, nbytes=size)
+    finally:
+        os.close(fd)
+
+
+def create_storm(root: str, params: dict, w: Workload):
+    buf = os.urandom(params['small_bytes'])
+
+    def create(path: str):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        os.write(fd, buf)
+        os.close(fd)
+
+    for d in range(params['dirs']):
+        directory = os.path.join(root, 'tree', f'd{d}')
+        os.makedirs(directory)
+        for f in range(params['files'] // params['dirs']):
+            w.timed(create, os.path.join(directory, f'f{f}'), nbytes=len(buf))
+
+
+def stat_walk(root: str, params: dict, w: Workload):
+    # What find does: list every directory and stat every entry.
+    for _ in range(params['walks']):
+        directories = [os.path.join(root, 'tree')]
+        while directories:
+            directory = directories.pop()
+            for name in w.timed(os.listdir, directory):
+                path = os.path.join(directory, name)
+                if stat.S_ISDIR(w.timed(os.lstat, path).st_mode):
+                    directories.append(path)
+
+
+def rename_churn(root: str, params: dict, w: Workload):
+    rng = random.Random(params['seed'] + 2)
+    directory = os.path.join(root, 'tree', 'd0')
+    names = sorted(os.listdir(directory))
+    for i in range(params['renames']):
+        n = rng.randrange(len(names))
+        new = f'r{i}'
+        w.timed(os.rename, os.path.join(directory, names[n]), os.path.join(directory, new))
+        names[n] = new
+
+
+# Run in this order: the later workloads use the files of the earlier ones.
+WORKLOADS = {
+    'sequential_write': sequential_write,
+    'sequential_read': sequential_read,
+    'random_write': random_write,
+    'random_read': random_read,
+    'create_storm': create_storm,
+    'stat_walk': stat_walk,
+    'rename_churn': rename_churn,
+}
+
+
+def run_workloads(root: str, params: dict, names: List[str]) -> Dict[str, dict]:
+    results = {}
+    for name in WORKLOADS:
+        if name not in names:
+            continue
+        w = Workload()
+        start = time.perf_counter()
+        WORKLOADS[name](root, params, w)
+        w.elapsed = time.perf_counter() - start
+        results[name] = w.result()
+        print(f'  {name:<17} {results[name]["ops_per_s"]:>10.0f} ops/s {results[name]["mb_per_s"]:>8.1f} MB/s'
+              f'  p50 {results[name]["p50_ms"]:.3f} ms  p99 {results[name]["p99_ms"]:.3f} ms', flush=True)
+    return results
+
+
+def unmount(path: str):
+    if os.path.ismount(path):
+        subprocess.run(['fusermount', '-u', '-z', path], check=False)
+
+
+@contextlib.contextmanager
+def mounted(nbr_slaves: int, replica_fs_args: List[str]):
+    master = os.path.normpath(os.path.join(CODE_DIR, constants.MASTER_MOUNT_PATH))
+    slaves = [os.path.normpath(os.path.join(CODE_DIR, f'{constants.SLAVE_MOUNT_PATH_PREFIX}{i}'))
+              for i in range(nbr_slaves)]
+    backing = tempfile.mkdtemp(prefix='replicafs_bench_')
+    process = subprocess.Popen(
+        [sys.executable, 'replica_fs.py', '-f', '--nbr-slaves', str(nbr_slaves)] + replica_fs_args + [backing],
+        cwd=CODE_DIR, stdout=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.time() + MOUNT_TIMEOUT
+        while not all(os.path.ismount(path) for path in [master] + slaves):
+            if process.poll() is not None or time.time() > deadline:
+                raise click.ClickException(f'replica_fs.py did not mount {master}')
+            time.sleep(0.1)
+        yield master
+    finally:
+        for path in [master] + slaves:
+            unmount(path)
+        try:
+            process.wait(timeout=MOUNT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        shutil.rmtree(backing, ignore_errors=True)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Returns one line per metric that is worse than the baseline by more than tolerance."""
+    regressions = []
+    for slaves, workloads in results.items():
+        for name, result in workloads.items():
+            reference = baseline.get(slaves, {}).get(name)
+            if reference is None:
+                continue
+            for key in THROUGHPUT_KEYS + LATENCY_KEYS:
+                old, new = reference[key], result[key]
+                if not old:
+                    continue
+                change = (new - old) / old
+                worse = change < -tolerance if key in THROUGHPUT_KEYS else change > tolerance
+                if worse:
+                    regressions.append(f'{slaves} slaves {name} {key}: {old:.3f} -> {new:.3f} ({change:+.0%})')
+    return regressions
+
+
+@click.command(context_settings={'ignore_unknown_options': True})
+@click.option('--nbr-slaves', '-n', default=3, help='Largest number of slaves')
+@click.option('--target', default=None, help='Run in this directory instead of mounting ReplicaFS')
+@click.option('--workload', '-w', 'workloads', multiple=True, type=click.Choice(list(WORKLOADS)),
+              help='Workload to run; repeatable, all by default')
+@click.option('--file-bytes', default=64 * 1024 * 1024, help='Size of the file read and written')
+@click.option('--block-bytes', default=128 * 1024, help='Bytes per sequential read or write')
+@click.option('--small-bytes', default=4096, help='Bytes per random read or write and per created file')
+@click.option('--random-ops', default=2000, help='Random reads and writes')
+@click.option('--files', default=2000, help='Files created')
+@click.option('--dirs', default=20, help='Directories the files are spread over')
+@click.option('--walks', default=3, help='Passes over the created tree')
+@click.option('--renames', default=1000, help='Renames')
+@click.option('--seed', default=0, help='Seed of the random offsets and names')
+@click.option('--output', '-o', default=None, help='Write the results as JSON to this file')
+@click.option('--baseline', default=None, help='JSON results of an earlier run to compare against')
+@click.option('--tolerance', default=0.1, help='Relative change reported as a regression')
+@click.argument('replica_fs_args', nargs=-1, type=click.UNPROCESSED)
+def main(nbr_slaves: int, target: str, workloads: List[str], file_bytes: int, block_bytes: int,
+         small_bytes: int, random_ops: int, files: int, dirs: int, walks: int, renames: int, seed: int,
+         output: str, baseline: str, tolerance: float, replica_fs_args: List[str]):
+    params = {
+        'file_bytes': file_bytes,
+        'block_bytes': block_bytes,
+        'small_bytes': small_bytes,
+        'random_ops': random_ops,
+        'files': files,
+        'dirs': dirs,
+        'walks': walks,
+        'renames': renames,
+        'seed': seed,
+    }
+    names = list(workloads or WORKLOADS)
+
+    results = {}
+    if target is not None:
+        # Keyed like a mount without slaves
+        root = tempfile.mkdtemp(prefix='replicafs_bench_', dir=target)
+        try:
+            print(f'{target}:')
+            results['0'] = run_workloads(root, params, names)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+    else:
+        for n in range(1, nbr_slaves + 1):
+            with mounted(n, list(replica_fs_args)) as master:
+                print(f'{n} slaves:')
+                results[str(n)] = run_workloads(master, params, names)
+
+    run = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'target': target,
+            'replica_fs_args': list(replica_fs_args),
+            'params': params,
+        },
+        'results': results,
+    }
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(run, f, indent=2)
+
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f)['results'], tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regression beyond {tolerance:.0%} against {baseline}')
+
+
+if __name__ == '__main__':
+    main()
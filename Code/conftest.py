@@ -0,0 +1,79 @@
+from contextlib import contextmanager
+from typing import List
+import filecmp
+import logging
+import os
+import threading
+import time
+
+from fs.ChunkedReplicaFSSlave import make_slave
+from fs.ReplicaFSMaster import ReplicaFSMaster
+from fs.SlaveQueue import SlaveQueue
+from fs.config import ReplicaFSConfig
+
+
+# The master and its slaves run in the test process unless a test starts
+# slave daemons; nothing is mounted.
+NBR_SLAVES = 2
+
+
+def local_config(root: str, nbr_slaves: int = NBR_SLAVES, **settings) -> ReplicaFSConfig:
+    config = ReplicaFSConfig(
+        master_mount_point=os.path.join(root, 'mnt'),
+        slave_mount_points=[os.path.join(root, f'mnt_{i}') for i in range(nbr_slaves)],
+        master_backing=os.path.join(root, 'master'),
+        slave_backings=[os.path.join(root, f'slave_{i}') for i in range(nbr_slaves)],
+        nbr_slaves=nbr_slaves,
+        **settings,
+    )
+    for path in [config.master_backing] + config.slave_backings:
+        os.makedirs(path, exist_ok=True)
+    return config
+
+
+@contextmanager
+def local_replica(root: str, nbr_slaves: int = NBR_SLAVES, **settings):
+    # Master and slaves in the test process, for what the daemons hide
+    config = local_config(root, nbr_slaves, **settings)
+    queues = [SlaveQueue(config.queue_max_ops, config.queue_max_bytes) for _ in range(nbr_slaves)]
+    slaves = [
+        make_slave(config, queue=queues[n], slave_n=n, logger=logging.getLogger('replica_fs.test'))
+        for n in range(nbr_slaves)
+    ]
+    master = ReplicaFSMaster(config, queues=queues, nbr_slaves=nbr_slaves)
+    try:
+        yield master, slaves
+    finally:
+        master.destroy('/')
+        for slave in slaves:
+            slave.stop()
+
+
+def assert_same_tree(master_backing: str, slave_backings: List[str]):
+    def check(diff: filecmp.dircmp):
+        assert not diff.left_only and not diff.right_only and not diff.diff_files
+        for sub_diff in diff.subdirs.values():
+            check(sub_diff)
+
+    for slave_backing in slave_backings:
+        check(filecmp.dircmp(master_backing, slave_backing))
+
+
+def poll(condition, timeout: float = 10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'condition not reached'
+        time.sleep(0.01)
+
+
+def stall_slave(slave) -> threading.Event:
+    # The slave applies nothing until the event is set.
+    stalled = threading.Event()
+    dispatch = slave._dispatch_command
+
+    def stall(command):
+        stalled.wait()
+        dispatch(command)
+
+    slave._dispatch_command = stall
+    return stalled
@@ -1,16 +1,45 @@
 from fuse import Operations, FuseOSError
 import errno
 import os
+import time
+
+from .Durability import Durability, FsyncDurability
+from .MetadataCache import MetadataCache
+from .OperationMetrics import OperationMetrics
+from .PositionalIO import read_blocks, write_blocks
 
 
 class BaseOperations(Operations):
-    def __init__(self, mount_point: str, backing_store: str):
+    def __init__(self,
+                 mount_point: str,
+                 backing_store: str,
+                 metadata_cache: MetadataCache = None,
+                 durability: Durability = None,
+                 ):
         self.mount_point = mount_point
         self.backing_store = backing_store
+        self.metadata_cache = metadata_cache
+        self.durability = durability if durability is not None else FsyncDurability()
+        self.metrics = OperationMetrics()
+
+    def __call__(self, op, *args):
+        # Every FUSE operation goes through here.
+        start = time.perf_counter()
+        failed = True
+        try:
+            ret = super().__call__(op, *args)
+            failed = False
+            return ret
+        finally:
+            self.metrics.observe(op, time.perf_counter() - start, failed)
 
     def _get_real_path(self, path: str) -> str:
         if path.startswith('/'):
             path = path[1:]
+        # Slaves get their paths from the master over the network, none may
+        # lead out of the backing store.
+        if path.startswith('/') or '..' in path.split('/'):
+            raise FuseOSError(errno.EINVAL)
 
         path = os.path.join(self.backing_store, path)
         return path
@@ -20,28 +49,64 @@ class BaseOperations(Operations):
         if not os.access(full_path, mode):
             raise FuseOSError(errno.EACCES)
 
+    def _invalidate_metadata(self, path):
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(path)
+
+    def _invalidate_metadata_entry(self, path):
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate_entry(path)
+
+    def _invalidate_metadata_tree(self, path):
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate_tree(path)
+
     def chmod(self, path, mode):
         full_path = self._get_real_path(path)
-        return os.chmod(full_path, mode)
+        ret = os.chmod(full_path, mode)
+        self._invalidate_metadata(path)
+        return ret
 
     def chown(self, path, uid, gid):
         full_path = self._get_real_path(path)
-        return os.chown(full_path, uid, gid)
+        ret = os.chown(full_path, uid, gid)
+        self._invalidate_metadata(path)
+        return ret
 
     def getattr(self, path, fh=None):
+        cache = self.metadata_cache
+        if cache is not None:
+            attrs = cache.get_attrs(path)
+            if attrs is not None:
+                return attrs
+            generation = cache.generation
+
         full_path = self._get_real_path(path)
         st = os.lstat(full_path)
-        return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                                                        'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+        attrs = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+                                                         'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+        if cache is not None:
+            cache.put_attrs(path, attrs, generation)
+        return attrs
 
     def readdir(self, path, fh):
-        full_path = self._get_real_path(path)
+        cache = self.metadata_cache
+        dirents = None if cache is None else cache.get_entries(path)
+
+        if dirents is None:
+            if cache is not None:
+                generation = cache.generation
+            full_path = self._get_real_path(path)
 
-        dirents = ['.', '..']
-        if os.path.isdir(full_path):
-            dirents.extend(os.listdir(full_path))
-        for r in dirents:
-            yield r
+            dirents = ['.', '..']
+            if os.path.isdir(full_path):
+                dirents.extend(os.listdir(full_path))
+            if cache is not None:
+                cache.put_entries(path, dirents, generation)
+
+        # A list rather than a generator, so the listing is done (and
+        # timed) within the call.
+        return list(dirents)
 
     def readlink(self, path):
         pathname = os.readlink(self._get_real_path(path))
@@ -52,14 +117,19 @@ class BaseOperations(Operations):
             return pathname
 
     def mknod(self, path, mode, dev):
-        return os.mknod(self._get_real_path(path), mode, dev)
+        ret = os.mknod(self._get_real_path(path), mode, dev)
+        self._invalidate_metadata_entry(path)
+        return ret
 
     def rmdir(self, path):
         full_path = self._get_real_path(path)
-        return os.rmdir(full_path)
+        ret = os.rmdir(full_path)
+        self._invalidate_metadata_tree(path)
+        return ret
 
     def mkdir(self, path, mode):
         os.mkdir(self._get_real_path(path), mode)
+        self._invalidate_metadata_entry(path)
 
     def statfs(self, path):
         full_path = self._get_real_path(path)
@@ -69,45 +139,77 @@ class BaseOperations(Operations):
                                                          'f_frsize', 'f_namemax'))
 
     def unlink(self, path):
-        return os.unlink(self._get_real_path(path))
+        ret = os.unlink(self._get_real_path(path))
+        self._invalidate_metadata_entry(path)
+        return ret
 
     def symlink(self, name, target):
-        return os.symlink(name, self._get_real_path(target))
+        ret = os.symlink(name, self._get_real_path(target))
+        self._invalidate_metadata_entry(target)
+        return ret
 
     def rename(self, old, new):
-        return os.rename(self._get_real_path(old), self._get_real_path(new))
+        ret = os.rename(self._get_real_path(old), self._get_real_path(new))
+        self._invalidate_metadata_tree(old)
+        self._invalidate_metadata_tree(new)
+        return ret
 
     def link(self, target, name):
-        return os.link(self._get_real_path(target), self._get_real_path(name))
+        ret = os.link(self._get_real_path(target), self._get_real_path(name))
+        self._invalidate_metadata(target)
+        self._invalidate_metadata_entry(name)
+        return ret
 
     def utimens(self, path, times=None):
-        return os.utime(self._get_real_path(path), times)
+        ret = os.utime(self._get_real_path(path), times)
+        self._invalidate_metadata(path)
+        return ret
 
     def open(self, path, flags):
-        return os.open(self._get_real_path(path), flags)
+        ret = os.open(self._get_real_path(path), flags)
+        if flags & (os.O_CREAT | os.O_TRUNC):
+            self._invalidate_metadata_entry(path)
+        return ret
 
     def create(self, path, mode, fi=None):
         full_path = self._get_real_path(path)
-        return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+        ret = os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+        self._invalidate_metadata_entry(path)
+        return ret
 
     def read(self, path, length, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
+        # Positional I/O leaves the handle's offset alone, so threads
+        # sharing fh need no locking.
+        return os.pread(fh, length, offset)
+
+    def read_blocks(self, path, sizes, offset, fh):
+        return read_blocks(fh, sizes, offset)
 
     def write(self, path, buf, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.write(fh, buf)
+        ret = os.pwrite(fh, buf, offset)
+        self._invalidate_metadata(path)
+        return ret
+
+    def write_blocks(self, path, buffers, offset, fh):
+        ret = write_blocks(fh, buffers, offset)
+        self._invalidate_metadata(path)
+        return ret
 
     def truncate(self, path, length, fh=None):
-        full_path = self._get_real_path(path)
-        with open(full_path, 'r+') as f:
-            f.truncate(length)
+        if fh is not None:
+            os.ftruncate(fh, length)
+        else:
+            os.truncate(self._get_real_path(path), length)
+        self._invalidate_metadata(path)
 
     def flush(self, path, fh):
-        return os.fsync(fh)
+        return self.durability.sync(fh)
 
     def release(self, path, fh):
         return os.close(fh)
 
     def fsync(self, path, fdatasync, fh):
-        return self.flush(path, fh)
+        return self.durability.sync(fh, datasync=bool(fdatasync))
+
+    def _sync_handles(self, fhs):
+        self.durability.sync_many(fhs)
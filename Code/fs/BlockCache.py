@@ -0,0 +1,139 @@
+from collections import OrderedDict
+from typing import Callable, Dict, List, Set, Tuple
+import itertools
+import threading
+
+
+class BlockCache:
+    """
+    Bounded LRU cache of file blocks read through the master, keyed by
+    (path, block index). A block shorter than block_size is the last block
+    of the file at the time it was read.
+    """
+
+    def __init__(self, capacity_bytes: int, block_size: int = 64 * 1024):
+        self.capacity_bytes = capacity_bytes
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._blocks: 'OrderedDict[Tuple[str, int], bytes]' = OrderedDict()
+        self._by_path: Dict[str, Set[int]] = {}
+        self._bytes = 0
+        # Bumped on every invalidation so that data fetched before it is
+        # not inserted afterwards. Callers invalidate once the change has
+        # been handed to the slaves, so that a miss read under the new
+        # generation is applied after it.
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def read(self, path: str, length: int, offset: int, fetch: Callable[[int, int], List[bytes]]) -> bytes:
+        if length <= 0:
+            return b''
+
+        bs = self.block_size
+        first = offset // bs
+        last = (offset + length - 1) // bs
+
+        with self._lock:
+            generation = self._generation
+            blocks = {}
+            for index in range(first, last + 1):
+                block = self._blocks.get((path, index))
+                if block is None:
+                    continue
+                self._blocks.move_to_end((path, index))
+                blocks[index] = block
+                if len(block) < bs:
+                    break
+            missing = [
+                index for index in range(first, last + 1)
+                if index not in blocks and not self._beyond_eof(blocks, index)
+            ]
+            self.hits += len(blocks)
+            self.misses += len(missing)
+
+        if missing:
+            # fetch returns the range already split into blocks, the last
+            # one short (and nothing after it) at end of file.
+            start = missing[0] * bs
+            fetched = dict(zip(itertools.count(missing[0]), fetch(start, (missing[-1] + 1) * bs - start)))
+            blocks.update(fetched)
+            self._insert(path, fetched, generation)
+
+        out = bytearray()
+        for index in range(first, last + 1):
+            block = blocks.get(index)
+            if block is None:
+                break
+            out += block
+            if len(block) < bs:
+                break
+        start = offset - first * bs
+        return bytes(out[start:start + length])
+
+    def invalidate(self, path: str, offset: int, length: int):
+        bs = self.block_size
+        first = offset // bs
+        last = (offset + max(length, 1) - 1) // bs
+        with self._lock:
+            self._generation += 1
+            for index in list(self._by_path.get(path, ())):
+                # A short block stops being the end of file once the file
+                # grows past it.
+                if first <= index <= last or len(self._blocks[(path, index)]) < bs:
+                    self._drop(path, index)
+
+    def truncate(self, path: str, length: int):
+        with self._lock:
+            self._generation += 1
+            for index in list(self._by_path.get(path, ())):
+                if index >= length // self.block_size or len(self._blocks[(path, index)]) < self.block_size:
+                    self._drop(path, index)
+
+    def invalidate_path(self, path: str):
+        # Also drops everything below path when it is a directory.
+        with self._lock:
+            self._generation += 1
+            for cached in [p for p in self._by_path if p == path or p.startswith(path + '/')]:
+                for index in list(self._by_path[cached]):
+                    self._drop(cached, index)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'blocks': len(self._blocks),
+                'bytes': self._bytes,
+                'capacity_bytes': self.capacity_bytes,
+            }
+
+    def _beyond_eof(self, blocks: Dict[int, bytes], index: int) -> bool:
+        return any(i < index and len(b) < self.block_size for i, b in blocks.items())
+
+    def _insert(self, path: str, fetched: Dict[int, bytes], generation: int):
+        with self._lock:
+            if generation != self._generation:
+                return
+            for index, block in fetched.items():
+                key = (path, index)
+                if key in self._blocks:
+                    continue
+                self._blocks[key] = block
+                self._by_path.setdefault(path, set()).add(index)
+                self._bytes += len(block)
+            while self._bytes > self.capacity_bytes and self._blocks:
+                (old_path, old_index), _ = next(iter(self._blocks.items()))
+                self._drop(old_path, old_index)
+                self.evictions += 1
+
+    def _drop(self, path: str, index: int):
+        block = self._blocks.pop((path, index))
+        self._bytes -= len(block)
+        indexes = self._by_path[path]
+        indexes.discard(index)
+        if not indexes:
+            del self._by_path[path]
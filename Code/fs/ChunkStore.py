@@ -0,0 +1,149 @@
+from collections import Counter
+from typing import Iterable, List, Tuple
+import hashlib
+import itertools
+import os
+import shutil
+import struct
+import threading
+
+
+DIGEST_BYTES = 20
+# Stands for a chunk of zeros, which is never stored
+HOLE = bytes(DIGEST_BYTES)
+
+# Magic, file size, chunk size
+_MANIFEST_HEADER = struct.Struct('<8sQI')
+_MANIFEST_MAGIC = b'RFSCHNK1'
+
+
+def chunk_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=DIGEST_BYTES).digest()
+
+
+def read_manifest(path: str) -> Tuple[int, int, List[bytes]]:
+    """Returns the size, chunk size and chunk digests of the file whose manifest is at path."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _MANIFEST_HEADER.size:
+        raise ValueError(f'{path} is not a chunk manifest')
+    magic, size, chunk_bytes = _MANIFEST_HEADER.unpack_from(data)
+    if magic != _MANIFEST_MAGIC:
+        raise ValueError(f'{path} is not a chunk manifest')
+    body = data[_MANIFEST_HEADER.size:]
+    return size, chunk_bytes, [body[i:i + DIGEST_BYTES] for i in range(0, len(body), DIGEST_BYTES)]
+
+
+def read_manifest_size(path: str) -> int:
+    with open(path, 'rb') as f:
+        header = f.read(_MANIFEST_HEADER.size)
+    if len(header) < _MANIFEST_HEADER.size:
+        raise ValueError(f'{path} is not a chunk manifest')
+    magic, size, _ = _MANIFEST_HEADER.unpack(header)
+    if magic != _MANIFEST_MAGIC:
+        raise ValueError(f'{path} is not a chunk manifest')
+    return size
+
+
+def encode_manifest(size: int, chunk_bytes: int, digests: List[bytes]) -> bytes:
+    return _MANIFEST_HEADER.pack(_MANIFEST_MAGIC, size, chunk_bytes) + b''.join(digests)
+
+
+class ChunkStore:
+    """
+    Content-addressed store of file chunks, each kept once however many
+    files or offsets contain it. Reference counts live in memory and are
+    rebuilt from the manifests on start, which also drops the chunks no
+    manifest refers to (e.g. written just before a crash).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = os.path.join(path, 'tmp')
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self._lock = threading.Lock()
+        self._refs = Counter()
+        self._tmp_names = itertools.count()
+
+        self.stored_bytes = 0
+        self.written_bytes = 0
+        self.deduplicated_bytes = 0
+
+    def rebuild(self, digests: Iterable[bytes]):
+        with self._lock:
+            self._refs = Counter(digest for digest in digests if digest != HOLE)
+            self.stored_bytes = 0
+            for prefix in os.listdir(self.path):
+                directory = os.path.join(self.path, prefix)
+                if directory == self.tmp_path:
+                    continue
+                for name in os.listdir(directory):
+                    chunk_path = os.path.join(directory, name)
+                    if bytes.fromhex(prefix + name) in self._refs:
+                        self.stored_bytes += os.path.getsize(chunk_path)
+                    else:
+                        os.unlink(chunk_path)
+
+    def put(self, data: bytes, sync: bool = False) -> bytes:
+        """Stores data unless an identical chunk is already there and takes a reference on it."""
+        digest = chunk_digest(data)
+        with self._lock:
+            if self._refs[digest] == 0 and not os.path.exists(self._chunk_path(digest)):
+                self._write_chunk(digest, data, sync)
+                self.stored_bytes += len(data)
+                self.written_bytes += len(data)
+            else:
+                self.deduplicated_bytes += len(data)
+            self._refs[digest] += 1
+        return digest
+
+    def get(self, digest: bytes) -> bytes:
+        with open(self._chunk_path(digest), 'rb') as f:
+            return f.read()
+
+    def release(self, digest: bytes):
+        if digest == HOLE:
+            return
+        with self._lock:
+            self._refs[digest] -= 1
+            if self._refs[digest] > 0:
+                return
+            del self._refs[digest]
+            chunk_path = self._chunk_path(digest)
+            self.stored_bytes -= os.path.getsize(chunk_path)
+            os.unlink(chunk_path)
+
+    def tmp_file(self) -> str:
+        # Manifests are written here before they replace the old ones, so
+        # no half-written file ever shows in the tree.
+        with self._lock:
+            return os.path.join(self.tmp_path, str(next(self._tmp_names)))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'chunks': len(self._refs),
+                'stored_bytes': self.stored_bytes,
+                'written_bytes': self.written_bytes,
+                'deduplicated_bytes': self.deduplicated_bytes,
+            }
+
+    def _chunk_path(self, digest: bytes) -> str:
+        name = digest.hex()
+        return os.path.join(self.path, name[:2], name[2:])
+
+    def _write_chunk(self, digest: bytes, data: bytes, sync: bool):
+        chunk_path = self._chunk_path(digest)
+        os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+        tmp = os.path.join(self.tmp_path, digest.hex())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, chunk_path)
+
+
+def is_zero(data: bytes) -> bool:
+    return data.count(0) == len(data)
@@ -0,0 +1,21 @@
+from fs.config import ReplicaFSConfig
+from .ChunkedStorage import ChunkedStorage
+from .ReplicaFSSlave import ReplicaFSSlave
+
+
+class ChunkedReplicaFSSlave(ReplicaFSSlave, ChunkedStorage):
+    """
+    Slave whose backing store is a chunk store: the replicated operations
+    and the reads of ReplicaFSSlave go through ChunkedStorage instead of
+    plain files.
+    """
+
+    def __init__(self, config: ReplicaFSConfig, *args, **kwargs):
+        self.chunk_bytes = config.slave_chunk_bytes
+        super().__init__(config, *args, **kwargs)
+
+
+def make_slave(config: ReplicaFSConfig, *args, **kwargs) -> ReplicaFSSlave:
+    if config.slave_chunk_bytes > 0:
+        return ChunkedReplicaFSSlave(config, *args, **kwargs)
+    return ReplicaFSSlave(config, *args, **kwargs)
@@ -0,0 +1,348 @@
+from fuse import FuseOSError
+from typing import Dict, List, Optional
+import errno
+import itertools
+import os
+import stat
+import threading
+
+from .Base import BaseOperations
+from .ChunkStore import HOLE, ChunkStore, encode_manifest, is_zero, read_manifest, read_manifest_size
+from .Durability import NoDurability
+
+# Chunks written to by an open file and held in memory; past this many the
+# whole ones are stored right away.
+MAX_DIRTY_CHUNKS = 64
+
+
+class ChunkedFile:
+    """
+    Contents of one file as a list of chunk digests, shared by every handle
+    open on it. Written chunks stay in memory until commit.
+    """
+
+    def __init__(self, path: str, real_path: str, size: int, chunk_bytes: int, digests: List[bytes]):
+        self.path = path
+        self.real_path = real_path
+        self.size = size
+        self.chunk_bytes = chunk_bytes
+        self.digests = digests
+        self.dirty: Dict[int, bytearray] = {}
+        # Digests replaced since the manifest was last written
+        self.stale: List[bytes] = []
+        self.modified = False
+        self.handles = 0
+        self.unlinked = False
+        self.lock = threading.RLock()
+
+    def read(self, store: ChunkStore, length: int, offset: int) -> bytes:
+        with self.lock:
+            end = min(offset + length, self.size)
+            parts = []
+            position = offset
+            while position < end:
+                index, start = divmod(position, self.chunk_bytes)
+                chunk = self._chunk(store, index)
+                size = min(self.chunk_bytes - start, end - position)
+                part = chunk[start:start + size]
+                # Stored chunks are cut at the end of the file they were
+                # written for; the file may have grown since.
+                parts.append(part + bytes(size - len(part)))
+                position += size
+            return b''.join(parts)
+
+    def write(self, store: ChunkStore, data: bytes, offset: int, sync: bool):
+        with self.lock:
+            position = 0
+            while position < len(data):
+                index, start = divmod(offset + position, self.chunk_bytes)
+                size = min(self.chunk_bytes - start, len(data) - position)
+                chunk = self._dirty_chunk(store, index)
+                if len(chunk) < start + size:
+                    chunk.extend(bytes(start + size - len(chunk)))
+                chunk[start:start + size] = data[position:position + size]
+                position += size
+            self.size = max(self.size, offset + len(data))
+            self.modified = True
+            if len(self.dirty) > MAX_DIRTY_CHUNKS:
+                self._store_dirty(store, sync, whole_only=True)
+
+    def truncate(self, store: ChunkStore, length: int):
+        with self.lock:
+            chunks = (length + self.chunk_bytes - 1) // self.chunk_bytes
+            for index in range(chunks, len(self.digests)):
+                self.stale.append(self.digests[index])
+            del self.digests[chunks:]
+            for index in [index for index in self.dirty if index >= chunks]:
+                del self.dirty[index]
+            tail = length % self.chunk_bytes
+            if tail and length < self.size:
+                # Zero what is cut off, a later extension reads it as zeros.
+                del self._dirty_chunk(store, chunks - 1)[tail:]
+            self.size = length
+            self.modified = True
+
+    def commit(self, store: ChunkStore, sync: bool):
+        """Stores the written chunks and replaces the manifest."""
+        with self.lock:
+            if not self.modified:
+                return
+            self._store_dirty(store, sync)
+            if not self.unlinked:
+                write_manifest(store, self.real_path, self.size, self.chunk_bytes, self.digests, sync)
+            stale, self.stale = self.stale, []
+            self.modified = False
+        for digest in stale:
+            store.release(digest)
+
+    def drop(self, store: ChunkStore):
+        # The file is gone and its last handle closed.
+        with self.lock:
+            for digest in self.digests + self.stale:
+                store.release(digest)
+            self.digests = []
+            self.stale = []
+            self.dirty = {}
+
+    def _chunk(self, store: ChunkStore, index: int) -> bytes:
+        chunk = self.dirty.get(index)
+        if chunk is not None:
+            return chunk
+        digest = self.digests[index] if index < len(self.digests) else HOLE
+        if digest == HOLE:
+            return b''
+        return store.get(digest)
+
+    def _dirty_chunk(self, store: ChunkStore, index: int) -> bytearray:
+        chunk = self.dirty.get(index)
+        if chunk is None:
+            chunk = self.dirty[index] = bytearray(self._chunk(store, index))
+        return chunk
+
+    def _store_dirty(self, store: ChunkStore, sync: bool, whole_only: bool = False):
+        for index in sorted(self.dirty):
+            chunk = self.dirty[index]
+            if whole_only and len(chunk) < self.chunk_bytes:
+                continue
+            del self.dirty[index]
+            del chunk[max(self.size - index * self.chunk_bytes, 0):]
+            digest = HOLE if is_zero(chunk) else store.put(bytes(chunk), sync)
+            if index >= len(self.digests):
+                self.digests.extend([HOLE] * (index + 1 - len(self.digests)))
+            self.stale.append(self.digests[index])
+            self.digests[index] = digest
+
+
+def write_manifest(store: ChunkStore, path: str, size: int, chunk_bytes: int, digests: List[bytes], sync: bool,
+                   mode: Optional[int] = None):
+    if mode is None:
+        mode = stat.S_IMODE(os.lstat(path).st_mode)
+    tmp = store.tmp_file()
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    try:
+        os.fchmod(fd, mode)
+        os.write(fd, encode_manifest(size, chunk_bytes, digests))
+        if sync:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+
+
+class ChunkedStorage(BaseOperations):
+    """
+    Backing store keeping file contents as content-addressed chunks of
+    chunk_bytes, so identical files and identical aligned blocks are stored
+    and written once. The tree under the backing store keeps the
+    directories and, in place of each file, a manifest listing its chunks;
+    the chunks themselves live next to it in <backing store>.chunks.
+    """
+
+    chunk_bytes = 64 * 1024
+
+    def __init__(self, mount_point: str, backing_store: str, *args, **kwargs):
+        super().__init__(mount_point, backing_store, *args, **kwargs)
+        self.chunk_store = ChunkStore(backing_store.rstrip('/') + '.chunks')
+        self.chunk_store.rebuild(self._manifest_digests())
+        self._files_lock = threading.Lock()
+        # Open files by mount path, and by handle
+        self._files: Dict[str, ChunkedFile] = {}
+        self._handles: Dict[int, ChunkedFile] = {}
+        self._handle_ids = itertools.count(1)
+
+    def _manifest_digests(self):
+        for directory, _, names in os.walk(self.backing_store):
+            for name in names:
+                yield from read_manifest(os.path.join(directory, name))[2]
+
+    @property
+    def _sync(self) -> bool:
+        return not isinstance(self.durability, NoDurability)
+
+    def _file(self, fh) -> ChunkedFile:
+        with self._files_lock:
+            file = self._handles.get(fh)
+        if file is None:
+            raise FuseOSError(errno.EBADF)
+        return file
+
+    def _open_file(self, path: str) -> int:
+        with self._files_lock:
+            file = self._files.get(path)
+            if file is None:
+                try:
+                    size, chunk_bytes, digests = read_manifest(self._get_real_path(path))
+                except ValueError:
+                    raise FuseOSError(errno.EIO)
+                file = self._files[path] = ChunkedFile(path, self._get_real_path(path), size, chunk_bytes, digests)
+            file.handles += 1
+            fh = next(self._handle_ids)
+            self._handles[fh] = file
+        return fh
+
+    def getattr(self, path, fh=None):
+        attrs = super().getattr(path, fh)
+        if not stat.S_ISREG(attrs['st_mode']):
+            return attrs
+        with self._files_lock:
+            file = self._files.get(path)
+        if file is not None:
+            size = file.size
+        else:
+            try:
+                size = read_manifest_size(self._get_real_path(path))
+            except ValueError:
+                raise FuseOSError(errno.EIO)
+        return dict(attrs, st_size=size)
+
+    def open(self, path, flags):
+        full_path = self._get_real_path(path)
+        if flags & os.O_CREAT and not os.path.exists(full_path):
+            write_manifest(self.chunk_store, full_path, 0, self.chunk_bytes, [], self._sync, mode=0o644)
+            self._invalidate_metadata_entry(path)
+        elif not os.path.isfile(full_path):
+            # Lets the usual errors (ENOENT, EISDIR, ...) through.
+            os.close(os.open(full_path, flags & ~os.O_CREAT))
+        fh = self._open_file(path)
+        if flags & os.O_TRUNC:
+            # Not self.truncate, which a slave refuses.
+            ChunkedStorage.truncate(self, path, 0, fh)
+        return fh
+
+    def create(self, path, mode, fi=None):
+        full_path = self._get_real_path(path)
+        if not os.path.exists(full_path):
+            write_manifest(self.chunk_store, full_path, 0, self.chunk_bytes, [], self._sync, mode=mode & 0o7777)
+            self._invalidate_metadata_entry(path)
+        return self._open_file(path)
+
+    def read(self, path, length, offset, fh):
+        return self._file(fh).read(self.chunk_store, length, offset)
+
+    def read_blocks(self, path, sizes, offset, fh):
+        data = self.read(path, sum(sizes), offset, fh)
+        blocks = []
+        position = 0
+        for size in sizes:
+            block = bytearray(data[position:position + size])
+            blocks.append(block)
+            position += size
+            if len(block) < size:
+                break
+        return blocks
+
+    def write(self, path, buf, offset, fh):
+        self._file(fh).write(self.chunk_store, buf, offset, self._sync)
+        self._invalidate_metadata(path)
+        return len(buf)
+
+    def write_blocks(self, path, buffers, offset, fh):
+        return self.write(path, b''.join(buffers), offset, fh)
+
+    def truncate(self, path, length, fh=None):
+        if fh is None:
+            fh = self._open_file(path)
+            try:
+                return ChunkedStorage.truncate(self, path, length, fh)
+            finally:
+                ChunkedStorage.release(self, path, fh)
+        self._file(fh).truncate(self.chunk_store, length)
+        self._invalidate_metadata(path)
+
+    def flush(self, path, fh):
+        self._file(fh).commit(self.chunk_store, self._sync)
+
+    def fsync(self, path, fdatasync, fh):
+        self.flush(path, fh)
+
+    def _sync_handles(self, fhs):
+        for fh in fhs:
+            self.flush(None, fh)
+
+    def release(self, path, fh):
+        with self._files_lock:
+            file = self._handles.pop(fh, None)
+        if file is None:
+            raise FuseOSError(errno.EBADF)
+        file.commit(self.chunk_store, self._sync)
+        with self._files_lock:
+            file.handles -= 1
+            if file.handles:
+                return
+            if self._files.get(file.path) is file:
+                del self._files[file.path]
+        if file.unlinked:
+            file.drop(self.chunk_store)
+
+    def unlink(self, path):
+        full_path = self._get_real_path(path)
+        with self._files_lock:
+            file = self._files.pop(path, None)
+            if file is not None:
+                # Still readable through the open handles until the last
+                # one is released.
+                file.unlinked = True
+        digests = []
+        if file is None and os.path.isfile(full_path) and not os.path.islink(full_path):
+            digests = self._manifest_chunks(full_path)
+        ret = super().unlink(path)
+        self._release_chunks(digests)
+        return ret
+
+    def rename(self, old, new):
+        new_path = self._get_real_path(new)
+        with self._files_lock:
+            replaced = self._files.pop(new, None)
+            if replaced is not None:
+                replaced.unlinked = True
+        digests = []
+        if replaced is None and os.path.isfile(new_path) and not os.path.islink(new_path) and \
+                os.path.realpath(new_path) != os.path.realpath(self._get_real_path(old)):
+            digests = self._manifest_chunks(new_path)
+
+        ret = super().rename(old, new)
+        self._release_chunks(digests)
+        prefix = old.rstrip('/') + '/'
+        with self._files_lock:
+            for path in [path for path in self._files if path == old or path.startswith(prefix)]:
+                file = self._files.pop(path)
+                moved = new + path[len(old):]
+                file.path = moved
+                file.real_path = self._get_real_path(moved)
+                self._files[moved] = file
+        return ret
+
+    def chunk_stats(self) -> dict:
+        return self.chunk_store.stats()
+
+    @staticmethod
+    def _manifest_chunks(full_path: str) -> List[bytes]:
+        try:
+            return read_manifest(full_path)[2]
+        except ValueError:
+            return []
+
+    def _release_chunks(self, digests: List[bytes]):
+        for digest in digests:
+            self.chunk_store.release(digest)
+
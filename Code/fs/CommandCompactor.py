@@ -0,0 +1,268 @@
+from typing import Callable, Dict, List, Optional, Set
+import itertools
+
+from . import SlaveOperationCommands
+from .SlaveOperationCommands import Chmod, Create, Mkdir, Open, Release, Rename, Rmdir, Truncate, Unlink, Write
+
+# Later commands looked at for one that supersedes a command, and at most
+# for the end of a temporary file
+SUPERSEDE_WINDOW = 64
+CHAIN_WINDOW = 1024
+
+_NAMESPACE = (Create, Mkdir, Rename, Rmdir, Unlink)
+
+
+class Compacted:
+    """
+    Stands in a batch for what compaction made of queued commands: command
+    is applied (None for nothing), then every command of replaces counts as
+    applied. Failures of a quiet command are expected.
+    """
+    __slots__ = ('command', 'replaces', 'quiet')
+
+    def __init__(self, command: Optional[SlaveOperationCommands.Command],
+                 replaces: List[SlaveOperationCommands.Command], quiet: bool = False):
+        self.command = command
+        self.replaces = replaces
+        self.quiet = quiet
+
+
+class CommandCompactor:
+    """
+    Drops from a batch of commands drained from a slave's queue those a
+    later command of the batch makes irrelevant:
+
+    - a write covered by a later write through the same handle, or cut off
+      by a later truncate of it;
+    - a truncate followed by one no longer of the same file, and a chmod
+      followed by another one of the same path;
+    - everything done to a file created in the batch and unlinked later in
+      it, through handles all opened and released in the batch; only its
+      renames are left, as unlinks of the names they replaced.
+
+    Handles are told apart by lifetime, from the Create or Open that maps
+    them to the Release that unmaps them, as a number may be handed out
+    again; a command on a handle opened before the batch, which the slave's
+    fd_map holds, is only ever dropped for a later write or truncate through
+    that same handle. Reads, checksums and pings see every command queued
+    before them, so nothing is dropped across them. The dropped commands
+    count as applied once the command that superseded them is.
+
+    exists tells whether a path exists on the slave before the batch.
+    """
+
+    def __init__(self, exists: Callable[[str], bool]):
+        self.exists = exists
+
+    def compact(self, commands: list) -> list:
+        # The result holds the commands kept, Compacted in place of the
+        # others, and the None that stops the slave if there was one.
+        result = []
+        segment = []
+        names = _Names(self.exists)
+        for command in commands:
+            if SlaveOperationCommands.is_replicated(command):
+                segment.append(command)
+                continue
+            result.extend(self._compact_segment(segment, names))
+            segment = []
+            result.append(command)
+        result.extend(self._compact_segment(segment, names))
+        return result
+
+    def _compact_segment(self, commands: list, names: '_Names') -> list:
+        if len(commands) < 2:
+            for command in commands:
+                names.record(command)
+            return commands
+
+        files = _files(commands)
+        # Index of a command dropped -> index of the one it is applied with
+        dropped: Dict[int, int] = {}
+        # Index of a command -> what is applied in its place, the command
+        # itself counting as applied there unless it was dropped
+        replaced: Dict[int, SlaveOperationCommands.Command] = {}
+
+        self._temporary_files(commands, files, names, dropped, replaced)
+        self._superseded(commands, files, dropped)
+
+        absorbed: Dict[int, List[SlaveOperationCommands.Command]] = {}
+        for i, j in dropped.items():
+            # The command that superseded this one may have been dropped in
+            # turn, for a later one.
+            while j in dropped:
+                j = dropped[j]
+            absorbed.setdefault(j, []).append(commands[i])
+        result = []
+        for i, command in enumerate(commands):
+            if i in replaced:
+                replaces = [] if i in dropped else [command]
+                result.append(Compacted(replaced[i], replaces + absorbed.get(i, []), quiet=True))
+            elif i in dropped:
+                continue
+            elif i in absorbed:
+                result.append(Compacted(command, [command] + absorbed[i]))
+            else:
+                result.append(command)
+        return result
+
+    def _superseded(self, commands: list, files: list, dropped: Dict[int, int]):
+        for i, command in enumerate(commands):
+            if i in dropped or files[i] is None:
+                continue
+            kind = type(command)
+            if kind not in (Write, Truncate, Chmod):
+                continue
+            for j in range(i + 1, min(i + 1 + SUPERSEDE_WINDOW, len(commands))):
+                if files[j] != files[i] or j in dropped:
+                    continue
+                if _supersedes(command, commands[j]):
+                    dropped[i] = j
+                    break
+
+    def _temporary_files(self, commands: list, files: list, names: '_Names',
+                         dropped: Dict[int, int], replaced: Dict[int, SlaveOperationCommands.Command]):
+        for i, command in enumerate(commands):
+            if type(command) == Create and i not in dropped and names.absent(command.path):
+                self._temporary_file(commands, files, i, dropped, replaced)
+            names.record(command)
+
+    @staticmethod
+    def _temporary_file(commands: list, files: list, start: int,
+                        dropped: Dict[int, int], replaced: Dict[int, SlaveOperationCommands.Command]):
+        # Follows the file created at start through its names and handles.
+        path = commands[start].path
+        lifetimes = {files[start]}
+        open_lifetimes = {files[start]}
+        chain = [start]
+        renames = []
+        unlink = None
+        for j in range(start + 1, min(start + CHAIN_WINDOW, len(commands))):
+            command = commands[j]
+            kind = type(command)
+            if files[j] in lifetimes and kind in (Write, Truncate, Release):
+                chain.append(j)
+                if kind == Release:
+                    open_lifetimes.discard(files[j])
+                    if unlink is not None and not open_lifetimes:
+                        break
+                continue
+            if unlink is not None:
+                continue
+            if kind == Open and command.path == path:
+                lifetimes.add(files[j])
+                open_lifetimes.add(files[j])
+                chain.append(j)
+            elif kind in (Truncate, Chmod) and getattr(command, 'fh', None) is None and command.path == path:
+                chain.append(j)
+            elif kind == Rename and command.old == path:
+                renames.append(j)
+                chain.append(j)
+                path = command.new
+            elif kind == Unlink and command.path == path:
+                unlink = j
+                if not open_lifetimes:
+                    break
+            elif any(other == path or path.startswith(other + '/') for other in _paths(command)):
+                return
+        else:
+            return
+        if unlink is None or open_lifetimes:
+            return
+
+        for j in chain:
+            if j < unlink:
+                dropped[j] = unlink
+            else:
+                # Left for handles the file is no longer reachable through
+                replaced[j] = None
+        for j in renames:
+            # Whatever the file was renamed over is gone.
+            replaced[j] = Unlink(commands[j].new)
+        # and its last name, never created on the slave, with it
+        replaced[unlink] = None
+
+
+class _Names:
+    # Whether paths exist, as the commands of a batch leave them: those a
+    # command created or removed are known, the others exist as they did
+    # before the batch unless a directory above them was moved or removed.
+
+    def __init__(self, exists: Callable[[str], bool]):
+        self.exists = exists
+        self.known: Dict[str, bool] = {}
+        self.moved: Set[str] = set()
+
+    def absent(self, path: str) -> bool:
+        if any(directory in self.moved for directory in _ancestry(path)[1:]):
+            return False
+        if path in self.known:
+            return not self.known[path]
+        return not self.exists(path)
+
+    def record(self, command: SlaveOperationCommands.Command):
+        kind = type(command)
+        if kind in (Create, Mkdir):
+            self.known[command.path] = True
+        elif kind in (Unlink, Rmdir):
+            self.known[command.path] = False
+            if kind == Rmdir:
+                self.moved.add(command.path)
+        elif kind == Rename:
+            self.known[command.old] = False
+            self.known[command.new] = True
+            self.moved.update((command.old, command.new))
+
+
+def _supersedes(command: SlaveOperationCommands.Command, later: SlaveOperationCommands.Command) -> bool:
+    # Both are on the same file.
+    if type(command) == Write:
+        if type(later) == Write:
+            return later.offset <= command.offset and \
+                command.offset + len(command.buf) <= later.offset + len(later.buf)
+        return type(later) == Truncate and later.length <= command.offset
+    if type(command) == Truncate:
+        return type(later) == Truncate and later.length <= command.length
+    return type(command) == Chmod and type(later) == Chmod
+
+
+def _files(commands: list) -> List[Optional[tuple]]:
+    # What file each command changes the contents or mode of: a handle's
+    # lifetime, or a path until the next change to the namespace.
+    lifetimes = {}
+    counter = itertools.count()
+    epoch = 0
+    files = []
+    for command in commands:
+        kind = type(command)
+        if kind in (Create, Open):
+            lifetimes[command.ret_fd] = ('handle', next(counter))
+            file = lifetimes[command.ret_fd]
+        elif kind in (Write, Truncate, Release) and command.fh is not None:
+            file = lifetimes.get(command.fh, ('outer', command.fh))
+            if kind == Release:
+                lifetimes.pop(command.fh, None)
+        elif kind in (Truncate, Chmod):
+            file = ('path', command.path, epoch)
+        else:
+            file = None
+        if kind in _NAMESPACE:
+            epoch += 1
+        files.append(file)
+    return files
+
+
+def _paths(command: SlaveOperationCommands.Command) -> List[str]:
+    if type(command) == Rename:
+        return [command.old, command.new]
+    path = getattr(command, 'path', None)
+    return [] if path is None else [path]
+
+
+def _ancestry(path: str) -> List[str]:
+    # The path and the directories above it
+    paths = [path]
+    while path.count('/') > 1:
+        path = path.rsplit('/', 1)[0]
+        paths.append(path)
+    return paths
@@ -0,0 +1,136 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List
+import os
+import threading
+import time
+
+from fs.config import DURABILITY_FDATASYNC, DURABILITY_FSYNC, DURABILITY_GROUP, DURABILITY_NONE
+
+
+class Durability(ABC):
+    """
+    What flush and fsync do with a handle before they return.
+    """
+
+    @abstractmethod
+    def sync(self, fh: int, datasync: bool = False):
+        pass
+
+    def sync_many(self, fhs: List[int]):
+        for fh in fhs:
+            self.sync(fh)
+
+
+class NoDurability(Durability):
+    # Leaves the data to the page cache
+    def sync(self, fh: int, datasync: bool = False):
+        pass
+
+
+class FsyncDurability(Durability):
+    def sync(self, fh: int, datasync: bool = False):
+        if datasync:
+            os.fdatasync(fh)
+        else:
+            os.fsync(fh)
+
+
+class FdatasyncDurability(Durability):
+    def sync(self, fh: int, datasync: bool = False):
+        os.fdatasync(fh)
+
+
+class _SyncRequest:
+    __slots__ = ('done', 'error')
+
+    def __init__(self):
+        self.done = False
+        self.error = None
+
+
+class GroupCommitDurability(Durability):
+    """
+    Group commit across handles: the first caller to find no commit running
+    becomes the leader, waits window seconds for others to join, then
+    fdatasyncs every handle flushed so far while later callers queue up for
+    the next commit.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._lock = threading.Lock()
+        self._committed = threading.Condition(self._lock)
+        self._committing = False
+        self._pending: Dict[int, List[_SyncRequest]] = {}
+
+        self.commits = 0
+        self.syncs = 0
+
+    def sync(self, fh: int, datasync: bool = False):
+        self._commit([fh])
+
+    def sync_many(self, fhs: List[int]):
+        # The handles join the same commit as those of concurrent callers.
+        self._commit(fhs)
+
+    def _commit(self, fhs: List[int]):
+        requests = [_SyncRequest() for _ in fhs]
+        with self._lock:
+            for fh, request in zip(fhs, requests):
+                self._pending.setdefault(fh, []).append(request)
+            while not all(request.done for request in requests):
+                if self._committing:
+                    self._committed.wait()
+                    continue
+
+                self._committing = True
+                self._lock.release()
+                try:
+                    if self.window > 0:
+                        time.sleep(self.window)
+                finally:
+                    self._lock.acquire()
+                pending, self._pending = self._pending, {}
+                self._lock.release()
+                errors = {}
+                try:
+                    errors = self._sync_all(pending)
+                finally:
+                    self._lock.acquire()
+                    self._committing = False
+                    for synced_fh, fh_requests in pending.items():
+                        for fh_request in fh_requests:
+                            fh_request.done = True
+                            fh_request.error = errors.get(synced_fh)
+                    self.commits += 1
+                    self.syncs += len(pending)
+                    self._committed.notify_all()
+
+        for request in requests:
+            if request.error is not None:
+                raise request.error
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'commits': self.commits, 'syncs': self.syncs}
+
+    @staticmethod
+    def _sync_all(pending: Dict[int, List[_SyncRequest]]) -> Dict[int, OSError]:
+        errors = {}
+        for fh in pending:
+            try:
+                os.fdatasync(fh)
+            except OSError as e:
+                errors[fh] = e
+        return errors
+
+
+def make_durability(policy: str, group_commit_window: float) -> Durability:
+    if policy == DURABILITY_GROUP:
+        return GroupCommitDurability(group_commit_window)
+    if policy == DURABILITY_NONE:
+        return NoDurability()
+    if policy == DURABILITY_FDATASYNC:
+        return FdatasyncDurability()
+    assert policy == DURABILITY_FSYNC
+    return FsyncDurability()
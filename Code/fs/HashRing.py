@@ -0,0 +1,47 @@
+from typing import Iterable, List
+import bisect
+import hashlib
+
+# Points each slave has on the ring; more spread the keys more evenly.
+VNODES = 64
+
+
+def _hash(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto slaves. Every slave has VNODES points on
+    a ring of hashes and a key belongs to the first replicas distinct slaves
+    found clockwise from its own hash, so adding or removing a slave only
+    moves the keys next to that slave's points.
+    """
+
+    def __init__(self, slaves: Iterable[int], factor: int):
+        self.slaves = sorted(slaves)
+        self.factor = factor
+        # Fewer while there are fewer slaves than the factor
+        self.replicas = min(factor, len(self.slaves))
+        points = sorted((_hash(f'{n}:{i}'.encode()), n) for n in self.slaves for i in range(VNODES))
+        self._hashes = [point for point, _ in points]
+        self._owners = [n for _, n in points]
+
+    def owners(self, key: int) -> List[int]:
+        owners = []
+        if not self.replicas:
+            return owners
+        start = bisect.bisect(self._hashes, _hash(key.to_bytes(8, 'little')))
+        for i in range(len(self._owners)):
+            n = self._owners[(start + i) % len(self._owners)]
+            if n not in owners:
+                owners.append(n)
+                if len(owners) == self.replicas:
+                    break
+        return owners
+
+    def with_slave(self, n: int) -> 'HashRing':
+        return HashRing(self.slaves + [n], self.factor)
+
+    def without_slave(self, n: int) -> 'HashRing':
+        return HashRing([m for m in self.slaves if m != n], self.factor)
@@ -0,0 +1,142 @@
+from typing import List, Optional
+import dataclasses
+import threading
+import time
+
+from .SlaveHealth import MIN_HEDGE_DELAY, is_slave_fault
+from .SlaveRequestPipeline import SlaveRequestPipeline
+
+
+class HedgedReads:
+    """
+    Reads in flight from the master to the slaves. A thread goes over them
+    a few times per hedge delay and sends again those not answered within
+    it; a timer per read would cost more than the read.
+    """
+
+    def __init__(self, master):
+        self.master = master
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='hedged-reads', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def submit(self, command, first: int) -> SlaveRequestPipeline:
+        read = HedgedRead(self, command)
+        with self._lock:
+            self._in_flight.add(read)
+        read.attempt(first, command)
+        return read
+
+    def forget(self, read: 'HedgedRead'):
+        with self._lock:
+            self._in_flight.discard(read)
+
+    def _run(self):
+        while not self._stopped.wait(max(self.master.health.hedge_delay() / 2, MIN_HEDGE_DELAY)):
+            now = time.monotonic()
+            with self._lock:
+                in_flight = list(self._in_flight)
+            for read in in_flight:
+                if read.deadline <= now:
+                    read.expired()
+
+
+class _Attempt:
+    # Stands in for the pipeline of the command sent to one slave, and
+    # passes the slave's answer on to the read.
+    __slots__ = ('read', 'slave_n', 'start')
+
+    def __init__(self, read: 'HedgedRead', slave_n: int):
+        self.read = read
+        self.slave_n = slave_n
+        self.start = time.perf_counter()
+
+    def provide(self, result):
+        self.read._answered(self, result, None)
+
+    def fail(self, exception: BaseException):
+        self.read._answered(self, None, exception)
+
+
+class HedgedRead(SlaveRequestPipeline):
+    """
+    A Read sent to one slave, and again to another healthy slave holding the
+    file each time the previous ones have not answered by the deadline or
+    have failed; the first answer completes it. With no slave left to ask,
+    the read is served from the master's backing store.
+    """
+
+    def __init__(self, reads: HedgedReads, command):
+        super().__init__()
+        self.reads = reads
+        self.command = command
+        self.deadline = 0.0
+        self._tried: List[int] = []
+        self._pending = 0
+        self._settled = False
+
+    def attempt(self, n: int, command):
+        master = self.reads.master
+        with self._lock:
+            self._tried.append(n)
+            self._pending += 1
+            self.deadline = time.monotonic() + master.health.hedge_delay()
+        command.pipeline = _Attempt(self, n)
+        master.read_scheduler.started(n)
+        master.queues[n].put(command)
+
+    def expired(self):
+        with self._lock:
+            # Settled, or another slave was asked since.
+            if self._settled or self.deadline > time.monotonic():
+                return
+        self.reads.master.health.note_hedged()
+        self._next()
+
+    def _answered(self, attempt: _Attempt, result, exception: Optional[BaseException]):
+        self.reads.master._read_done(attempt.slave_n, exception, time.perf_counter() - attempt.start)
+        with self._lock:
+            if self._settled:
+                return
+            self._pending -= 1
+            retry = exception is not None and is_slave_fault(exception)
+            if retry and self._pending:
+                # Another slave may still answer.
+                return
+        if retry:
+            self._next()
+        else:
+            self._settle(result, exception)
+
+    def _next(self):
+        master = self.reads.master
+        with self._lock:
+            tried = list(self._tried)
+        others = [n for n in master._read_candidates(self.command) if n not in tried]
+        if others:
+            # Each slave completes its own copy of the command.
+            self.attempt(master.read_scheduler.choose(others), dataclasses.replace(self.command, pipeline=None))
+            return
+        local = master._read_locally(self.command)
+        self._settle(local.result, local.exception)
+
+    def _settle(self, result, exception: Optional[BaseException]):
+        with self._lock:
+            if self._settled:
+                return
+            self._settled = True
+        self.reads.forget(self)
+        if exception is not None:
+            self.fail(exception)
+        else:
+            self.provide(result)
@@ -0,0 +1,293 @@
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import os
+import pickle
+import shutil
+import stat
+import struct
+import threading
+
+from .PositionalIO import read_blocks, write_blocks
+
+
+BLOCK_SIZE = 1024 * 1024
+COPY_RUN_BLOCKS = 16
+
+_KIND_DIR = 'd'
+_KIND_FILE = 'f'
+_KIND_LINK = 'l'
+
+_STATE_VERSION = 1
+
+
+def _digest(*parts: bytes) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
+
+def _join(rel: str, name: str) -> str:
+    return f'{rel}/{name}' if rel else name
+
+
+class Node:
+    __slots__ = ('kind', 'mode', 'size', 'mtime_ns', 'blocks', 'target', 'children', 'digest')
+
+    def __init__(self, kind: str, mode: int, digest: bytes = b'', size: int = 0, mtime_ns: int = 0,
+                 blocks: List[bytes] = None, target: str = None, children: List[str] = None):
+        self.kind = kind
+        self.mode = mode
+        self.digest = digest
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.blocks = blocks
+        self.target = target
+        self.children = children
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class MerkleTree:
+    """
+    Hash tree over a backing store: directories hash their entries, files
+    hash a list of fixed-size block hashes. The tree is kept between runs in
+    state_path; refresh() only rehashes files whose size or mtime changed,
+    or whose blocks were invalidated through the mutation hooks.
+    """
+
+    def __init__(self, root: str, state_path: Optional[str] = None, block_size: int = BLOCK_SIZE):
+        self.root = root
+        self.state_path = state_path
+        self.block_size = block_size
+        self.nodes: Dict[str, Node] = {}
+
+        self._lock = threading.Lock()
+        # Relative path -> set of dirty block indexes, None for the whole file
+        self._dirty: Dict[str, Optional[set]] = {}
+        # Block invalidations are only trusted once the tree has been
+        # refreshed in this process, i.e. every change since went through
+        # the hooks.
+        self._tracking = False
+        self._load()
+
+    def invalidate(self, path: str, offset: Optional[int] = None, length: Optional[int] = None):
+        rel = self._rel(path)
+        with self._lock:
+            if offset is None or rel in self._dirty and self._dirty[rel] is None:
+                self._dirty[rel] = None
+                return
+            first = offset // self.block_size
+            last = (offset + max(length, 1) - 1) // self.block_size
+            self._dirty.setdefault(rel, set()).update(range(first, last + 1))
+
+    def rename(self, old: str, new: str):
+        old_rel = self._rel(old)
+        new_rel = self._rel(new)
+        with self._lock:
+            for rel in list(self.nodes):
+                if rel == old_rel or rel.startswith(old_rel + '/'):
+                    self.nodes[new_rel + rel[len(old_rel):]] = self.nodes.pop(rel)
+            for rel in list(self._dirty):
+                if rel == old_rel or rel.startswith(old_rel + '/'):
+                    self._dirty[new_rel + rel[len(old_rel):]] = self._dirty.pop(rel)
+
+    def refresh(self) -> bytes:
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {}
+            tracking = self._tracking
+            old_nodes = self.nodes
+
+        nodes: Dict[str, Node] = {}
+        root = self._scan('', old_nodes, nodes, dirty, tracking)
+
+        with self._lock:
+            self.nodes = nodes
+            self._tracking = True
+        return root.digest
+
+    def save(self):
+        if self.state_path is None:
+            return
+        with self._lock:
+            state = {'version': _STATE_VERSION, 'block_size': self.block_size, 'nodes': self.nodes}
+            with open(self.state_path + '.tmp', 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def resync_from(self, master: 'MerkleTree') -> dict:
+        """
+        Make this tree's backing store identical to master's, copying only
+        the blocks whose hashes differ. Both trees must be refreshed.
+        """
+        stats = {'blocks_copied': 0, 'bytes_copied': 0, 'entries_created': 0, 'entries_removed': 0}
+        self._sync_node(master, '', stats)
+        return stats
+
+    def _rel(self, path: str) -> str:
+        return path.strip('/')
+
+    def _full(self, rel: str) -> str:
+        return os.path.join(self.root, rel) if rel else self.root
+
+    def _load(self):
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return
+        with open(self.state_path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') == _STATE_VERSION and state.get('block_size') == self.block_size:
+            self.nodes = state['nodes']
+
+    def _scan(self, rel: str, old_nodes: Dict[str, Node], nodes: Dict[str, Node],
+              dirty: Dict[str, Optional[set]], tracking: bool) -> Node:
+        full = self._full(rel)
+        st = os.lstat(full)
+        mode = stat.S_IMODE(st.st_mode)
+
+        if stat.S_ISDIR(st.st_mode):
+            children = []
+            parts = [b'd', struct.pack('<I', mode)]
+            for name in sorted(os.listdir(full)):
+                try:
+                    child = self._scan(_join(rel, name), old_nodes, nodes, dirty, tracking)
+                except FileNotFoundError:
+                    # Removed while we were walking
+                    continue
+                children.append(name)
+                parts.append(name.encode('utf-8', 'surrogateescape') + b'\0' + child.digest)
+            node = Node(_KIND_DIR, mode, _digest(*parts), mtime_ns=st.st_mtime_ns, children=children)
+        elif stat.S_ISLNK(st.st_mode):
+            target = os.readlink(full)
+            node = Node(_KIND_LINK, mode, _digest(b'l', target.encode('utf-8', 'surrogateescape')), target=target)
+        else:
+            blocks = self._file_blocks(rel, st, old_nodes.get(rel), dirty, tracking)
+            digest = _digest(b'f', struct.pack('<IQ', mode, st.st_size), *blocks)
+            node = Node(_KIND_FILE, mode, digest, size=st.st_size, mtime_ns=st.st_mtime_ns, blocks=blocks)
+
+        nodes[rel] = node
+        return node
+
+    def _file_blocks(self, rel: str, st: os.stat_result, old: Optional[Node],
+                     dirty: Dict[str, Optional[set]], tracking: bool) -> List[bytes]:
+        nbr_blocks = (st.st_size + self.block_size - 1) // self.block_size
+        unchanged = old is not None and old.kind == _KIND_FILE and \
+            old.size == st.st_size and old.mtime_ns == st.st_mtime_ns
+
+        if rel not in dirty and unchanged:
+            return old.blocks
+
+        if tracking and old is not None and old.kind == _KIND_FILE and dirty.get(rel) is not None:
+            # The hooks told us exactly which blocks were written; when the
+            # size changed, the old last block may have been padded too.
+            rehash = set(dirty[rel])
+            if old.size != st.st_size:
+                rehash.update(range(min(len(old.blocks), nbr_blocks) - 1, nbr_blocks))
+        else:
+            rehash = set(range(nbr_blocks))
+
+        blocks = list(old.blocks[:nbr_blocks]) if old is not None and old.kind == _KIND_FILE else []
+        blocks.extend([b''] * (nbr_blocks - len(blocks)))
+        fd = os.open(self._full(rel), os.O_RDONLY)
+        try:
+            for index in sorted(i for i in rehash if 0 <= i < nbr_blocks):
+                blocks[index] = _digest(os.pread(fd, self.block_size, index * self.block_size))
+        finally:
+            os.close(fd)
+        return blocks
+
+    def _sync_node(self, master: 'MerkleTree', rel: str, stats: dict):
+        m = master.nodes[rel]
+        s = self.nodes.get(rel)
+        if s is not None and s.digest == m.digest:
+            return
+
+        full = self._full(rel)
+        if s is not None and s.kind != m.kind:
+            self._remove(rel, stats)
+            s = None
+
+        if m.kind == _KIND_DIR:
+            if s is None:
+                os.mkdir(full, m.mode)
+                stats['entries_created'] += 1
+            if s is None or s.mode != m.mode:
+                os.chmod(full, m.mode)
+
+            existing = set(s.children) if s is not None else set()
+            for name in existing.difference(m.children):
+                self._remove(_join(rel, name), stats)
+            for name in m.children:
+                self._sync_node(master, _join(rel, name), stats)
+        elif m.kind == _KIND_LINK:
+            if s is not None:
+                self._remove(rel, stats)
+            os.symlink(m.target, full)
+            stats['entries_created'] += 1
+        else:
+            self._sync_file(master, rel, m, s, stats)
+
+        self.nodes[rel] = self._copy_node(m, full)
+
+    def _sync_file(self, master: 'MerkleTree', rel: str, m: Node, s: Optional[Node], stats: dict):
+        if s is None:
+            stats['entries_created'] += 1
+        src = os.open(master._full(rel), os.O_RDONLY)
+        dst = os.open(self._full(rel), os.O_WRONLY | os.O_CREAT, m.mode)
+        try:
+            changed = [
+                index for index, digest in enumerate(m.blocks)
+                if s is None or index >= len(s.blocks) or s.blocks[index] != digest
+            ]
+            # Copy runs of consecutive blocks with one preadv/pwritev each.
+            run = []
+            for index in changed + [None]:
+                if run and (index != run[-1] + 1 or len(run) == COPY_RUN_BLOCKS):
+                    blocks = read_blocks(src, [self.block_size] * len(run), run[0] * self.block_size)
+                    write_blocks(dst, blocks, run[0] * self.block_size)
+                    stats['blocks_copied'] += len(blocks)
+                    stats['bytes_copied'] += sum(len(block) for block in blocks)
+                    run = []
+                if index is not None:
+                    run.append(index)
+            os.ftruncate(dst, m.size)
+            os.fchmod(dst, m.mode)
+        finally:
+            os.close(src)
+            os.close(dst)
+
+    def _remove(self, rel: str, stats: dict):
+        full = self._full(rel)
+        if os.path.isdir(full) and not os.path.islink(full):
+            shutil.rmtree(full)
+        else:
+            os.unlink(full)
+        stats['entries_removed'] += 1
+        for other in list(self.nodes):
+            if other == rel or other.startswith(rel + '/'):
+                del self.nodes[other]
+
+    @staticmethod
+    def _copy_node(m: Node, full: str) -> Node:
+        st = os.lstat(full)
+        return Node(m.kind, m.mode, m.digest, size=m.size, mtime_ns=st.st_mtime_ns,
+                    blocks=m.blocks, target=m.target, children=m.children)
+
+
+def state_path_for(merkle_path: str, backing_store: str) -> str:
+    return os.path.join(merkle_path, os.path.basename(os.path.normpath(backing_store)) + '.merkle')
+
+
+def resync_backing_store(master: MerkleTree, slave: MerkleTree) -> Tuple[bytes, dict]:
+    master.refresh()
+    slave.refresh()
+    stats = slave.resync_from(master)
+    digest = slave.refresh()
+    slave.save()
+    master.save()
+    return digest, stats
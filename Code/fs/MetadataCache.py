@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from typing import List, Optional
+import os
+import threading
+
+
+class MetadataCache:
+    """
+    Bounded LRU cache of getattr results and directory listings, keyed by
+    mount path. Entries never expire on their own; the operations that
+    change metadata invalidate them.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._attrs: 'OrderedDict[str, dict]' = OrderedDict()
+        self._entries: 'OrderedDict[str, List[str]]' = OrderedDict()
+        # Bumped on every invalidation so a lookup that raced with a change
+        # does not insert what it read before the change.
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get_attrs(self, path: str) -> Optional[dict]:
+        return self._get(self._attrs, path)
+
+    def put_attrs(self, path: str, attrs: dict, generation: int):
+        self._put(self._attrs, path, attrs, generation)
+
+    def get_entries(self, path: str) -> Optional[List[str]]:
+        return self._get(self._entries, path)
+
+    def put_entries(self, path: str, entries: List[str], generation: int):
+        self._put(self._entries, path, entries, generation)
+
+    def invalidate(self, path: str):
+        with self._lock:
+            self._generation += 1
+            self._attrs.pop(path, None)
+            self._entries.pop(path, None)
+
+    def invalidate_entry(self, path: str):
+        # path was created or removed: its parent's listing, link count and
+        # times change as well.
+        parent = os.path.dirname(path.rstrip('/')) or '/'
+        with self._lock:
+            self._generation += 1
+            for cached in (path, parent):
+                self._attrs.pop(cached, None)
+                self._entries.pop(cached, None)
+
+    def invalidate_tree(self, path: str):
+        self.invalidate_entry(path)
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            self._generation += 1
+            for cache in (self._attrs, self._entries):
+                for cached in [p for p in cache if p.startswith(prefix)]:
+                    del cache[cached]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'attrs': len(self._attrs),
+                'listings': len(self._entries),
+            }
+
+    def _get(self, cache: OrderedDict, path: str):
+        with self._lock:
+            value = cache.get(path)
+            if value is None:
+                self.misses += 1
+                return None
+            cache.move_to_end(path)
+            self.hits += 1
+            return value
+
+    def _put(self, cache: OrderedDict, path: str, value, generation: int):
+        with self._lock:
+            if generation != self._generation:
+                return
+            cache[path] = value
+            cache.move_to_end(path)
+            while len(cache) > self.max_entries:
+                cache.popitem(last=False)
@@ -0,0 +1,94 @@
+from typing import Dict, List
+import bisect
+import threading
+
+
+# Upper bounds of the latency buckets in seconds: 10us doubling up to ~10s,
+# plus an implicit +Inf bucket.
+BUCKETS = tuple(10e-6 * 2 ** i for i in range(21))
+
+
+class LatencyHistogram:
+    __slots__ = ('counts', 'count', 'errors', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float, failed: bool):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.errors += failed
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def cumulative(self) -> List[int]:
+        counts = []
+        running = 0
+        for count in self.counts:
+            running += count
+            counts.append(running)
+        return counts
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-quantile, at most the
+        # largest latency seen.
+        rank = q * self.count
+        for bound, running in zip(BUCKETS, self.cumulative()):
+            if running >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class OperationMetrics:
+    """
+    Latency histograms of the FUSE operations served, one per operation
+    name, with the number of operations that failed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, LatencyHistogram] = {}
+
+    def observe(self, op: str, seconds: float, failed: bool = False):
+        with self._lock:
+            histogram = self._histograms.get(op)
+            if histogram is None:
+                histogram = self._histograms[op] = LatencyHistogram()
+            histogram.observe(seconds, failed)
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                op: {
+                    'count': histogram.count,
+                    'errors': histogram.errors,
+                    'total_seconds': histogram.total,
+                    'p50_seconds': histogram.quantile(0.5),
+                    'p99_seconds': histogram.quantile(0.99),
+                    'max_seconds': histogram.max,
+                } for op, histogram in sorted(self._histograms.items())
+            }
+
+    def prometheus(self, name: str) -> List[str]:
+        """Lines of the histograms in the Prometheus text format."""
+        lines = [
+            f'# HELP {name}_seconds Latency of the FUSE operations served.',
+            f'# TYPE {name}_seconds histogram',
+        ]
+        errors = [
+            f'# HELP {name}_errors_total FUSE operations that failed.',
+            f'# TYPE {name}_errors_total counter',
+        ]
+        with self._lock:
+            for op, histogram in sorted(self._histograms.items()):
+                for bound, running in zip(BUCKETS + (float('inf'),), histogram.cumulative()):
+                    le = '+Inf' if bound == float('inf') else f'{bound:.6g}'
+                    lines.append(f'{name}_seconds_bucket{{op="{op}",le="{le}"}} {running}')
+                lines.append(f'{name}_seconds_sum{{op="{op}"}} {histogram.total:.9g}')
+                lines.append(f'{name}_seconds_count{{op="{op}"}} {histogram.count}')
+                errors.append(f'{name}_errors_total{{op="{op}"}} {histogram.errors}')
+        return lines + errors
@@ -0,0 +1,65 @@
+from contextlib import contextmanager
+import threading
+
+
+class PathLocks:
+    """
+    Striped locks keyed by path or file handle, so that operations on the
+    same key are serialised while unrelated keys proceed in parallel. On
+    top of that, operations that reshape the tree (rename, rmdir) can take
+    the lock exclusively to wait out and hold off every other mutation.
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self._condition = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._exclusive_waiting = 0
+
+    @contextmanager
+    def hold(self, *keys):
+        # Always acquire stripes in index order so two callers holding
+        # several keys cannot deadlock.
+        indexes = sorted({hash(key) % len(self._stripes) for key in keys})
+        for index in indexes:
+            self._stripes[index].acquire()
+        try:
+            yield
+        finally:
+            for index in reversed(indexes):
+                self._stripes[index].release()
+
+    @contextmanager
+    def shared(self):
+        with self._condition:
+            while self._exclusive or self._exclusive_waiting:
+                self._condition.wait()
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._shared -= 1
+                if not self._shared:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._condition:
+            self._exclusive_waiting += 1
+            while self._exclusive or self._shared:
+                self._condition.wait()
+            self._exclusive_waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+    @contextmanager
+    def mutation(self, *paths):
+        with self.shared(), self.hold(*paths):
+            yield
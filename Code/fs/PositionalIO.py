@@ -0,0 +1,44 @@
+from typing import List, Sequence
+import os
+
+
+# preadv/pwritev take at most this many buffers per call
+IOV_MAX = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in os.sysconf_names else 1024
+
+
+def read_blocks(fd: int, sizes: Sequence[int], offset: int) -> List[bytearray]:
+    """
+    Reads consecutive blocks of the given sizes starting at offset with as
+    few preadv calls as possible. Stops at end of file: the last block
+    returned is then short, possibly empty, and the blocks past it are left
+    out.
+    """
+    blocks = []
+    for start in range(0, len(sizes), IOV_MAX):
+        buffers = [bytearray(size) for size in sizes[start:start + IOV_MAX]]
+        remaining = os.preadv(fd, buffers, offset)
+        offset += remaining
+        for buffer in buffers:
+            if remaining < len(buffer):
+                del buffer[remaining:]
+                blocks.append(buffer)
+                return blocks
+            blocks.append(buffer)
+            remaining -= len(buffer)
+    return blocks
+
+
+def write_blocks(fd: int, buffers: Sequence[bytes], offset: int) -> int:
+    """Writes all buffers back to back at offset, retrying short writes."""
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    total = 0
+    while views:
+        written = os.pwritev(fd, views[:IOV_MAX], offset)
+        offset += written
+        total += written
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if written:
+            views[0] = views[0][written:]
+    return total
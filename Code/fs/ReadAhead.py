@@ -0,0 +1,152 @@
+from collections import namedtuple
+from typing import Callable, Dict, List, Optional, Tuple
+import threading
+import typing
+
+
+# A range of a file requested from a slave; the pipeline yields its bytes.
+ReadPart = namedtuple('ReadPart', ['offset', 'length', 'pipeline'])
+
+
+def assemble(parts: List[ReadPart], offset: int, length: int) -> bytes:
+    """
+    Joins the bytes of [offset, offset + length) from consecutive parts,
+    stopping at the first part cut short by the end of the file.
+    """
+    out = bytearray()
+    for part in parts:
+        if part.offset + part.length <= offset:
+            continue
+        if part.offset >= offset + length:
+            break
+        data = part.pipeline.get()
+        start = max(offset - part.offset, 0)
+        out += data[start:offset + length - part.offset]
+        if len(data) < part.length:
+            break
+    return bytes(out)
+
+
+class _Stream:
+    __slots__ = ('next_offset', 'streak', 'parts')
+
+    def __init__(self):
+        self.next_offset = None
+        self.streak = 0
+        # Consecutive parts fetched ahead of the reader
+        self.parts: List[ReadPart] = []
+
+
+class ReadAhead:
+    """
+    Detects handles that are read sequentially and keeps up to window_bytes
+    past the reader's position in flight from the slaves, so that the next
+    reads are served from data already fetched.
+    """
+
+    def __init__(self, window_bytes: int, trigger: int = 2):
+        self.window_bytes = window_bytes
+        # Number of back to back sequential reads before prefetching starts
+        self.trigger = trigger
+        self._lock = threading.Lock()
+        self._streams: Dict[Tuple[str, 'typing.Any'], _Stream] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.prefetched_bytes = 0
+
+    def read(self,
+             path: str,
+             fh,
+             length: int,
+             offset: int,
+             submit: Callable[[int, int], List[ReadPart]],
+             prefetch: Callable[[int, int, Callable[[List[ReadPart]], None]], None],
+             ) -> bytes:
+        """
+        submit(offset, length) requests a range from the slaves.
+        prefetch(offset, length, register) does the same for a range ahead
+        of the reader and hands the parts to register(), with the path
+        locked against writes so an invalidation cannot slip in between.
+        """
+        key = (path, fh)
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is None:
+                stream = self._streams[key] = _Stream()
+            if offset == stream.next_offset:
+                stream.streak += 1
+            else:
+                stream.streak = 0
+                stream.parts = []
+            stream.next_offset = offset + length
+
+            parts = self._covering(stream.parts, offset, length)
+            stream.parts = [part for part in stream.parts if part.offset + part.length > offset]
+            if stream.parts and stream.parts[-1].offset + stream.parts[-1].length < offset + length:
+                # The reader overtook the prefetched data.
+                stream.parts = []
+            if parts is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+            ahead = None
+            if stream.streak >= self.trigger:
+                window_end = offset + length + self.window_bytes
+                fetched_end = stream.parts[-1].offset + stream.parts[-1].length if stream.parts else offset + length
+                # Top the window up once the reader went through half of it.
+                if window_end - fetched_end >= self.window_bytes // 2:
+                    start = max(fetched_end, offset + length)
+                    ahead = (start, window_end - start)
+
+        data = None
+        if parts is not None:
+            try:
+                data = assemble(parts, offset, length)
+            except OSError:
+                # The prefetch failed, e.g. because the handle is gone;
+                # the direct read below reports the error if it persists.
+                pass
+        if data is None:
+            data = assemble(submit(offset, length), offset, length)
+
+        if ahead is not None:
+            prefetch(ahead[0], ahead[1], lambda new_parts: self._register(key, stream, new_parts))
+        return data
+
+    def forget(self, path: str, fh):
+        with self._lock:
+            self._streams.pop((path, fh), None)
+
+    def invalidate(self, path: str):
+        # Also drops everything below path when it is a directory.
+        with self._lock:
+            for key in [key for key in self._streams if key[0] == path or key[0].startswith(path + '/')]:
+                del self._streams[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'prefetched_bytes': self.prefetched_bytes,
+                'streams': len(self._streams),
+            }
+
+    def _register(self, key, stream: _Stream, parts: List[ReadPart]):
+        with self._lock:
+            # Dropped in the meantime by an invalidation or a random read
+            if self._streams.get(key) is not stream or not parts:
+                return
+            end = stream.parts[-1].offset + stream.parts[-1].length if stream.parts else None
+            if end is not None and parts[0].offset != end:
+                return
+            stream.parts.extend(parts)
+            self.prefetched_bytes += sum(part.length for part in parts)
+
+    @staticmethod
+    def _covering(parts: List[ReadPart], offset: int, length: int) -> Optional[List[ReadPart]]:
+        if not parts or parts[0].offset > offset or parts[-1].offset + parts[-1].length < offset + length:
+            return None
+        return [part for part in parts if part.offset < offset + length and part.offset + part.length > offset]
@@ -0,0 +1,103 @@
+from abc import ABC, abstractmethod
+from typing import List
+import threading
+
+from fs.config import READ_EWMA, READ_LEAST_OUTSTANDING, READ_ROUND_ROBIN
+from .SlaveQueue import SlaveQueue
+
+
+class ReadScheduler(ABC):
+    """
+    Picks the slave that serves the next read through the master and keeps
+    per-slave statistics: reads in flight, reads served and an
+    exponentially weighted moving average of the response time.
+    """
+
+    EWMA_ALPHA = 0.2
+
+    def __init__(self, queues: List[SlaveQueue]):
+        self.queues = queues
+        self._lock = threading.Lock()
+        self.outstanding = [0] * len(queues)
+        self.served = [0] * len(queues)
+        self.ewma = [None] * len(queues)
+
+    @abstractmethod
+    def choose(self, candidates: List[int]) -> int:
+        # candidates are the slaves currently fit to serve reads, never empty.
+        pass
+
+    def add_slave(self):
+        # Its queue is already in queues.
+        with self._lock:
+            self.outstanding.append(0)
+            self.served.append(0)
+            self.ewma.append(None)
+
+    def started(self, n: int):
+        with self._lock:
+            self.outstanding[n] += 1
+
+    def finished(self, n: int, elapsed: float):
+        with self._lock:
+            self.outstanding[n] -= 1
+            self.served[n] += 1
+            if self.ewma[n] is None:
+                self.ewma[n] = elapsed
+            else:
+                self.ewma[n] += self.EWMA_ALPHA * (elapsed - self.ewma[n])
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [
+                {
+                    'outstanding': self.outstanding[n],
+                    'served': self.served[n],
+                    'ewma_seconds': self.ewma[n],
+                    'queue_depth': self.queues[n].qsize(),
+                } for n in range(len(self.outstanding))
+            ]
+
+    def _depth(self, n: int) -> int:
+        # Reads already in flight plus whatever the slave still has to apply
+        # before it gets to a new request.
+        return self.outstanding[n] + self.queues[n].qsize()
+
+
+class RoundRobinReadScheduler(ReadScheduler):
+    def __init__(self, queues: List[SlaveQueue]):
+        super().__init__(queues)
+        self._next = 0
+
+    def choose(self, candidates: List[int]) -> int:
+        with self._lock:
+            n = min(candidates, key=lambda n: (n - self._next) % len(self.queues))
+            self._next = (n + 1) % len(self.queues)
+            return n
+
+
+class LeastOutstandingReadScheduler(ReadScheduler):
+    def choose(self, candidates: List[int]) -> int:
+        with self._lock:
+            return min(candidates, key=self._depth)
+
+
+class EwmaLatencyReadScheduler(ReadScheduler):
+    def choose(self, candidates: List[int]) -> int:
+        with self._lock:
+            # A slave that has not served anything yet is tried first.
+            return min(
+                candidates,
+                key=lambda n: -1 if self.ewma[n] is None else self.ewma[n] * (self._depth(n) + 1),
+            )
+
+
+_SCHEDULERS = {
+    READ_ROUND_ROBIN: RoundRobinReadScheduler,
+    READ_LEAST_OUTSTANDING: LeastOutstandingReadScheduler,
+    READ_EWMA: EwmaLatencyReadScheduler,
+}
+
+
+def make_read_scheduler(policy: str, queues: List[SlaveQueue]) -> ReadScheduler:
+    return _SCHEDULERS[policy](queues)
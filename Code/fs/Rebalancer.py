@@ -0,0 +1,123 @@
+from typing import List
+import logging
+import os
+import stat
+
+from . import SlaveOperationCommands
+from .HashRing import HashRing
+from .SlaveBootstrap import CATCHING_UP, COPYING, FAILED, JOIN_LAG_OPS, STOPPED, SlaveGone, TreeCopy, outermost_paths
+from .SlaveQueue import SlaveQueue
+
+DROPPING = 'dropping'
+DONE = 'done'
+
+
+class Rebalancer(TreeCopy):
+    """
+    Moves files between slaves when the hash ring changes from previous to
+    ring. Every file is first copied to the slaves that own it under ring
+    only (slaves joining also get the directories) while the master sends
+    its commands to its owners under both rings; the master then places and
+    reads files by ring alone, and every file is unlinked from the slaves
+    that only owned it under previous, which meanwhile still follow the
+    renames and unlinks. Consistent hashing keeps
+    the files that move to those near the points of the slaves that joined
+    or left.
+    """
+
+    def __init__(self, master, previous: HashRing, ring: HashRing, joining: List[int],
+                 logger: logging.Logger = None):
+        super().__init__(master, 'rebalance', logger)
+        self.previous = previous
+        self.ring = ring
+        self.joining = joining
+        self.unlinked = 0
+
+    def running(self) -> bool:
+        return self.state not in (DONE, FAILED, STOPPED)
+
+    def renamed(self, path: str):
+        with self._lock:
+            if self.state in (COPYING, DROPPING):
+                self._renamed.add(path)
+
+    def _directory_queues(self) -> List[SlaveQueue]:
+        return self._queues(self.joining)
+
+    def _file_queues(self, fd: int) -> List[SlaveQueue]:
+        key = os.fstat(fd).st_ino
+        previous = self.previous.owners(key)
+        return self._queues([n for n in self.ring.owners(key) if n not in previous])
+
+    def _queues(self, slaves: List[int]) -> List[SlaveQueue]:
+        # Not to slaves detached meanwhile
+        replicated_to = self.master._replicated_to
+        return [self.master.queues[n] for n in slaves if n in replicated_to]
+
+    def _run(self):
+        try:
+            self._copy_all(CATCHING_UP)
+            while True:
+                self._wait_for_lag(self._queues(self.ring.slaves), max_ops=JOIN_LAG_OPS)
+                if self.master._finish_rebalance(self):
+                    break
+                self._check()
+
+            self.state = DROPPING
+            self._drop('/')
+            while True:
+                with self._lock:
+                    renamed, self._renamed = self._renamed, set()
+                    if not renamed:
+                        self.state = DONE
+                        break
+                for path in outermost_paths(renamed):
+                    self._drop(path)
+            self.master._end_rebalance(self)
+            self.logger.info(f'Rebalanced: {self.stats()}')
+        except SlaveGone:
+            self.state = STOPPED if self._stopped.is_set() else FAILED
+        except Exception:
+            self.logger.exception('Rebalancing failed')
+            self.state = FAILED
+        if self.state == FAILED and not self._stopped.is_set():
+            self.master._end_rebalance(self)
+            for n in self.joining:
+                if n in self.master._replicated_to and n not in self.master._rings[0].slaves:
+                    self.master.detach_slave(n)
+
+    def _drop(self, root: str):
+        master = self.master
+        real_root = master._get_real_path(root)
+        paths = [root] if os.path.isfile(real_root) else (
+            '/' + os.path.relpath(os.path.join(directory, name), master.backing_store)
+            for directory, _, names in os.walk(real_root) for name in names
+        )
+        for path in paths:
+            self._check()
+            with master._locks.mutation(path):
+                try:
+                    attrs = os.lstat(master._get_real_path(path))
+                except FileNotFoundError:
+                    continue
+                if not stat.S_ISREG(attrs.st_mode):
+                    continue
+                owners = self.ring.owners(attrs.st_ino)
+                lost = self._queues([n for n in self.previous.owners(attrs.st_ino) if n not in owners])
+                if lost:
+                    self._put(lost, SlaveOperationCommands.Unlink(path))
+            with self._lock:
+                self.unlinked += len(lost)
+
+    def _check(self):
+        super()._check()
+        for n in self.joining:
+            proxy = self.master._proxies.get(n)
+            if proxy is not None and not proxy.connected():
+                self.logger.error(f'Slave {n} disconnected while joining')
+                raise SlaveGone()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        with self._lock:
+            return dict(stats, unlinked=self.unlinked, joining=list(self.joining))
@@ -0,0 +1,286 @@
+from collections import deque
+from fuse import FuseOSError
+import errno
+import itertools
+import threading
+import typing
+
+from . import SlaveOperationCommands
+from .ReplicaFSSlave import ReplicaFSSlave
+from .ReplicationJournal import ReplicationJournal
+from .SharedRing import SharedRing
+from .SlaveQueue import SlaveQueue
+
+
+# Messages exchanged with a slave outside the master's process:
+#   master -> slave  ('journal', id), ('replay', seq, name, fields, payload), ('replayed', seq),
+#                    ('command', id, name, fields, payload), None to stop
+#   slave -> master  ('ack', [id, ...]), ('result', id, data), ('error', id, errno), ('replayed', seq)
+# payload is the (offset, length) of a write's buffer in a shared ring, or
+# None when the buffer travels inline in fields. The fields of replicated
+# commands include their seq in the journal, if there is one.
+
+
+def _wire_fields(command: SlaveOperationCommands.Command) -> dict:
+    fields = SlaveOperationCommands.data_fields(command)
+    fields['seq'] = command.seq
+    if isinstance(fields.get('buf'), memoryview):
+        fields['buf'] = bytes(fields['buf'])
+    return fields
+
+
+class RemoteSlaveProxy:
+    """
+    Master side of a slave living outside the master's process. Commands
+    put on the slave's queue are forwarded over conn without waiting for
+    the previous ones, and the slave's acknowledgements and read results
+    are turned back into the usual events and pipelines.
+    """
+
+    def __init__(self,
+                 slave_n: int,
+                 queue: SlaveQueue,
+                 conn,
+                 journal: ReplicationJournal = None,
+                 ring: SharedRing = None,
+                 acknowledges: bool = True,
+                 ):
+        self.slave_n = slave_n
+        self.queue = queue
+        self.journal = journal
+        self.ring = ring
+        # Whether the slave counts towards the acks writers wait for; not
+        # while it is being brought up to date.
+        self.acknowledges = acknowledges
+        self._conn = conn
+
+        self._request_ids = itertools.count()
+        # Request id -> (command, whether its payload is in the ring)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        # Set once the slave is gone, after which commands are abandoned
+        # instead of forwarded
+        self._disconnected = False
+        self._forward_thread = threading.Thread(target=self._forward, daemon=True)
+        self._receive_thread = threading.Thread(target=self._receive, daemon=True)
+
+    def start(self):
+        self._forward_thread.start()
+        self._receive_thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self._forward_thread.join()
+        self._receive_thread.join()
+
+    def connected(self) -> bool:
+        return self._receive_thread.is_alive()
+
+    def _forward(self):
+        if self.journal is not None:
+            self._forward_replay()
+
+        while True:
+            command = self.queue.get()
+            if command is None:
+                try:
+                    self._conn.send(None)
+                except OSError:
+                    pass
+                return
+
+            fields = _wire_fields(command)
+            payload = None
+            if self.ring is not None and type(command) == SlaveOperationCommands.Write:
+                payload = self.ring.store(command.buf)
+                if payload is not None:
+                    fields['buf'] = None
+
+            request_id = next(self._request_ids)
+            with self._pending_lock:
+                disconnected = self._disconnected
+                if not disconnected:
+                    self._pending[request_id] = (command, payload is not None)
+            if disconnected:
+                if payload is not None:
+                    self.ring.release()
+                self._abandon(command)
+                continue
+            try:
+                self._conn.send(('command', request_id, type(command).__name__, fields, payload))
+            except OSError:
+                # Abandoned by _receive, which sees the connection end too
+                pass
+
+    def _forward_replay(self):
+        last_seq = self.journal.applied[self.slave_n]
+        try:
+            self._conn.send(('journal', self.journal.id))
+            for seq, command in self.journal.replay(last_seq):
+                self._conn.send(('replay', seq, type(command).__name__, _wire_fields(command), None))
+                last_seq = seq
+            self._conn.send(('replayed', last_seq))
+        except OSError:
+            # The journal keeps the rest for the next connection.
+            pass
+
+    def _receive(self):
+        while True:
+            try:
+                message = self._conn.recv()
+            except (EOFError, OSError):
+                break
+
+            kind = message[0]
+            if kind == 'ack':
+                for request_id in message[1]:
+                    self._acknowledge(self._pop(request_id))
+                if self.journal is not None:
+                    self.journal.release_segments()
+            elif kind == 'result':
+                self._pop(message[1]).pipeline.provide(message[2])
+            elif kind == 'error':
+                self._pop(message[1]).pipeline.fail(FuseOSError(message[2]))
+            elif kind == 'replayed':
+                self.journal.mark_applied(self.slave_n, message[1])
+                self.journal.release_segments()
+
+        # The slave is gone, do not leave readers and writers waiting
+        # forever; the journal, if any, keeps what it did not apply.
+        with self._pending_lock:
+            self._disconnected = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for command, in_ring in pending:
+            if in_ring:
+                self.ring.release()
+            self._abandon(command)
+
+    def _pop(self, request_id: int) -> SlaveOperationCommands.Command:
+        with self._pending_lock:
+            command, in_ring = self._pending.pop(request_id)
+        if in_ring:
+            self.ring.release()
+        return command
+
+    def _abandon(self, command: SlaveOperationCommands.Command):
+        if not SlaveOperationCommands.is_replicated(command):
+            command.pipeline.fail(FuseOSError(errno.EIO))
+            return
+        self.queue.applied(command)
+        if command.ack is not None and self.acknowledges:
+            command.ack.abandoned()
+
+    def _acknowledge(self, command: SlaveOperationCommands.Command):
+        if self.journal is not None:
+            self.journal.mark_applied(self.slave_n, command.seq)
+        self.queue.applied(command)
+        if command.ack is not None and self.acknowledges:
+            command.ack.applied()
+
+
+class RemoteSlaveQueue(SlaveQueue):
+    """
+    Queue of a slave fed by a master outside its process. Applied commands
+    are acknowledged in batches, in the order they were queued, on the
+    connection they came from.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._send_lock = threading.Lock()
+        # (connection, request id) of the queued replicated commands
+        self._requests = deque()
+        self._acked = []
+        self._acks_sent = threading.Condition()
+
+    def put_request(self, conn, request_id: int, command: SlaveOperationCommands.Command):
+        if SlaveOperationCommands.is_replicated(command):
+            self._requests.append((conn, request_id))
+        self.put(command)
+
+    def applied(self, command: SlaveOperationCommands.Command):
+        # Listed before the lag drops, for drain.
+        if SlaveOperationCommands.is_replicated(command):
+            self._acked.append(self._requests.popleft())
+        super().applied(command)
+
+    def batch_applied(self):
+        with self._acks_sent:
+            if not self._acked:
+                return
+            by_conn = {}
+            for conn, request_id in self._acked:
+                by_conn.setdefault(conn, []).append(request_id)
+            self._acked = []
+            for conn, request_ids in by_conn.items():
+                self.send(conn, ('ack', request_ids))
+            self._acks_sent.notify_all()
+
+    def drain(self):
+        """Waits until every command received is applied and acknowledged."""
+        self.wait_for_lag(max_ops=1)
+        with self._acks_sent:
+            self._acks_sent.wait_for(lambda: not self._acked)
+
+    def send(self, conn, message):
+        with self._send_lock:
+            try:
+                conn.send(message)
+            except OSError:
+                # The master went away; whatever it was waiting for is lost
+                # with it.
+                pass
+
+
+class _RemotePipeline:
+    def __init__(self, conn, request_id: int, queue: RemoteSlaveQueue):
+        self._conn = conn
+        self._request_id = request_id
+        self._queue = queue
+
+    def provide(self, result: 'typing.Any'):
+        self._queue.send(self._conn, ('result', self._request_id, result))
+
+    def fail(self, exception: BaseException):
+        self._queue.send(self._conn, ('error', self._request_id, getattr(exception, 'errno', None) or errno.EIO))
+
+
+def serve_master(conn, slave: ReplicaFSSlave, queue: RemoteSlaveQueue, shm=None):
+    """
+    Feeds the commands received on conn to slave until the master stops or
+    disconnects. shm is the shared memory holding ring payloads, if any.
+    """
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message is None:
+            return
+
+        kind = message[0]
+        if kind == 'journal':
+            # What the slave recorded of another journal says nothing of
+            # what it applied of this one.
+            slave.start_replay(known=slave.watermark is not None and slave.watermark.follow(message[1]))
+            continue
+        if kind == 'replayed':
+            slave._forget_handles()
+            queue.send(conn, message)
+            continue
+
+        _, request_id, name, fields, payload = message
+        command = SlaveOperationCommands.from_data_fields(name, fields)
+        if payload is not None:
+            offset, length = payload
+            command.buf = shm.buf[offset:offset + length]
+
+        if kind == 'replay':
+            # Replayed commands all arrive before the first live one, so
+            # applying them here keeps the order.
+            slave._replay_command(request_id, command)
+            continue
+        if not SlaveOperationCommands.is_replicated(command):
+            command.pipeline = _RemotePipeline(conn, request_id, queue)
+        queue.put_request(conn, request_id, command)
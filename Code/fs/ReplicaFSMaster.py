@@ -1,147 +1,797 @@
-from queue import Queue
-from typing import List
-import copy
+from fuse import FuseOSError
+from typing import List, Optional
+import errno
+import json
 import os
-import time
+import stat
 import threading
+import time
 
-from fs.config import ReplicaFSConfig
+from fs.config import ReplicaFSConfig, REPLICATION_ASYNC, REPLICATION_QUORUM
 from .Base import BaseOperations
+from .BlockCache import BlockCache
+from .Durability import GroupCommitDurability, make_durability
+from .HashRing import HashRing
+from .HedgedRead import HedgedReads
 from . import SlaveOperationCommands
+from .MerkleTree import MerkleTree, state_path_for
+from .MetadataCache import MetadataCache
+from .PathLocks import PathLocks
+from .ReadAhead import ReadAhead, ReadPart, assemble
+from .ReadScheduler import make_read_scheduler
+from .Rebalancer import Rebalancer
+from .RemoteSlave import RemoteSlaveProxy
+from .ReplicationAck import ReplicationAck
+from .ReplicationJournal import ReplicationJournal
+from .ReplicationProtocol import connect
+from .Scrubber import Scrubber
+from .SlaveBootstrap import SlaveBootstrap
+from .SlaveHealth import EVICTED_JOINING, SlaveHealth
+from .SlaveQueue import SlaveQueue
 from .SlaveRequestPipeline import SlaveRequestPipeline
-
-
-SLAVE_TIMEOUT = 3600
+from .StatsFiles import StatsFiles, is_stats_path
+from .WriteCoalescer import WriteCoalescer
 
 
 class ReplicaFSMaster(BaseOperations):
-    _read_repl = 0
-
     def __init__(self,
                  config: ReplicaFSConfig,
-                 queues: List[Queue],
+                 queues: List[SlaveQueue],
                  nbr_slaves: int,
+                 journal: ReplicationJournal = None,
                  ):
         backing_store = os.path.realpath(config.master_backing)
         mount_point = os.path.realpath(
             config.master_mount_point,
         )
-        super().__init__(mount_point, backing_store)
+        metadata_cache = None
+        if config.metadata_cache_entries > 0:
+            metadata_cache = MetadataCache(config.metadata_cache_entries)
+
+        durability = make_durability(config.durability, config.group_commit_ms / 1000)
+        super().__init__(mount_point, backing_store, metadata_cache, durability)
+        self.config = config
         self.queues = queues
         self.nbr_slaves = nbr_slaves
+        self.read_scheduler = make_read_scheduler(config.read_policy, queues)
+        self.health = SlaveHealth(queues, config.slave_timeout, config.hedge_reads)
+        self.health.start()
+        self.hedged_reads = HedgedReads(self)
+        self.hedged_reads.start()
+        self.block_cache = None
+        if config.cache_bytes > 0:
+            self.block_cache = BlockCache(config.cache_bytes, config.cache_block_size)
+        self.journal = journal
+        self.merkle_tree = None
+        self._merkle_refresh = None
+        if config.merkle_path is not None:
+            self.merkle_tree = MerkleTree(backing_store, state_path_for(config.merkle_path, backing_store))
+            # The tree only trusts the per-block invalidations once it has
+            # been refreshed in this process; do that while mounting.
+            self._merkle_refresh = threading.Thread(target=self.merkle_tree.refresh, name='merkle', daemon=True)
+            self._merkle_refresh.start()
+        self.write_coalescer = None
+        if config.coalesce_bytes > 0:
+            self.write_coalescer = WriteCoalescer(config.coalesce_bytes, config.coalesce_ms / 1000)
+        self.read_ahead = ReadAhead(config.readahead_bytes) if config.readahead_bytes > 0 else None
+
+        self._locks = PathLocks()
+        self._coalesce_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._dispatch_lock = threading.Lock()
+        self._bounded_queues = config.queue_max_ops is not None or config.queue_max_bytes is not None
+        # Slaves sent the replicated commands, and those of them that
+        # acknowledge writes (all but the ones still being brought up to
+        # date); replaced, never modified, under the dispatch lock.
+        self._replicated_to = list(range(len(queues)))
+        self._joined = list(range(len(queues)))
+        # Slaves attached while running
+        self._proxies = {}
+        self.bootstraps = {}
+        # With a replication factor, the ring files are placed by and, while
+        # a rebalance moves them, the one they are moving from; reads go to
+        # the ring the files are complete on. Keys are the master's inode
+        # numbers, which a rename keeps.
+        self._rings = None
+        self._read_ring = None
+        # The ring files are being dropped by, whose former owners still
+        # follow the renames and unlinks so that no copy escapes the drop
+        self._dropping = None
+        self._handle_keys = {}
+        self.rebalancer = None
+        if config.replication_factor is not None:
+            self._read_ring = HashRing(range(len(queues)), config.replication_factor)
+            self._rings = (self._read_ring, None)
+        self.stats_files = StatsFiles({
+            'stats': lambda: json.dumps(self.stats(), indent=2).encode() + b'\n',
+            'metrics': lambda: '\n'.join(self.prometheus_metrics()).encode() + b'\n',
+            'control': lambda: ''.join(f'{n} {state}\n' for n, state in enumerate(self.slave_states())).encode(),
+        }, controls={'control': self.control})
+        self.scrubber = None
+        if config.scrub_interval is not None:
+            self.scrubber = Scrubber(
+                self, config.scrub_block_bytes, config.scrub_rate_bytes, config.scrub_workers,
+                interval=config.scrub_interval, timeout=config.slave_timeout,
+            )
+            self.scrubber.start()
+        if self.write_coalescer is not None:
+            threading.Thread(target=self._release_held_writes, name='coalescer', daemon=True).start()
+
+    def __call__(self, op, *args):
+        if is_stats_path(op, args):
+            return self.stats_files(op, *args)
+        return super().__call__(op, *args)
 
     def mkdir(self, path, mode):
-        super().mkdir(path, mode)
+        self._wait_for_room()
+        with self._locks.mutation(path):
+            super().mkdir(path, mode)
+            self._invalidate_tree(path)
 
-        command = SlaveOperationCommands.Mkdir(path, mode)
-        self._notify_slaves(command)
+            command = SlaveOperationCommands.Mkdir(path, mode)
+            self._notify_slaves(command)
+        self._wait_replicated(command)
 
     def create(self, path, mode, fi=None) -> int:
-        ret = super().create(path, mode)
-        if ret == -1:
-            return ret
+        self._wait_for_room()
+        with self._locks.mutation(path):
+            ret = super().create(path, mode)
+            if ret == -1:
+                return ret
+            self._invalidate_tree(path)
+            self._track_handle(ret)
 
-        command = SlaveOperationCommands.Create(path, mode, fi, ret_fd=ret)
-        self._notify_slaves(command)
+            command = SlaveOperationCommands.Create(path, mode, fi, ret_fd=ret)
+            self._notify_slaves(command)
+        self._wait_replicated(command)
         return ret
 
     def open(self, path, flags):
-        ret = super().open(path, flags)
-        if ret == -1:
-            return ret
+        self._wait_for_room()
+        with self._locks.mutation(path):
+            ret = super().open(path, flags)
+            if ret == -1:
+                return ret
+            if flags & os.O_TRUNC:
+                self._invalidate_tree(path)
+                self._invalidate_reads(path)
+            self._track_handle(ret)
 
-        command = SlaveOperationCommands.Open(path, flags, ret_fd=ret)
-        self._notify_slaves(command)
+            command = SlaveOperationCommands.Open(path, flags, ret_fd=ret)
+            self._notify_slaves(command)
+            if flags & os.O_TRUNC and self.block_cache is not None:
+                self.block_cache.truncate(path, 0)
+        self._wait_replicated(command)
         return ret
 
     def write(self, path, buf, offset, fh):
-        ret = super().write(path, buf, offset, fh)
-        if ret == -1:
-            return ret
+        self._wait_for_room(len(buf))
+        with self._locks.mutation(path):
+            ret = super().write(path, buf, offset, fh)
+            if ret == -1:
+                return ret
+            self._invalidate_tree(path, offset, len(buf))
+            self._invalidate_reads(path)
 
-        command = SlaveOperationCommands.Write(path, buf, offset, fh)
-        self._notify_slaves(command)
+            command = SlaveOperationCommands.Write(path, buf, offset, fh)
+            if self.write_coalescer is None:
+                self._notify_slaves(command)
+                dispatched = [command]
+            else:
+                with self._coalesce_lock:
+                    dispatched = self.write_coalescer.add(command)
+                    for ready in dispatched:
+                        self._dispatch(ready)
+            # Only once the write is queued (or held by the coalescer, which
+            # a miss flushes first): a miss fetched under the new generation
+            # then reaches the slaves after it.
+            if self.block_cache is not None:
+                self.block_cache.invalidate(path, offset, len(buf))
+        self._wait_replicated(*dispatched)
         return ret
 
     def truncate(self, path, length, fh=None):
-        super().truncate(path, length, fh)
-        command = SlaveOperationCommands.Truncate(path, length, fh)
-        self._notify_slaves(command)
+        self._wait_for_room()
+        with self._locks.mutation(path):
+            super().truncate(path, length, fh)
+            self._invalidate_tree(path)
+            self._invalidate_reads(path)
+            command = SlaveOperationCommands.Truncate(path, length, fh)
+            self._notify_slaves(command, None if fh is not None else self._path_key(path))
+            if self.block_cache is not None:
+                self.block_cache.truncate(path, length)
+        self._wait_replicated(command)
 
-    def release(self, path, fh):
-        ret = super().release(path, fh)
-        if ret != 0:
-            return ret
+    def flush(self, path, fh):
+        self._flush_writes()
+        return super().flush(path, fh)
+
+    def fsync(self, path, fdatasync, fh):
+        self._flush_writes()
+        return super().fsync(path, fdatasync, fh)
 
-        command = SlaveOperationCommands.Release(path, fh)
-        self._notify_slaves(command)
+    def release(self, path, fh):
+        with self._locks.mutation(path):
+            # Replicate before closing: once fh is closed the number can be
+            # handed out by a concurrent open, whose Open must reach the
+            # slaves after this Release.
+            if self.read_ahead is not None:
+                self.read_ahead.forget(path, fh)
+            command = SlaveOperationCommands.Release(path, fh)
+            self._notify_slaves(command)
+            self._handle_keys.pop(fh, None)
+            ret = super().release(path, fh)
+        self._wait_replicated(command)
         return ret
 
     def rename(self, old, new):
-        super().rename(old, new)
-        command = SlaveOperationCommands.Rename(old, new)
-        self._notify_slaves(command)
+        self._wait_for_room()
+        with self._locks.exclusive():
+            key = self._path_key(old)
+            replaced = self._path_key(new)
+            super().rename(old, new)
+            if self.merkle_tree is not None:
+                self.merkle_tree.rename(old, new)
+            self._invalidate_reads(old)
+            self._invalidate_reads(new)
+            dispatched = []
+            if replaced is not None:
+                # Its owners are not all among those of old.
+                dispatched.append(SlaveOperationCommands.Unlink(new))
+                self._notify_slaves(dispatched[-1], replaced)
+            dispatched.append(SlaveOperationCommands.Rename(old, new))
+            self._notify_slaves(dispatched[-1], key)
+            if self.block_cache is not None:
+                self.block_cache.invalidate_path(old)
+                self.block_cache.invalidate_path(new)
+            for bootstrap in list(self.bootstraps.values()):
+                bootstrap.renamed(new)
+            if self.rebalancer is not None:
+                self.rebalancer.renamed(new)
+        self._wait_replicated(*dispatched)
 
     def rmdir(self, path):
-        ret = super().rmdir(path)
-        if ret:
-            return ret
-        command = SlaveOperationCommands.Rmdir(path)
-        self._notify_slaves(command)
+        self._wait_for_room()
+        with self._locks.exclusive():
+            ret = super().rmdir(path)
+            if ret:
+                return ret
+            command = SlaveOperationCommands.Rmdir(path)
+            self._notify_slaves(command)
+        self._wait_replicated(command)
         return ret
 
     def unlink(self, path):
-        ret = super().unlink(path)
-        if ret:
-            return ret
-        command = SlaveOperationCommands.Unlink(path)
-        self._notify_slaves(command)
+        self._wait_for_room()
+        with self._locks.mutation(path):
+            key = self._path_key(path)
+            ret = super().unlink(path)
+            if ret:
+                return ret
+            self._invalidate_reads(path)
+            command = SlaveOperationCommands.Unlink(path)
+            self._notify_slaves(command, key)
+            if self.block_cache is not None:
+                self.block_cache.invalidate_path(path)
+        self._wait_replicated(command)
         return ret
 
     def chmod(self, path, mode):
-        ret = super().chmod(path, mode)
-        if ret:
-            return ret
-        command = SlaveOperationCommands.Chmod(path, mode)
-        self._notify_slaves(command)
+        self._wait_for_room()
+        with self._locks.mutation(path):
+            ret = super().chmod(path, mode)
+            if ret:
+                return ret
+            command = SlaveOperationCommands.Chmod(path, mode)
+            self._notify_slaves(command, self._path_key(path))
+        self._wait_replicated(command)
         return ret
 
+    def destroy(self, path):
+        # Persist the hash tree on unmount; the blocks invalidated since the
+        # last refresh are the only ones that need rehashing.
+        self._stopped.set()
+        self._flush_writes()
+        self.health.stop()
+        self.hedged_reads.stop()
+        for bootstrap in list(self.bootstraps.values()):
+            bootstrap.stop()
+        if self.rebalancer is not None:
+            self.rebalancer.stop()
+        if self.scrubber is not None:
+            self.scrubber.stop()
+        if self.merkle_tree is not None:
+            self._merkle_refresh.join()
+            self.merkle_tree.refresh()
+            self.merkle_tree.save()
+
     def read(self, path, length, offset, fh):
-        command = SlaveOperationCommands.Read(path, length, offset, fh)
-        return self._request_from_next_slave(command)
+        if self.block_cache is not None:
+            return self.block_cache.read(
+                path, length, offset, lambda start, size: self._fetch_blocks(path, size, start, fh),
+            )
+        self._flush_writes()
+        return self._read_from_slave(path, length, offset, fh)
+
+    def _fetch_blocks(self, path, length, offset, fh):
+        # Called by the block cache after it has taken its generation, so
+        # the coalesced writes invalidated before are flushed ahead of the
+        # reads.
+        self._flush_writes()
+        return self._read_from_slave(path, length, offset, fh, self.block_cache.block_size)
+
+    def _read_from_slave(self, path, length, offset, fh, block_size=None):
+        if self.read_ahead is not None:
+            data = self.read_ahead.read(
+                path, fh, length, offset,
+                lambda start, size: self._submit_read(path, size, start, fh),
+                lambda start, size, register: self._prefetch(path, size, start, fh, register),
+            )
+            return data if block_size is None else _split_blocks(data, length, block_size)
+
+        parts = self._submit_read(path, length, offset, fh, block_size)
+        if block_size is None:
+            return assemble(parts, offset, length)
 
-    def _request_from_next_slave(self, command: SlaveOperationCommands.Command):
-        n = self._read_repl
+        blocks = []
+        for part in parts:
+            part_blocks = part.pipeline.get()
+            blocks.extend(part_blocks)
+            if sum(len(block) for block in part_blocks) < part.length:
+                break
+        return blocks
 
-        self._read_repl += 1
-        if self._read_repl >= self.nbr_slaves:
-            self._read_repl = 0
+    def _submit_read(self, path, length, offset, fh, block_size=None) -> List[ReadPart]:
+        # Large reads are cut into stripes served by several slaves at once.
+        stripe = self.config.stripe_bytes
+        if block_size is not None:
+            stripe = max(stripe // block_size, 1) * block_size
+        if not self.config.stripe_threshold or length < self.config.stripe_threshold or self.nbr_slaves < 2:
+            stripe = max(length, 1)
 
+        parts = []
+        for start in range(offset, offset + max(length, 1), stripe):
+            size = min(stripe, offset + length - start)
+            command = SlaveOperationCommands.Read(path, size, start, fh, block_size)
+            parts.append(ReadPart(start, size, self._submit_to_next_slave(command)))
+        return parts
+
+    def _prefetch(self, path, length, offset, fh, register):
+        # Under the path lock, the prefetched reads are queued either before
+        # a write's invalidation or after the write itself.
+        with self._locks.mutation(path):
+            self._flush_writes()
+            register(self._submit_read(path, length, offset, fh))
+
+    def _submit_to_next_slave(self, command: SlaveOperationCommands.Read) -> SlaveRequestPipeline:
+        candidates = self._read_candidates(command)
+        if not candidates:
+            return self._read_locally(command)
+        return self.hedged_reads.submit(command, self.read_scheduler.choose(candidates))
+
+    def _read_candidates(self, command: SlaveOperationCommands.Read) -> List[int]:
+        # The healthy slaves holding the file
+        if self._read_ring is None:
+            return self.health.healthy()
+        key = self._handle_keys.get(command.fh)
+        return self.readers(self._path_key(command.path) if key is None else key)
+
+    def readers(self, key: Optional[int]) -> List[int]:
+        """The healthy slaves a file with key can be read from."""
+        healthy = self.health.healthy()
+        ring = self._read_ring
+        if ring is None:
+            return healthy
+        if key is None:
+            return []
+        owners = ring.owners(key)
+        return [n for n in healthy if n in owners]
+
+    def _read_done(self, n: int, exception: Optional[BaseException], elapsed: float):
+        self.read_scheduler.finished(n, elapsed)
+        if exception is None:
+            self.health.succeeded(n, elapsed)
+        else:
+            self.health.failed(n, exception)
+
+    def _read_locally(self, command: SlaveOperationCommands.Read) -> SlaveRequestPipeline:
+        # No slave is fit to answer; the master's own copy is as recent as
+        # any of theirs.
+        self.health.note_local()
         pipeline = SlaveRequestPipeline()
-        command.pipeline = pipeline
-        self.queues[n].put(command)
-
-        result = None
-        while result is None:
-            result = pipeline.get()
-            time.sleep(0.1)
-
-        return result
-
-    def _notify_slaves(self, command: SlaveOperationCommands.Command):
-        condition = threading.Condition()
-
-        with condition:
-            events = []
-            for n in range(self.nbr_slaves):
-                command = copy.copy(command)
-                command.condition = condition
-                event = threading.Event()
-                command.event = event
-                events.append(event)
-                command.slave_i = n
+        try:
+            if command.block_size is None:
+                pipeline.provide(super().read(command.path, command.length, command.offset, command.fh))
+            else:
+                sizes = [command.block_size] * ((command.length + command.block_size - 1) // command.block_size)
+                pipeline.provide(self.read_blocks(command.path, sizes, command.offset, command.fh))
+        except Exception as e:
+            pipeline.fail(e)
+        return pipeline
+
+    def control(self, line: str):
+        """Runs one line written to the control file."""
+        words = line.split()
+        if len(words) == 2 and words[0] == 'attach':
+            self.attach_slave(words[1])
+        elif len(words) == 2 and words[0] == 'detach' and words[1].isdigit():
+            self.detach_slave(int(words[1]))
+        else:
+            raise ValueError(f'Unknown control command {line!r}')
+
+    def attach_slave(self, address: str) -> int:
+        """
+        Adds the slave daemon at address, which should start from an empty
+        backing store. It is sent every replicated command from now on and
+        joins the others once a copy of the tree has reached it.
+        """
+        if self._rebalancing():
+            raise OSError(errno.EBUSY, 'A rebalance is running')
+        conn = connect(address, self.config.remote_secret)
+        queue = SlaveQueue(self.config.queue_max_ops, self.config.queue_max_bytes)
+        with self._dispatch_lock:
+            n = len(self.queues)
+            self.queues.append(queue)
+            self.read_scheduler.add_slave()
+            self.health.add_slave()
+            if self.scrubber is not None:
+                self.scrubber.add_slave()
+            if self.journal is not None:
+                self.journal.add_slave()
+            proxy = RemoteSlaveProxy(n, queue, conn, journal=self.journal, acknowledges=False)
+            proxy.start()
+            self._proxies[n] = proxy
+            self._replicated_to = self._replicated_to + [n]
+            if self._rings is None:
+                copy = self.bootstraps[n] = SlaveBootstrap(self, n, proxy)
+            else:
+                # It takes over the files next to its points on the ring.
+                ring = self._rings[0]
+                copy = self._start_rebalance(ring, ring.with_slave(n), [n])
+        copy.start()
+        return n
+
+    def detach_slave(self, n: int):
+        """
+        Stops replicating to slave n; it applies what it was already sent
+        and stops.
+        """
+        with self._dispatch_lock:
+            if n not in self._replicated_to:
+                raise ValueError(f'Slave {n} is not attached')
+            self._replicated_to = [m for m in self._replicated_to if m != n]
+            self._joined = [m for m in self._joined if m != n]
+            self.nbr_slaves = len(self._joined)
+            self.health.detach(n)
+            if self.journal is not None:
+                self.journal.remove_slave(n)
+            self.queues[n].put(None)
+        bootstrap = self.bootstraps.get(n)
+        if bootstrap is not None:
+            bootstrap.stop()
+        if self._rings is None:
+            return
+
+        rebalancer = self.rebalancer
+        if rebalancer is not None and rebalancer.running():
+            # Started again from wherever the files are complete
+            rebalancer.stop()
+            self._end_rebalance(rebalancer)
+            # The slaves it was bringing in go with it.
+            for m in rebalancer.joining:
+                if m != n and m in self._replicated_to and m not in self._rings[0].slaves:
+                    self.detach_slave(m)
+        with self._dispatch_lock:
+            ring = self._rings[0]
+            if n not in ring.slaves:
+                return
+            # The copies of its files left on the others are spread to more.
+            copy = self._start_rebalance(ring, ring.without_slave(n), [])
+        copy.start()
+
+    def _rebalancing(self) -> bool:
+        return self.rebalancer is not None and self.rebalancer.running()
+
+    def _start_rebalance(self, previous: HashRing, ring: HashRing, joining: List[int]) -> Rebalancer:
+        # Called under the dispatch lock; the master places files by both
+        # rings and reads them by previous until the copy is done.
+        self.rebalancer = Rebalancer(self, previous, ring, joining)
+        self._rings = (ring, previous)
+        self._read_ring = previous
+        return self.rebalancer
+
+    def _finish_rebalance(self, rebalancer: Rebalancer) -> bool:
+        # Writers wait while the new owners apply the little they lag by;
+        # files are then read from and placed on them only, so nothing
+        # reaches the former owners after the rebalance drops their copies.
+        with self._dispatch_lock:
+            if not self._placing(rebalancer):
+                return False
+            for n in rebalancer.ring.slaves:
+                if n in self._replicated_to and \
+                        not self.queues[n].wait_for_lag(max_ops=1, timeout=self.config.slave_timeout):
+                    return False
+            self._rings = (rebalancer.ring, None)
+            self._read_ring = rebalancer.ring
+            self._dropping = rebalancer.previous
+            joining = [n for n in rebalancer.joining if n in self._replicated_to]
+            for n in joining:
+                self._proxies[n].acknowledges = True
+            self._joined = self._joined + joining
+            self.nbr_slaves = len(self._joined)
+        for n in joining:
+            self.health.admit(n)
+        return True
+
+    def _placing(self, rebalancer: Rebalancer) -> bool:
+        # Whether the rebalance is still the one files are placed by
+        ring, previous = self._rings
+        return ring is rebalancer.ring and previous is rebalancer.previous
+
+    def _end_rebalance(self, rebalancer: Rebalancer):
+        # Files stay placed by the ring they are complete on.
+        with self._dispatch_lock:
+            if self._placing(rebalancer):
+                self._rings = (rebalancer.previous, None)
+                self._read_ring = rebalancer.previous
+            if self._dropping is rebalancer.previous:
+                self._dropping = None
+
+    def _join_slave(self, n: int) -> bool:
+        # Writers wait while the slave applies the little it lags by.
+        with self._dispatch_lock:
+            if n not in self._replicated_to:
+                return False
+            if not self.queues[n].wait_for_lag(max_ops=1, timeout=self.config.slave_timeout):
+                return False
+            self._proxies[n].acknowledges = True
+            self._joined = self._joined + [n]
+            self.nbr_slaves = len(self._joined)
+        self.health.admit(n)
+        return True
+
+    def slave_states(self) -> List[str]:
+        states = []
+        for n, health in enumerate(self.health.stats()):
+            if health['evicted'] is None:
+                states.append('healthy')
+            elif n in self.bootstraps and health['evicted'] == EVICTED_JOINING:
+                states.append(f'joining ({self.bootstraps[n].state})')
+            elif self.rebalancer is not None and n in self.rebalancer.joining and health['evicted'] == EVICTED_JOINING:
+                states.append(f'joining ({self.rebalancer.state})')
+            else:
+                states.append(health['evicted'])
+        return states
+
+    def replication_lag(self) -> List[dict]:
+        return [queue.lag() for queue in self.queues]
+
+    def read_distribution(self) -> List[dict]:
+        return self.read_scheduler.stats()
+
+    def cache_stats(self) -> dict:
+        if self.block_cache is None:
+            return {}
+        return self.block_cache.stats()
+
+    def metadata_cache_stats(self) -> dict:
+        if self.metadata_cache is None:
+            return {}
+        return self.metadata_cache.stats()
+
+    def readahead_stats(self) -> dict:
+        if self.read_ahead is None:
+            return {}
+        return self.read_ahead.stats()
+
+    def coalescing_stats(self) -> dict:
+        if self.write_coalescer is None:
+            return {'merged': 0, 'dispatched': 0}
+        return self.write_coalescer.stats()
+
+    def scrub_stats(self) -> dict:
+        if self.scrubber is None:
+            return {}
+        return self.scrubber.stats()
+
+    def slave_stats(self) -> List[dict]:
+        return [
+            dict(reads, lag_ops=lag['ops'], lag_bytes=lag['bytes'], **queue.occupancy(), **health)
+            for reads, lag, queue, health in zip(
+                self.read_distribution(), self.replication_lag(), self.queues, self.health.stats(),
+            )
+        ]
+
+    def stats(self) -> dict:
+        return {
+            'operations': self.metrics.stats(),
+            'slaves': self.slave_stats(),
+            'reads': self.health.read_stats(),
+            'block_cache': self.cache_stats(),
+            'metadata_cache': self.metadata_cache_stats(),
+            'readahead': self.readahead_stats(),
+            'coalescing': self.coalescing_stats(),
+            'group_commit': self.durability.stats() if isinstance(self.durability, GroupCommitDurability) else {},
+            'scrub': self.scrub_stats(),
+            'bootstrap': {n: bootstrap.stats() for n, bootstrap in self.bootstraps.items()},
+            'rebalance': self.rebalancer.stats() if self.rebalancer is not None else {},
+        }
+
+    def prometheus_metrics(self) -> List[str]:
+        lines = self.metrics.prometheus('replicafs_operation')
+        gauges = [
+            ('queue_depth', 'gauge', 'Commands queued to the slave.'),
+            ('lag_ops', 'gauge', 'Replicated operations not yet applied by the slave.'),
+            ('lag_bytes', 'gauge', 'Payload bytes not yet applied by the slave.'),
+            ('peak_bytes', 'gauge', 'Most payload bytes the slave has lagged by.'),
+            ('full_waits', 'counter', 'Operations that waited for room in the slave\'s queue.'),
+            ('full_timeouts', 'counter', 'Operations failed with EAGAIN for lack of room in the slave\'s queue.'),
+            ('outstanding', 'gauge', 'Reads in flight on the slave.'),
+            ('served', 'counter', 'Reads served by the slave.'),
+            ('healthy', 'gauge', '1 while the slave serves reads, 0 once evicted.'),
+            ('evictions', 'counter', 'Times the slave was evicted from the read rotation.'),
+        ]
+        slaves = self.slave_stats()
+        for key, kind, description in gauges:
+            name = f'replicafs_slave_{key}' + ('_total' if kind == 'counter' else '')
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{name}{{slave="{n}"}} {int(slave[key])}' for n, slave in enumerate(slaves))
+
+        if self.scrubber is not None:
+            scrub = self.scrubber.stats()
+            counters = [
+                ('mismatched_blocks', 'Blocks found to differ from the master.'),
+                ('repaired_blocks', 'Blocks rewritten from the master.'),
+                ('missing_files', 'Files found missing on the slave.'),
+            ]
+            for key, description in counters:
+                name = f'replicafs_scrub_{key}_total'
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} counter')
+                lines.extend(f'{name}{{slave="{n}"}} {value}' for n, value in enumerate(scrub[key]))
+            lines.append('# HELP replicafs_scrub_progress Fraction of the current scrub pass done.')
+            lines.append('# TYPE replicafs_scrub_progress gauge')
+            lines.append(f'replicafs_scrub_progress {scrub["progress"]}')
+        return lines
+
+    def _invalidate_tree(self, path, offset=None, length=None):
+        if self.merkle_tree is not None:
+            self.merkle_tree.invalidate(path, offset, length)
+
+    def _invalidate_reads(self, path):
+        if self.read_ahead is not None:
+            self.read_ahead.invalidate(path)
+
+    def _flush_writes(self):
+        if self.write_coalescer is None:
+            return
+        # Coalescing is for async replication only, so nothing waits for
+        # the writes once they are queued.
+        with self._coalesce_lock:
+            for ready in self.write_coalescer.flush():
+                self._dispatch(ready)
+
+    def _release_held_writes(self):
+        # Without a barrier a held write would otherwise stay off the slave
+        # mounts for as long as its handle is open.
+        while not self._stopped.wait(self.write_coalescer.max_delay / 2):
+            with self._coalesce_lock:
+                for ready in self.write_coalescer.expired():
+                    self._dispatch(ready)
+
+    def _wait_for_room(self, nbytes: int = 0):
+        # Before the operation changes the master (and takes its path
+        # locks), so one that cannot be handed to the slaves in time fails
+        # having changed nothing, and a lagging slave holds back writers
+        # without blocking the others on their paths.
+        if self.config.replication_mode == REPLICATION_ASYNC:
+            # A slave being brought up to date lags by its copy, which is
+            # no reason to hold writers back.
+            for n in self._joined:
+                self.queues[n].wait_for_lag(self.config.max_lag_ops, self.config.max_lag_bytes)
+        if not self._bounded_queues:
+            return
+        deadline = None if self.config.queue_timeout is None else time.monotonic() + self.config.queue_timeout
+        for n in self._replicated_to:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not self.queues[n].wait_for_room(nbytes, timeout):
+                raise FuseOSError(errno.EAGAIN)
+
+    def _required_acks(self, targets: List[int]) -> int:
+        if self.config.replication_mode == REPLICATION_ASYNC:
+            return 0
+        acknowledging = self._acknowledging(targets)
+        if self.config.replication_mode == REPLICATION_QUORUM:
+            return min(self.config.write_quorum, acknowledging)
+        return acknowledging
+
+    def _acknowledging(self, targets: List[int]) -> int:
+        return self.nbr_slaves if self._rings is None else sum(1 for n in targets if n in self._joined)
+
+    def _track_handle(self, fh: int):
+        if self._rings is not None:
+            self._handle_keys[fh] = os.fstat(fh).st_ino
+
+    def _path_key(self, path: str) -> Optional[int]:
+        # The key of a regular file; None for anything else, which every
+        # slave holds.
+        if self._rings is None:
+            return None
+        try:
+            attrs = os.lstat(self._get_real_path(path))
+        except FileNotFoundError:
+            return None
+        return attrs.st_ino if stat.S_ISREG(attrs.st_mode) else None
+
+    def _targets(self, command: SlaveOperationCommands.Command, key: Optional[int]) -> List[int]:
+        # Called under the dispatch lock.
+        rings = self._rings
+        if rings is None:
+            return self._replicated_to
+        if key is None:
+            fh = getattr(command, 'fh', None)
+            if fh is None:
+                fh = getattr(command, 'ret_fd', None)
+            key = self._handle_keys.get(fh)
+            if key is None:
+                return self._replicated_to
+        # A file being moved gets its commands on both sides.
+        if self._dropping is not None and isinstance(command, (SlaveOperationCommands.Rename,
+                                                                SlaveOperationCommands.Unlink)):
+            rings = rings + (self._dropping,)
+        owners = set().union(*(ring.owners(key) for ring in rings if ring is not None))
+        return [n for n in self._replicated_to if n in owners]
+
+    def _notify_slaves(self, command: SlaveOperationCommands.Command, key: Optional[int] = None):
+        # Every other operation is a barrier for held back writes.
+        self._flush_writes()
+        self._dispatch(command, key)
+
+    def _replicate(self, command: SlaveOperationCommands.Command, key: Optional[int] = None):
+        """
+        Sends command to the slaves and waits for it to be replicated, for
+        callers that hold no path lock.
+        """
+        self._dispatch(command, key)
+        self._wait_replicated(command)
+
+    def _dispatch(self, command: SlaveOperationCommands.Command, key: Optional[int] = None):
+        """
+        Journals command and queues it to the slaves, those owning the file
+        with key when a replication factor places files (key defaults to
+        that of the file the command's handle is open on). Called under the
+        path locks, so the queues see the commands in the order they
+        changed the master; waiting is left to _wait_replicated.
+        """
+        # Journal order and queue order must agree across threads, and the
+        # acks waited for with the slaves the command is sent to.
+        with self._dispatch_lock:
+            targets = self._targets(command, key)
+            required = self._required_acks(targets)
+            # The same command object goes to every slave; async writers do
+            # not wait, so they need no ack at all.
+            command.ack = ReplicationAck(required, self._acknowledging(targets)) if required else None
+            if self.journal is not None:
+                command.seq = self.journal.append(command)
+            for n in targets:
                 self.queues[n].put(command)
 
-            while any(map(lambda e: not e.is_set(), events)):
-                condition.wait(0.1)
+    def _wait_replicated(self, *commands: SlaveOperationCommands.Command):
+        # After the path locks are released: a slow disk or slave delays
+        # the caller, not every other operation on the path (or, for
+        # rename and rmdir, on the whole mount).
+        for command in commands:
+            if self.journal is not None:
+                self.journal.wait_durable(command.seq)
+            if command.ack is not None and not command.ack.wait(self.config.ack_timeout):
+                # The master's backing store has the change, too few slaves do.
+                raise FuseOSError(errno.EIO)
+
 
+def _split_blocks(data: bytes, length: int, block_size: int) -> List[bytes]:
+    blocks = [data[i:i + block_size] for i in range(0, len(data), block_size)]
+    # A short (or empty) last block marks the end of the file.
+    if len(data) < length and len(data) % block_size == 0:
+        blocks.append(b'')
+    return blocks
@@ -1,14 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
 from fuse import FuseOSError
-from queue import Queue
+from queue import Empty
 import errno
 import logging
 import os
 import threading
-import time
 
 from fs.config import ReplicaFSConfig
 from .Base import BaseOperations
 from . import SlaveOperationCommands
+from .CommandCompactor import CommandCompactor, Compacted
+from .Durability import make_durability
+from .MetadataCache import MetadataCache
+from .ReplicationJournal import ReplicationJournal
+from .Scrubber import block_digests
+from .SlaveQueue import SlaveQueue
+from .Watermark import Watermark
 
 
 class ReplicaFSSlave(BaseOperations):
@@ -16,13 +23,13 @@ class ReplicaFSSlave(BaseOperations):
         os.O_RDWR, os.O_WRONLY,
     ]
 
-    fd_map = {}
-
     def __init__(self,
                  config: ReplicaFSConfig,
-                 queue: Queue,
+                 queue: SlaveQueue,
                  slave_n: int,
                  logger: logging.Logger,
+                 journal: ReplicationJournal = None,
+                 watermark: Watermark = None,
                  ):
         backing_store = os.path.realpath(
             config.slave_backings[slave_n],
@@ -31,11 +38,44 @@ class ReplicaFSSlave(BaseOperations):
             config.slave_mount_points[slave_n],
         )
 
-        super().__init__(mount_point, backing_store)
+        metadata_cache = None
+        if config.metadata_cache_entries > 0:
+            metadata_cache = MetadataCache(config.metadata_cache_entries)
+
+        durability = make_durability(config.slave_durability, config.group_commit_ms / 1000)
+        super().__init__(mount_point, backing_store, metadata_cache, durability)
 
         self.slave_n = slave_n
+        # Master file handle -> this slave's file handle
+        self.fd_map = {}
+        # Handles released by the master, synced and closed together after
+        # the batch of commands they were released in.
+        self._released = []
+        # This slave's handles -> pooled reads in flight through them; a
+        # released handle one of them still uses is closed by the last.
+        self._reads_in_flight = {}
+        self._closing = set()
+        self._fd_lock = threading.Lock()
         self.queue = queue
         self.logger = logger
+        self.journal = journal
+        # What this slave applied of the master's journal, when it is not in
+        # the master's process and the journal's own record lags behind
+        self.watermark = watermark
+        # Commands applied by the current replay, and whether the ones
+        # applied before it are known
+        self._replayed = 0
+        self._replay_known = True
+        self.compactor = None
+        if config.slave_compaction:
+            self.compactor = CommandCompactor(lambda path: os.path.lexists(self._get_real_path(path)))
+        # Reads are independent of each other once every command queued
+        # before them has been applied, so they may run concurrently.
+        self._read_pool = None
+        if config.threaded:
+            self._read_pool = ThreadPoolExecutor(
+                max_workers=config.slave_read_threads, thread_name_prefix=f'slave-{slave_n}-read',
+            )
         self._make_run_loop()
 
     def mkdir(self, path, mode):
@@ -72,12 +112,20 @@ class ReplicaFSSlave(BaseOperations):
     def _repl_mkdir(self, path, mode):
         super().mkdir(path, mode)
 
+    def _map_fd(self, fd, slave_fd):
+        with self._fd_lock:
+            self.fd_map[fd] = slave_fd
+
+    def _slave_fd(self, fd):
+        with self._fd_lock:
+            return self.fd_map.get(fd)
+
     def _repl_open(self, path, flags, fd):
         ret = super().open(path, flags)
         if ret < 0:
             return ret
 
-        self.fd_map[fd] = ret
+        self._map_fd(fd, ret)
         return ret
 
     def _repl_create(self, path, mode, fd, fi=None):
@@ -85,21 +133,66 @@ class ReplicaFSSlave(BaseOperations):
         if ret < 0:
             return ret
 
-        self.fd_map[fd] = ret
-        return super().create(path, mode, fi)
+        self._map_fd(fd, ret)
+        return ret
 
     def _repl_write(self, path, buf, offset, fd):
-        return super().write(path, buf, offset, None if fd is None else self.fd_map[fd])
+        slave_fd = self._slave_fd(fd)
+        if slave_fd is None:
+            # The handle was opened before this slave started following the
+            # master (e.g. during journal replay), or there is none (repairs
+            # from the scrubber), go through the path.
+            fh = super().open(path, os.O_WRONLY)
+            try:
+                return super().write(path, buf, offset, fh)
+            finally:
+                super().release(path, fh)
+
+        return super().write(path, buf, offset, slave_fd)
 
     def _repl_truncate(self, path, length, fh=None):
-        super().truncate(path, length, None if fh is None else self.fd_map[fh])
+        super().truncate(path, length, self._slave_fd(fh))
 
     def _repl_release(self, path, fh):
-        ret = super().release(path, None if fh is None else self.fd_map[fh])
-        if not ret:
-            return ret
-        del self.fd_map[fh]
-        return ret
+        with self._fd_lock:
+            slave_fd = self.fd_map.pop(fh, None)
+            if slave_fd is not None:
+                self._released.append(slave_fd)
+
+    def _close_released(self):
+        with self._fd_lock:
+            released = [fh for fh in self._released if fh not in self._reads_in_flight]
+            self._closing.update(fh for fh in self._released if fh in self._reads_in_flight)
+            self._released = []
+        self._close_handles(released)
+
+    def _close_handles(self, handles):
+        try:
+            self._sync_handles(handles)
+        except OSError:
+            self.logger.exception(f'[Slave {self.slave_n}] Failed to sync released handles')
+        for fh in handles:
+            super().release(None, fh)
+
+    def _pin_fd(self, fd):
+        # Taken in queue order, so that a Release queued after the read
+        # cannot close the handle under it.
+        with self._fd_lock:
+            slave_fd = self.fd_map.get(fd)
+            if slave_fd is not None:
+                self._reads_in_flight[slave_fd] = self._reads_in_flight.get(slave_fd, 0) + 1
+            return slave_fd
+
+    def _unpin_fd(self, slave_fd):
+        with self._fd_lock:
+            self._reads_in_flight[slave_fd] -= 1
+            if self._reads_in_flight[slave_fd] > 0:
+                return
+            del self._reads_in_flight[slave_fd]
+            if slave_fd not in self._closing:
+                return
+            self._closing.remove(slave_fd)
+        self._close_handles([slave_fd])
 
     def _repl_rename(self, old, new):
         super().rename(old, new)
@@ -113,14 +206,95 @@ class ReplicaFSSlave(BaseOperations):
     def _repl_chmod(self, path, mode):
         return super().chmod(path, mode)
 
-    def _distrib_read(self, path, length, offset, fh, pipeline):
+    def _distrib_read(self, path, length, offset, slave_fd, pipeline, block_size=None):
         self.logger.debug(f'[Slave {self.slave_n}] Reading from {path}')
-        data = super().read(path, length, offset, None if fh is None else self.fd_map[fh])
+        try:
+            opened = slave_fd is None
+            if opened:
+                # The handle was opened before this slave was attached.
+                slave_fd = super().open(path, os.O_RDONLY)
+            try:
+                if block_size is None:
+                    data = super().read(path, length, offset, slave_fd)
+                else:
+                    sizes = [block_size] * ((length + block_size - 1) // block_size)
+                    data = self.read_blocks(path, sizes, offset, slave_fd)
+            finally:
+                if opened:
+                    super().release(path, slave_fd)
+        except Exception as e:
+            pipeline.fail(e)
+            raise
         pipeline.provide(data)
 
+    def _pooled_read(self, command: SlaveOperationCommands.Read, slave_fd):
+        try:
+            self._distrib_read(
+                command.path, command.length, command.offset, slave_fd, command.pipeline, command.block_size,
+            )
+        except Exception:
+            self.logger.exception(f'[Slave {self.slave_n}] Failed to apply Read')
+        finally:
+            if slave_fd is not None:
+                self._unpin_fd(slave_fd)
+
+    def _checksum(self, path, length, offset, block_size, pipeline):
+        # The blocks are read here, in queue order, so they are those of the
+        # commands queued before; only the hashing may run concurrently.
+        try:
+            fh = super().open(path, os.O_RDONLY)
+            try:
+                sizes = [block_size] * ((length + block_size - 1) // block_size)
+                blocks = super().read_blocks(path, sizes, offset, fh)
+            finally:
+                super().release(path, fh)
+        except Exception as e:
+            pipeline.fail(e)
+            raise
+        if self._read_pool is not None:
+            self._read_pool.submit(lambda: pipeline.provide(block_digests(blocks)))
+        else:
+            pipeline.provide(block_digests(blocks))
+
     def _execute_command(
             self,
             command: SlaveOperationCommands.Command,
+    ):
+        if type(command) == Compacted:
+            return self._execute_compacted(command)
+
+        try:
+            self._dispatch_command(command)
+        except Exception:
+            self.logger.exception(f'[Slave {self.slave_n}] Failed to apply {type(command).__name__}')
+
+        if SlaveOperationCommands.is_replicated(command):
+            self._mark_applied(command)
+
+    def _execute_compacted(self, compacted: Compacted):
+        if compacted.command is not None:
+            try:
+                self._dispatch_command(compacted.command)
+            except Exception as e:
+                # An unlink of a name a rename may not have replaced
+                if not (compacted.quiet and isinstance(e, FileNotFoundError)):
+                    self.logger.exception(f'[Slave {self.slave_n}] Failed to apply {type(compacted.command).__name__}')
+
+        for command in compacted.replaces:
+            self._mark_applied(command)
+
+    def _mark_applied(self, command: SlaveOperationCommands.Command):
+        if self.journal is not None:
+            self.journal.mark_applied(self.slave_n, command.seq)
+        if self.watermark is not None:
+            self.watermark.mark(command.seq)
+        self.queue.applied(command)
+        if command.ack is not None:
+            command.ack.applied()
+
+    def _dispatch_command(
+            self,
+            command: SlaveOperationCommands.Command,
     ):
         if type(command) == SlaveOperationCommands.Mkdir:
             command: SlaveOperationCommands.Mkdir
@@ -154,22 +328,108 @@ class ReplicaFSSlave(BaseOperations):
             self._repl_chmod(command.path, command.mode)
         elif type(command) == SlaveOperationCommands.Read:
             command: SlaveOperationCommands.Read
-            self._distrib_read(command.path, command.length, command.offset, command.fh, command.pipeline)
-            return
+            if self._read_pool is not None:
+                self._read_pool.submit(self._pooled_read, command, self._pin_fd(command.fh))
+            else:
+                self._distrib_read(
+                    command.path, command.length, command.offset, self._slave_fd(command.fh), command.pipeline,
+                    command.block_size,
+                )
+        elif type(command) == SlaveOperationCommands.Checksum:
+            command: SlaveOperationCommands.Checksum
+            self._checksum(command.path, command.length, command.offset, command.block_size, command.pipeline)
+        elif type(command) == SlaveOperationCommands.Ping:
+            command.pipeline.provide(b'')
         else:
             raise TypeError(f'Invalid command type {type(command)}')
-        command.event.set()
-
-        with command.condition:
-            command.condition.notify()
 
     def _make_run_loop(self):
-        self.run_loop_thread = threading.Thread(target=self._run_loop)
+        self.run_loop_thread = threading.Thread(target=self._run_loop, daemon=True)
         self.run_loop_thread.start()
 
-    def _run_loop(self):
+    def stop(self):
+        self.queue.put(None)
+        self.run_loop_thread.join()
+        if self._read_pool is not None:
+            self._read_pool.shutdown()
+
+    def _drain_queue(self) -> list:
+        # Block until at least one command arrives, then take everything
+        # that is already queued so a burst is applied in one wake-up.
+        commands = [self.queue.get()]
         while True:
-            if not self.queue.empty():
-                command: SlaveOperationCommands = self.queue.get()
+            try:
+                commands.append(self.queue.get_nowait())
+            except Empty:
+                return commands
+
+    def _replay_journal(self):
+        watermark = self.journal.applied[self.slave_n]
+        self.start_replay(known=True)
+        for seq, command in self.journal.replay(watermark):
+            self._replay_command(seq, command)
+
+        self._forget_handles()
+        self.journal.release_segments()
+        self.logger.info(f'[Slave {self.slave_n}] Replayed {self._replayed} journal entries after {watermark}')
+
+    def start_replay(self, known: bool):
+        # known tells whether the watermark is that of the journal replayed.
+        self._replayed = 0
+        self._replay_known = known
+
+    def _replay_command(self, seq: int, command: SlaveOperationCommands.Command):
+        if self.watermark is not None and seq <= self.watermark.seq:
+            # Applied before the master went away, but not acknowledged.
+            # Writes through the handles its skipped opens would have mapped
+            # go through the path.
+            return
+
+        try:
+            self._dispatch_command(command)
+        except OSError as e:
+            # The watermark is written after every command, so only the
+            # first one may have been applied already, unless nothing is
+            # known of what was.
+            if self._replayed == 0 or not self._replay_known:
+                self.logger.debug(f'[Slave {self.slave_n}] Replay of {seq} failed: {e}')
+            else:
+                self.logger.error(f'[Slave {self.slave_n}] Replay of {seq} failed: {e}')
+        self._replayed += 1
+        if self.journal is not None:
+            self.journal.mark_applied(self.slave_n, seq)
+        if self.watermark is not None:
+            self.watermark.mark(seq)
+
+    def _forget_handles(self):
+        # Handles opened during replay belong to the previous master process.
+        with self._fd_lock:
+            self._released.extend(self.fd_map.values())
+            self.fd_map.clear()
+        self._close_released()
+
+    def _compact(self, commands: list) -> list:
+        compacted = self.compactor.compact(commands)
+        if len(compacted) < len(commands):
+            self.logger.debug(f'[Slave {self.slave_n}] Compacted {len(commands)} commands to {len(compacted)}')
+        return compacted
+
+    def _run_loop(self):
+        if self.journal is not None:
+            self._replay_journal()
+
+        stopped = False
+        while not stopped:
+            commands = self._drain_queue()
+            if self.compactor is not None:
+                commands = self._compact(commands)
+            for command in commands:
+                if command is None:
+                    stopped = True
+                    break
                 self._execute_command(command)
-                time.sleep(0.1)
+            self._close_released()
+            self.queue.batch_applied()
+
+            if self.journal is not None:
+                self.journal.release_segments()
@@ -0,0 +1,40 @@
+import threading
+import typing
+
+
+class ReplicationAck:
+    """
+    Completion of one replicated command, shared by every slave the command
+    was queued to; the master waits until enough of them applied it, or
+    until too many were lost for that. required is the number of acks
+    waited for, slaves the number of slaves that acknowledge it, None if
+    unknown.
+    """
+    __slots__ = ('_condition', 'acked', 'lost', 'required', 'slaves')
+
+    def __init__(self, required: int, slaves: typing.Optional[int] = None):
+        self._condition = threading.Condition()
+        self.acked = 0
+        self.lost = 0
+        self.required = required
+        self.slaves = slaves
+
+    def applied(self):
+        with self._condition:
+            self.acked += 1
+            self._condition.notify_all()
+
+    def abandoned(self):
+        # By a slave that disconnected before applying it
+        with self._condition:
+            self.lost += 1
+            self._condition.notify_all()
+
+    def wait(self, timeout: typing.Optional[float] = None) -> bool:
+        def settled():
+            return self.acked >= self.required or \
+                (self.slaves is not None and self.slaves - self.lost < self.required)
+
+        with self._condition:
+            self._condition.wait_for(settled, timeout)
+            return self.acked >= self.required
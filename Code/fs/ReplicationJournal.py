@@ -0,0 +1,253 @@
+from typing import Dict, Iterator, List, Tuple
+import os
+import pickle
+import struct
+import threading
+import uuid
+import zlib
+
+from . import SlaveOperationCommands
+from .Watermark import Watermark
+
+
+# crc32 of the body, sequence number, body length
+_HEADER = struct.Struct('<IQI')
+_SEGMENT_SUFFIX = '.seg'
+
+
+def encode_command(command: SlaveOperationCommands.Command) -> bytes:
+    fields = SlaveOperationCommands.data_fields(command)
+    for name, value in fields.items():
+        if isinstance(value, (bytearray, memoryview)):
+            fields[name] = bytes(value)
+    return pickle.dumps((type(command).__name__, fields), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode_command(body: bytes) -> SlaveOperationCommands.Command:
+    return SlaveOperationCommands.from_data_fields(*pickle.loads(body))
+
+
+class ReplicationJournal:
+    """
+    Append-only on-disk log of the replicated commands. Every command gets
+    a sequence number; each slave records the highest sequence number it
+    has applied (its watermark) after every command so it can replay the
+    rest after a restart. Segments are deleted once every slave has applied
+    all of them. Slaves outside the master's process keep a watermark of
+    their own too, as the master only learns what they applied from their
+    acknowledgements; id tells them which journal it belongs to.
+    """
+
+    def __init__(self, path: str, nbr_slaves: int, segment_bytes: int = 64 * 1024 * 1024):
+        self.path = path
+        self.nbr_slaves = nbr_slaves
+        self.segment_bytes = segment_bytes
+        os.makedirs(path, exist_ok=True)
+        self.id = self._read_id()
+
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._syncing = False
+
+        self._watermarks = [Watermark(self._watermark_path(n)) for n in range(nbr_slaves)]
+        self.applied = [watermark.seq for watermark in self._watermarks]
+        # Slaves detached while running, which no longer hold segments back
+        self.detached = set()
+        self._segments = self._list_segments()
+        last_seq = self._recover_tail()
+        # Everything after this was appended by the running master and is
+        # delivered through the slave queues, not by replay.
+        self.recovered_seq = last_seq
+        self._next_seq = last_seq + 1
+        self._appended = last_seq
+        self._durable = last_seq
+
+        if not self._segments:
+            self._segments.append(self._next_seq)
+        self._file = open(self._segment_path(self._segments[-1]), 'ab')
+
+    @property
+    def last_seq(self) -> int:
+        with self._lock:
+            return self._appended
+
+    def append(self, command: SlaveOperationCommands.Command) -> int:
+        body = encode_command(command)
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            if not self._syncing and self._file.tell() >= self.segment_bytes:
+                self._roll_segment(seq)
+            self._file.write(_HEADER.pack(zlib.crc32(body), seq, len(body)))
+            self._file.write(body)
+            self._appended = seq
+        return seq
+
+    def wait_durable(self, seq: int):
+        # Group commit: the first waiter to find no sync running becomes the
+        # leader and syncs everything appended so far, later waiters either
+        # piggyback on that sync or lead the next one.
+        with self._lock:
+            while self._durable < seq:
+                if self._syncing:
+                    self._synced.wait()
+                    continue
+
+                self._syncing = True
+                target = self._appended
+                self._file.flush()
+                fd = self._file.fileno()
+                self._lock.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self._lock.acquire()
+                    self._syncing = False
+                self._durable = max(self._durable, target)
+                self._synced.notify_all()
+
+    def replay(self, after_seq: int) -> Iterator[Tuple[int, SlaveOperationCommands.Command]]:
+        with self._lock:
+            self._file.flush()
+            segments = list(self._segments)
+
+        for first_seq in segments:
+            try:
+                f = open(self._segment_path(first_seq), 'rb')
+            except FileNotFoundError:
+                continue
+            with f:
+                for seq, body in self._read_records(f):
+                    if seq > self.recovered_seq:
+                        return
+                    if seq > after_seq:
+                        command = decode_command(body)
+                        command.seq = seq
+                        yield seq, command
+
+    def mark_applied(self, slave_n: int, seq: int):
+        if seq is not None and seq > self.applied[slave_n]:
+            self.applied[slave_n] = seq
+            self._watermarks[slave_n].set(seq)
+
+    def skip_to(self, slave_n: int, seq: int):
+        # The slave was brought up to date by other means (e.g. a resync).
+        self.applied[slave_n] = seq
+        self._watermarks[slave_n].set(seq)
+        self.release_segments()
+
+    def slave_watermark_path(self, slave_n: int) -> str:
+        # Where a slave in another process on this node keeps its own
+        return os.path.join(self.path, f'slave_watermark_{slave_n}')
+
+    def add_slave(self) -> int:
+        """
+        Adds a slave that starts from a copy of the master's tree and so has
+        nothing to replay; whatever is appended from now on reaches it
+        through its queue.
+        """
+        with self._lock:
+            slave_n = len(self.applied)
+            self.applied.append(self._appended)
+            self._watermarks.append(Watermark(self._watermark_path(slave_n)))
+            self.nbr_slaves += 1
+        self._watermarks[slave_n].set(self.applied[slave_n])
+        return slave_n
+
+    def remove_slave(self, slave_n: int):
+        # Its watermark is kept, but the segments past it may go: the slave
+        # needs a resync before it follows this journal again.
+        with self._lock:
+            self.detached.add(slave_n)
+        self.release_segments()
+
+    def watermarks(self) -> Dict[int, int]:
+        return dict(enumerate(self.applied))
+
+    def release_segments(self):
+        # Called after batches of marks, rather than on every one
+        self._truncate(self._min_applied())
+
+    def _min_applied(self) -> int:
+        return min((seq for n, seq in enumerate(self.applied) if n not in self.detached), default=self._appended)
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        for watermark in self._watermarks:
+            watermark.close()
+
+    def _roll_segment(self, first_seq: int):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._durable = self._appended
+        self._segments.append(first_seq)
+        self._file = open(self._segment_path(first_seq), 'ab')
+
+    def _truncate(self, applied_seq: int):
+        with self._lock:
+            # A segment can go once the next one starts at or below the
+            # first sequence number some slave has not applied yet.
+            while len(self._segments) > 1 and self._segments[1] <= applied_seq + 1:
+                first_seq = self._segments.pop(0)
+                try:
+                    os.unlink(self._segment_path(first_seq))
+                except FileNotFoundError:
+                    pass
+
+    def _recover_tail(self) -> int:
+        if not self._segments:
+            return max(self.applied, default=0)
+
+        last_seq = self._segments[-1] - 1
+        path = self._segment_path(self._segments[-1])
+        with open(path, 'rb') as f:
+            for seq, _ in self._read_records(f):
+                last_seq = seq
+            valid_bytes = f.tell()
+        # Drop a record torn by a crash in the middle of an append.
+        if valid_bytes < os.path.getsize(path):
+            os.truncate(path, valid_bytes)
+        return last_seq
+
+    @staticmethod
+    def _read_records(f) -> Iterator[Tuple[int, bytes]]:
+        while True:
+            start = f.tell()
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                f.seek(start)
+                return
+            crc, seq, length = _HEADER.unpack(header)
+            body = f.read(length)
+            if len(body) < length or zlib.crc32(body) != crc:
+                f.seek(start)
+                return
+            yield seq, body
+
+    def _list_segments(self) -> List[int]:
+        return sorted(
+            int(name[:-len(_SEGMENT_SUFFIX)])
+            for name in os.listdir(self.path) if name.endswith(_SEGMENT_SUFFIX)
+        )
+
+    def _segment_path(self, first_seq: int) -> str:
+        return os.path.join(self.path, f'{first_seq:020d}{_SEGMENT_SUFFIX}')
+
+    def _watermark_path(self, slave_n: int) -> str:
+        return os.path.join(self.path, f'watermark_{slave_n}')
+
+    def _read_id(self) -> str:
+        path = os.path.join(self.path, 'id')
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            journal_id = uuid.uuid4().hex
+            with open(path + '.tmp', 'w') as f:
+                f.write(journal_id)
+            os.replace(path + '.tmp', path)
+            return journal_id
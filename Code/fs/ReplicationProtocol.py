@@ -0,0 +1,329 @@
+from typing import List, Tuple
+import hashlib
+import hmac
+import ipaddress
+import os
+import socket
+import struct
+import threading
+import typing
+
+
+# Binary framing of the messages exchanged with a slave on another node
+# (see RemoteSlave for the messages themselves). Every frame is a 5 byte
+# header, body length and message kind, followed by the body. Commands
+# carry their seq, then their fields in the order given by COMMAND_FIELDS;
+# a write's payload always comes last so it is sent straight from the
+# caller's buffer and used in place by the receiver.
+
+_FRAME = struct.Struct('<IB')
+_ID = struct.Struct('<Q')
+_COMMAND = struct.Struct('<QB')
+_STR = struct.Struct('<H')
+_INT = struct.Struct('<q')
+_OPT_INT = struct.Struct('<?q')
+_LEN = struct.Struct('<I')
+_RESULT = struct.Struct('<Q?')
+_ERROR = struct.Struct('<Qi')
+
+# Larger scatter lists are joined before sending
+_MAX_BUFFERS = 256
+
+# A slave with a shared secret sends a random challenge to every master that
+# connects, which answers with its HMAC-SHA256 under the secret before the
+# first frame; the slave confirms with a byte or closes the connection.
+_CHALLENGE_BYTES = 32
+_ACCEPTED = b'\x01'
+_HANDSHAKE_TIMEOUT = 10
+
+KIND_COMMAND = 1
+KIND_REPLAY = 2
+KIND_REPLAYED = 3
+KIND_STOP = 4
+KIND_ACK = 5
+KIND_RESULT = 6
+KIND_ERROR = 7
+KIND_JOURNAL = 8
+
+_KINDS = {'command': KIND_COMMAND, 'replay': KIND_REPLAY}
+_NAMES = {KIND_COMMAND: 'command', KIND_REPLAY: 'replay'}
+
+_F_STR = 's'
+_F_INT = 'i'
+_F_OPT_INT = 'o'
+_F_BYTES = 'b'
+_F_NONE = 'n'
+
+COMMAND_FIELDS = {
+    'Mkdir': (('path', _F_STR), ('mode', _F_INT)),
+    'Create': (('path', _F_STR), ('mode', _F_INT), ('ret_fd', _F_OPT_INT), ('fi', _F_NONE)),
+    'Open': (('path', _F_STR), ('flags', _F_INT), ('ret_fd', _F_OPT_INT)),
+    'Write': (('path', _F_STR), ('offset', _F_INT), ('fh', _F_OPT_INT), ('buf', _F_BYTES)),
+    'Truncate': (('path', _F_STR), ('length', _F_INT), ('fh', _F_OPT_INT)),
+    'Rename': (('old', _F_STR), ('new', _F_STR)),
+    'Release': (('path', _F_STR), ('fh', _F_OPT_INT)),
+    'Rmdir': (('path', _F_STR),),
+    'Unlink': (('path', _F_STR),),
+    'Chmod': (('path', _F_STR), ('mode', _F_INT)),
+    'Read': (('path', _F_STR), ('length', _F_INT), ('offset', _F_INT), ('fh', _F_OPT_INT),
+             ('block_size', _F_OPT_INT)),
+    'Checksum': (('path', _F_STR), ('length', _F_INT), ('offset', _F_INT), ('block_size', _F_INT)),
+    'Ping': (),
+}
+_COMMAND_CODES = {name: code for code, name in enumerate(COMMAND_FIELDS)}
+_COMMAND_NAMES = list(COMMAND_FIELDS)
+
+
+def encode_message(message) -> List[bytes]:
+    """Returns the frame of message as a list of buffers to send in order."""
+    if message is None:
+        return [_FRAME.pack(0, KIND_STOP)]
+
+    kind = message[0]
+    if kind in _KINDS:
+        _, request_id, name, fields, _ = message
+        head = bytearray(_COMMAND.pack(request_id, _COMMAND_CODES[name]))
+        seq = fields.get('seq')
+        head += _OPT_INT.pack(seq is not None, seq or 0)
+        tail = []
+        for field, field_type in COMMAND_FIELDS[name]:
+            value = fields[field]
+            if field_type == _F_STR:
+                encoded = value.encode('utf-8', 'surrogateescape')
+                head += _STR.pack(len(encoded))
+                head += encoded
+            elif field_type == _F_INT:
+                head += _INT.pack(value)
+            elif field_type == _F_OPT_INT:
+                head += _OPT_INT.pack(value is not None, value or 0)
+            elif field_type == _F_BYTES:
+                head += _LEN.pack(len(value))
+                tail.append(value)
+        parts = [head] + tail
+        code = _KINDS[kind]
+    elif kind == 'journal':
+        parts = [message[1].encode('ascii')]
+        code = KIND_JOURNAL
+    elif kind == 'replayed':
+        parts = [_ID.pack(message[1])]
+        code = KIND_REPLAYED
+    elif kind == 'ack':
+        ids = message[1]
+        parts = [_LEN.pack(len(ids)), struct.pack(f'<{len(ids)}Q', *ids)]
+        code = KIND_ACK
+    elif kind == 'result':
+        _, request_id, data = message
+        if isinstance(data, list):
+            parts = [_RESULT.pack(request_id, True), _LEN.pack(len(data))]
+            parts.append(struct.pack(f'<{len(data)}I', *(len(block) for block in data)))
+            parts.extend(data)
+        else:
+            parts = [_RESULT.pack(request_id, False), data]
+        code = KIND_RESULT
+    elif kind == 'error':
+        parts = [_ERROR.pack(message[1], message[2])]
+        code = KIND_ERROR
+    else:
+        raise ValueError(f'Unknown message {kind}')
+
+    length = sum(len(part) for part in parts)
+    return [_FRAME.pack(length, code)] + parts
+
+
+def decode_message(code: int, body: memoryview):
+    if code == KIND_STOP:
+        return None
+
+    if code in _NAMES:
+        request_id, command_code = _COMMAND.unpack_from(body)
+        name = _COMMAND_NAMES[command_code]
+        present, seq = _OPT_INT.unpack_from(body, _COMMAND.size)
+        position = _COMMAND.size + _OPT_INT.size
+        fields = {'seq': seq if present else None}
+        for field, field_type in COMMAND_FIELDS[name]:
+            if field_type == _F_STR:
+                (length,) = _STR.unpack_from(body, position)
+                position += _STR.size
+                fields[field] = str(body[position:position + length], 'utf-8', 'surrogateescape')
+                position += length
+            elif field_type == _F_INT:
+                (fields[field],) = _INT.unpack_from(body, position)
+                position += _INT.size
+            elif field_type == _F_OPT_INT:
+                present, value = _OPT_INT.unpack_from(body, position)
+                fields[field] = value if present else None
+                position += _OPT_INT.size
+            elif field_type == _F_BYTES:
+                (length,) = _LEN.unpack_from(body, position)
+                position += _LEN.size
+                # Used in place, the frame buffer is not reused.
+                fields[field] = body[position:position + length]
+                position += length
+            else:
+                fields[field] = None
+        return _NAMES[code], request_id, name, fields, None
+
+    if code == KIND_JOURNAL:
+        return 'journal', str(body, 'ascii')
+    if code == KIND_REPLAYED:
+        return 'replayed', _ID.unpack_from(body)[0]
+    if code == KIND_ACK:
+        (count,) = _LEN.unpack_from(body)
+        return 'ack', list(struct.unpack_from(f'<{count}Q', body, _LEN.size))
+    if code == KIND_RESULT:
+        request_id, is_blocks = _RESULT.unpack_from(body)
+        if not is_blocks:
+            return 'result', request_id, bytes(body[_RESULT.size:])
+        (count,) = _LEN.unpack_from(body, _RESULT.size)
+        position = _RESULT.size + _LEN.size
+        lengths = struct.unpack_from(f'<{count}I', body, position)
+        position += 4 * count
+        blocks = []
+        for length in lengths:
+            blocks.append(bytes(body[position:position + length]))
+            position += length
+        return 'result', request_id, blocks
+    if code == KIND_ERROR:
+        return ('error',) + _ERROR.unpack_from(body)
+    raise ValueError(f'Unknown message kind {code}')
+
+
+class FramedConnection:
+    """
+    Message connection over a stream socket, a drop-in for the
+    multiprocessing connections used between master and slave processes.
+    Messages are pipelined: send() never waits for the other side.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        buffers = encode_message(message)
+        if len(buffers) > _MAX_BUFFERS:
+            buffers = [b''.join(buffers)]
+        buffers = [memoryview(buffer).cast('B') for buffer in buffers]
+        with self._send_lock:
+            while buffers:
+                sent = self.sock.sendmsg(buffers)
+                while buffers and sent >= len(buffers[0]):
+                    sent -= len(buffers[0])
+                    buffers.pop(0)
+                if sent:
+                    buffers[0] = buffers[0][sent:]
+
+    def recv(self):
+        length, code = _FRAME.unpack(self._recv_exactly(_FRAME.size))
+        return decode_message(code, memoryview(self._recv_exactly(length)))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _recv_exactly(self, length: int) -> bytearray:
+        return _recv_exactly(self.sock, length)
+
+
+def _recv_exactly(sock: socket.socket, length: int) -> bytearray:
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise EOFError('Connection closed')
+        received += n
+    return buffer
+
+
+def parse_address(address: str) -> Tuple[int, 'typing.Any']:
+    """unix:/path/to/socket or host:port, the host defaulting to 127.0.0.1"""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+def is_local(address: str) -> bool:
+    # Whether only processes of this node can reach address
+    family, sockaddr = parse_address(address)
+    if family == socket.AF_UNIX or sockaddr[0] == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(sockaddr[0]).is_loopback
+    except ValueError:
+        return False
+
+
+def read_secret(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        secret = f.read().strip()
+    if not secret:
+        raise ValueError(f'No secret in {path}')
+    return secret
+
+
+def _answer(secret: bytes, challenge: bytes) -> bytes:
+    return hmac.new(secret, challenge, hashlib.sha256).digest()
+
+
+def connect(address: str, secret: bytes = None) -> FramedConnection:
+    family, sockaddr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockaddr)
+        if secret is not None:
+            sock.settimeout(_HANDSHAKE_TIMEOUT)
+            sock.sendall(_answer(secret, bytes(_recv_exactly(sock, _CHALLENGE_BYTES))))
+            if _recv_exactly(sock, len(_ACCEPTED)) != _ACCEPTED:
+                raise EOFError('Connection closed')
+            sock.settimeout(None)
+    except (EOFError, socket.timeout):
+        sock.close()
+        raise PermissionError(f'The slave at {address} did not accept the secret')
+    except OSError:
+        sock.close()
+        raise
+    return FramedConnection(sock)
+
+
+def accept(server: socket.socket, secret: bytes = None) -> Tuple[FramedConnection, 'typing.Any']:
+    """
+    Waits for the next master. With a secret, raises PermissionError for
+    one that does not prove it knows it.
+    """
+    sock, peer = server.accept()
+    if secret is not None:
+        try:
+            sock.settimeout(_HANDSHAKE_TIMEOUT)
+            challenge = os.urandom(_CHALLENGE_BYTES)
+            sock.sendall(challenge)
+            answer = _recv_exactly(sock, hashlib.sha256().digest_size)
+            accepted = hmac.compare_digest(answer, _answer(secret, challenge))
+            if accepted:
+                sock.sendall(_ACCEPTED)
+                sock.settimeout(None)
+        except (EOFError, OSError):
+            accepted = False
+        if not accepted:
+            sock.close()
+            raise PermissionError(f'Master from {peer or "socket"} did not prove the secret')
+    return FramedConnection(sock), peer
+
+
+def listen(address: str) -> socket.socket:
+    family, sockaddr = parse_address(address)
+    if family == socket.AF_UNIX and os.path.exists(sockaddr):
+        os.unlink(sockaddr)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family != socket.AF_UNIX:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(sockaddr)
+    sock.listen()
+    return sock
@@ -0,0 +1,253 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import errno
+import hashlib
+import logging
+import os
+import stat
+import threading
+import time
+
+from . import SlaveOperationCommands
+from .PositionalIO import read_blocks
+from .SlaveRequestPipeline import SlaveRequestPipeline
+
+# Blocks compared by one request to the slaves
+RANGE_BLOCKS = 16
+
+
+def block_digests(blocks: List[bytes]) -> List[bytes]:
+    return [hashlib.blake2b(block, digest_size=16).digest() for block in blocks]
+
+
+class Scrubber:
+    """
+    Background check of the slaves' copies against the master. A pass walks
+    the master's tree and compares, range by range, the digests of the
+    master's blocks with those each slave computes of its own copy; the
+    ranges are checked on a pool of worker threads reading at most
+    rate_bytes a second from the master. Blocks that differ are rewritten
+    from the master on the slave they differ on.
+
+    A range is read on the master and its Checksum queued to the slaves
+    under the path lock, so each slave hashes exactly the state the master
+    read, whatever was written before or after. Foreground operations on the
+    path wait at most for that read.
+    """
+
+    def __init__(self,
+                 master,
+                 block_size: int,
+                 rate_bytes: int,
+                 workers: int,
+                 interval: Optional[float] = None,
+                 timeout: Optional[float] = None,
+                 logger: logging.Logger = None,
+                 ):
+        self.master = master
+        self.block_size = block_size
+        self.rate_bytes = rate_bytes
+        self.workers = workers
+        self.interval = interval
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger('replica_fs.scrubber')
+
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._next_read = 0.0
+
+        nbr_slaves = len(master.queues)
+        self.passes = 0
+        self.running = False
+        self.files = 0
+        self.scanned_bytes = 0
+        self.total_bytes = 0
+        self.last_pass_s = None
+        self.checked_blocks = 0
+        self.mismatched_blocks = [0] * nbr_slaves
+        self.repaired_blocks = [0] * nbr_slaves
+        self.missing_files = [0] * nbr_slaves
+        self.errors = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='scrubber', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def add_slave(self):
+        with self._lock:
+            self.mismatched_blocks.append(0)
+            self.repaired_blocks.append(0)
+            self.missing_files.append(0)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_pass()
+            except Exception:
+                self.logger.exception('Scrub pass failed')
+
+    def run_pass(self):
+        """Checks every file once and returns when done (or stopped)."""
+        files = list(self._walk())
+        start = time.perf_counter()
+        with self._lock:
+            self.running = True
+            self.files = 0
+            self.scanned_bytes = 0
+            self.total_bytes = sum(size for _, size in files)
+
+        # Bounds the ranges waiting for a worker, and so the memory they hold.
+        slots = threading.BoundedSemaphore(self.workers * 2)
+
+        def check(path: str, offset: int):
+            try:
+                self._check_range(path, offset)
+            except Exception:
+                self.logger.exception(f'Failed to scrub {path} at {offset}')
+                with self._lock:
+                    self.errors += 1
+            finally:
+                slots.release()
+
+        range_bytes = self.block_size * RANGE_BLOCKS
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scrubber') as pool:
+            for path, size in files:
+                if self._stopped.is_set():
+                    break
+                # Up to and including the range holding the end of the file,
+                # which tells a slave's copy that is longer.
+                for offset in range(0, size + 1, range_bytes):
+                    slots.acquire()
+                    pool.submit(check, path, offset)
+                with self._lock:
+                    self.files += 1
+
+        with self._lock:
+            self.running = False
+            self.passes += 1
+            self.last_pass_s = time.perf_counter() - start
+
+    def _walk(self):
+        backing_store = self.master.backing_store
+        for directory, _, names in os.walk(backing_store):
+            for name in names:
+                full_path = os.path.join(directory, name)
+                try:
+                    attrs = os.lstat(full_path)
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISREG(attrs.st_mode):
+                    yield '/' + os.path.relpath(full_path, backing_store), attrs.st_size
+
+    def _check_range(self, path: str, offset: int):
+        master = self.master
+        sizes = [self.block_size] * RANGE_BLOCKS
+        with master._locks.mutation(path):
+            # Held back writes must reach the slaves before the Checksum.
+            master._flush_writes()
+            try:
+                blocks = self._read_master(path, sizes, offset)
+            except FileNotFoundError:
+                return
+            # Evicted slaves would only hold the pass up.
+            pipelines = {n: self._submit_checksum(n, path, offset) for n in master.readers(master._path_key(path))}
+
+        read = sum(len(block) for block in blocks)
+        self._throttle(read)
+        expected = block_digests(blocks)
+        with self._lock:
+            self.scanned_bytes += read
+            self.checked_blocks += len(blocks)
+
+        for n, pipeline in pipelines.items():
+            try:
+                digests = pipeline.get(self.timeout)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._missing(n, path)
+                continue
+            differing = [
+                i for i in range(max(len(expected), len(digests)))
+                if i >= len(expected) or i >= len(digests) or expected[i] != digests[i]
+            ]
+            if differing:
+                self.logger.warning(f'Slave {n} differs from the master in {len(differing)} blocks of {path} '
+                                    f'at {offset}')
+                with self._lock:
+                    self.mismatched_blocks[n] += len(differing)
+                self._repair(n, path, offset, differing)
+
+    def _repair(self, slave_n: int, path: str, offset: int, differing: List[int]):
+        master = self.master
+        sizes = [self.block_size] * RANGE_BLOCKS
+        with master._locks.mutation(path):
+            master._flush_writes()
+            # Read again: whatever was written since is queued to the slave
+            # ahead of the repair, which must not undo it.
+            try:
+                blocks = self._read_master(path, sizes, offset)
+            except FileNotFoundError:
+                return
+            queue = master.queues[slave_n]
+            for i in differing:
+                if i < len(blocks) and blocks[i]:
+                    queue.put(SlaveOperationCommands.Write(path, bytes(blocks[i]), offset + i * self.block_size, None))
+            if len(blocks) < RANGE_BLOCKS or len(blocks[-1]) < self.block_size:
+                end = offset + sum(len(block) for block in blocks)
+                queue.put(SlaveOperationCommands.Truncate(path, end, None))
+        with self._lock:
+            self.repaired_blocks[slave_n] += len(differing)
+
+    def _read_master(self, path: str, sizes: List[int], offset: int) -> List[bytearray]:
+        fd = os.open(self.master._get_real_path(path), os.O_RDONLY)
+        try:
+            return read_blocks(fd, sizes, offset)
+        finally:
+            os.close(fd)
+
+    def _submit_checksum(self, slave_n: int, path: str, offset: int) -> SlaveRequestPipeline:
+        pipeline = SlaveRequestPipeline()
+        command = SlaveOperationCommands.Checksum(path, self.block_size * RANGE_BLOCKS, offset, self.block_size)
+        command.pipeline = pipeline
+        self.master.queues[slave_n].put(command)
+        return pipeline
+
+    def _missing(self, slave_n: int, path: str):
+        # Whole files are left to a resync.
+        self.logger.warning(f'Slave {slave_n} is missing {path}')
+        with self._lock:
+            self.missing_files[slave_n] += 1
+
+    def _throttle(self, nbytes: int):
+        if not self.rate_bytes:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next_read, now)
+            self._next_read = start + nbytes / self.rate_bytes
+        if start > now:
+            time.sleep(start - now)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'passes': self.passes,
+                'running': self.running,
+                'files': self.files,
+                'scanned_bytes': self.scanned_bytes,
+                'total_bytes': self.total_bytes,
+                'progress': min(self.scanned_bytes / self.total_bytes, 1.0) if self.total_bytes else 0.0,
+                'last_pass_s': self.last_pass_s,
+                'checked_blocks': self.checked_blocks,
+                'mismatched_blocks': list(self.mismatched_blocks),
+                'repaired_blocks': list(self.repaired_blocks),
+                'missing_files': list(self.missing_files),
+                'errors': self.errors,
+            }
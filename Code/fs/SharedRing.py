@@ -0,0 +1,65 @@
+from collections import deque
+from multiprocessing import shared_memory
+from typing import Optional, Tuple
+import threading
+
+
+class SharedRing:
+    """
+    Ring buffer in shared memory used to hand write payloads to a slave
+    process without pickling them. Payloads are stored by a single thread
+    and applied by the slave in that order, so space is reclaimed in that
+    order as well.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.name = self.shm.name
+
+        self._condition = threading.Condition()
+        # Monotonic byte positions; position % size is the offset in shm.
+        self._head = 0
+        self._tail = 0
+        # End position of every stored payload, padding included
+        self._ends = deque()
+
+    def store(self, payload) -> Optional[Tuple[int, int]]:
+        """
+        Copies payload in, waiting for space if needed, and returns its
+        (offset, length); returns None if it is too large for the ring.
+        """
+        length = len(payload)
+        if length > self.size // 2:
+            return None
+
+        with self._condition:
+            while True:
+                offset = self._head % self.size
+                # A payload never wraps around, skip to the start instead.
+                padding = self.size - offset if offset + length > self.size else 0
+                if self._head + padding + length - self._tail <= self.size:
+                    break
+                self._condition.wait()
+
+            if padding:
+                offset = 0
+            self._head += padding + length
+            self._ends.append(self._head)
+
+        self.shm.buf[offset:offset + length] = payload
+        return offset, length
+
+    def release(self):
+        """Frees the oldest stored payload."""
+        with self._condition:
+            self._tail = self._ends.popleft()
+            self._condition.notify_all()
+
+    def occupancy(self) -> int:
+        with self._condition:
+            return self._head - self._tail
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,328 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Set, Tuple
+import errno
+import itertools
+import logging
+import os
+import stat
+import threading
+
+from . import SlaveOperationCommands
+from .SlaveQueue import SlaveQueue
+
+# Files copied at once, and the size of the writes they are copied with
+WORKERS = 4
+CHUNK_BYTES = 1024 * 1024
+# Payload bytes a slave may have left to apply before a copy to it waits
+MAX_LAG_BYTES = 64 * 1024 * 1024
+# A slave joins once it lags by fewer operations than this; writers are
+# held back while it applies the rest.
+JOIN_LAG_OPS = 64
+# Times what was renamed during the copy is copied again before joining
+MAX_RECOPIES = 8
+
+COPYING = 'copying'
+CATCHING_UP = 'catching up'
+JOINED = 'joined'
+FAILED = 'failed'
+STOPPED = 'stopped'
+
+# Handles of the copied files on the slaves, negative so they never meet
+# the master's, and shared by all copies as two may go to the same slave
+_handles = itertools.count(1)
+
+
+class SlaveGone(Exception):
+    pass
+
+
+class TreeCopy(ABC):
+    """
+    Copies the master's tree to slaves while the file system is in use.
+    Directories are copied top down and regular files on a pool of workers,
+    each in chunks read and queued under its path lock and skipping holes.
+    The slaves are meanwhile sent the commands of the files they hold: a
+    command on a path not copied yet fails harmlessly on a slave, the copy
+    made later includes its effect; one on a path already copied applies on
+    top of the copy. What is renamed during the copy may have moved behind
+    the walk and is copied again.
+
+    Subclasses tell which slaves each directory and file goes to.
+    """
+
+    def __init__(self, master, name: str, logger: logging.Logger = None):
+        self.master = master
+        self.name = name
+        self.logger = logger or logging.getLogger('replica_fs.bootstrap')
+
+        self.state = COPYING
+        self.directories = 0
+        self.files = 0
+        self.copied_bytes = 0
+        self.errors = 0
+        self._renamed: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # The thread may be waiting on a dead slave, it is not waited for.
+        self._stopped.set()
+
+    def renamed(self, path: str):
+        with self._lock:
+            if self.state == COPYING:
+                self._renamed.add(path)
+
+    @abstractmethod
+    def _run(self):
+        pass
+
+    @abstractmethod
+    def _directory_queues(self) -> List[SlaveQueue]:
+        pass
+
+    @abstractmethod
+    def _file_queues(self, fd: int) -> List[SlaveQueue]:
+        # fd is the master's file, open for reading.
+        pass
+
+    def _copy_all(self, next_state: str):
+        """Copies the whole tree, then what was renamed meanwhile."""
+        self._copy('/')
+        for _ in range(MAX_RECOPIES):
+            with self._lock:
+                renamed, self._renamed = self._renamed, set()
+                if not renamed:
+                    self.state = next_state
+                    return
+            for path in outermost_paths(renamed):
+                self._copy(path)
+        self.logger.warning(f'{self.name}: paths renamed during the copy left uncopied')
+        self.state = next_state
+
+    def _copy(self, path: str):
+        try:
+            attrs = os.lstat(self.master._get_real_path(path))
+        except FileNotFoundError:
+            return
+        if stat.S_ISREG(attrs.st_mode):
+            self._copy_file(path)
+        elif stat.S_ISDIR(attrs.st_mode):
+            self._copy_tree(path)
+
+    def _copy_tree(self, root: str):
+        # Bounds the files waiting for a worker.
+        slots = threading.BoundedSemaphore(WORKERS * 2)
+
+        def copy(path: str):
+            try:
+                self._copy_file(path)
+            except SlaveGone:
+                pass
+            except Exception:
+                self.logger.exception(f'{self.name}: failed to copy {path}')
+                with self._lock:
+                    self.errors += 1
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix=self.name) as pool:
+            directories = [root]
+            while directories:
+                self._check()
+                directory = directories.pop()
+                for name, is_directory in self._copy_directory(directory):
+                    path = directory.rstrip('/') + '/' + name
+                    if is_directory:
+                        directories.append(path)
+                    else:
+                        slots.acquire()
+                        pool.submit(copy, path)
+        self._check()
+
+    def _copy_directory(self, path: str):
+        master = self.master
+        real_path = master._get_real_path(path)
+        with master._locks.mutation(path):
+            master._flush_writes()
+            try:
+                attrs = os.lstat(real_path)
+            except FileNotFoundError:
+                return []
+            if not stat.S_ISDIR(attrs.st_mode):
+                return []
+            if path != '/':
+                mode = stat.S_IMODE(attrs.st_mode)
+                queues = self._directory_queues()
+                self._put(queues, SlaveOperationCommands.Mkdir(path, mode))
+                self._put(queues, SlaveOperationCommands.Chmod(path, mode))
+        with self._lock:
+            self.directories += 1
+
+        # Entries created from now on reach the slaves after their Mkdir.
+        entries = []
+        try:
+            with os.scandir(real_path) as scan:
+                for entry in scan:
+                    if entry.is_dir(follow_symlinks=False):
+                        entries.append((entry.name, True))
+                    elif entry.is_file(follow_symlinks=False):
+                        entries.append((entry.name, False))
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return entries
+
+    def _copy_file(self, path: str):
+        master = self.master
+        handle = -next(_handles)
+        with master._locks.mutation(path):
+            master._flush_writes()
+            try:
+                fd = os.open(master._get_real_path(path), os.O_RDONLY)
+            except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+                return
+            queues = self._file_queues(fd)
+            if not queues:
+                os.close(fd)
+                return
+            mode = stat.S_IMODE(os.fstat(fd).st_mode)
+            self._put(queues, SlaveOperationCommands.Create(path, mode, None, ret_fd=handle))
+            self._put(queues, SlaveOperationCommands.Chmod(path, mode))
+            self._put(queues, SlaveOperationCommands.Truncate(path, 0, handle))
+
+        try:
+            # The copy goes through fd and the slaves' handle, so it follows
+            # the file if it is renamed or unlinked meanwhile.
+            offset = 0
+            while True:
+                self._wait_for_lag(queues)
+                with master._locks.mutation(path):
+                    master._flush_writes()
+                    extent = _next_extent(fd, offset)
+                    if extent is None:
+                        break
+                    start, end = extent
+                    data = os.pread(fd, min(end - start, CHUNK_BYTES), start)
+                    if not data:
+                        break
+                    self._put(queues, SlaveOperationCommands.Write(path, data, start, handle))
+                offset = start + len(data)
+                with self._lock:
+                    self.copied_bytes += len(data)
+
+            with master._locks.mutation(path):
+                master._flush_writes()
+                # Holes at the end, and whatever was cut off meanwhile
+                self._put(queues, SlaveOperationCommands.Truncate(path, os.fstat(fd).st_size, handle))
+                self._put(queues, SlaveOperationCommands.Release(path, handle))
+        finally:
+            os.close(fd)
+        with self._lock:
+            self.files += 1
+
+    @staticmethod
+    def _put(queues: List[SlaveQueue], command: SlaveOperationCommands.Command):
+        # One command object for all, as in replication.
+        for queue in queues:
+            queue.put(command)
+
+    def _wait_for_lag(self, queues: List[SlaveQueue], max_ops: Optional[int] = None):
+        for queue in queues:
+            # Leaves live operations room in a bounded queue.
+            limit_ops = max_ops
+            if queue.max_ops is not None:
+                limit_ops = max(min(limit_ops or queue.max_ops, queue.max_ops // 2), 1)
+            limit_bytes = MAX_LAG_BYTES
+            if queue.max_bytes is not None:
+                limit_bytes = max(min(MAX_LAG_BYTES, queue.max_bytes // 2), 1)
+            while not queue.wait_for_lag(limit_ops, limit_bytes, timeout=1.0):
+                self._check()
+
+    def _check(self):
+        if self._stopped.is_set():
+            raise SlaveGone()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'directories': self.directories,
+                'files': self.files,
+                'copied_bytes': self.copied_bytes,
+                'errors': self.errors,
+            }
+
+
+class SlaveBootstrap(TreeCopy):
+    """
+    Brings a slave attached while the master runs up to date with a copy of
+    the whole tree; it is sent every replicated command from the moment it
+    is attached. Once it has nearly caught up, writers are held back until
+    it has applied everything; it then acknowledges writes and serves reads
+    like the other slaves.
+    """
+
+    def __init__(self, master, slave_n: int, proxy, logger: logging.Logger = None):
+        super().__init__(master, f'bootstrap-{slave_n}', logger)
+        self.slave_n = slave_n
+        self.proxy = proxy
+        self.queue = master.queues[slave_n]
+
+    def _directory_queues(self) -> List[SlaveQueue]:
+        return [self.queue]
+
+    def _file_queues(self, fd: int) -> List[SlaveQueue]:
+        return [self.queue]
+
+    def _run(self):
+        try:
+            self._copy_all(CATCHING_UP)
+            while True:
+                self._wait_for_lag([self.queue], max_ops=JOIN_LAG_OPS)
+                if self.master._join_slave(self.slave_n):
+                    break
+                self._check()
+            self.state = JOINED
+            self.logger.info(f'Slave {self.slave_n} joined: {self.stats()}')
+        except SlaveGone:
+            self.state = STOPPED if self._stopped.is_set() else FAILED
+        except Exception:
+            self.logger.exception(f'Failed to bring slave {self.slave_n} up to date')
+            self.state = FAILED
+        if self.state == FAILED and not self._stopped.is_set():
+            self.master.detach_slave(self.slave_n)
+
+    def _check(self):
+        super()._check()
+        if not self.proxy.connected():
+            self.logger.error(f'Slave {self.slave_n} disconnected while being brought up to date')
+            raise SlaveGone()
+
+
+def _next_extent(fd: int, offset: int) -> Optional[Tuple[int, int]]:
+    # The next range of the file holding data, from offset on.
+    if not hasattr(os, 'SEEK_DATA'):
+        size = os.fstat(fd).st_size
+        return (offset, size) if offset < size else None
+    try:
+        start = os.lseek(fd, offset, os.SEEK_DATA)
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            return None
+        raise
+    return start, os.lseek(fd, start, os.SEEK_HOLE)
+
+
+def outermost_paths(paths: Set[str]) -> List[str]:
+    # Copying a directory copies what is under it.
+    outermost = []
+    for path in sorted(paths):
+        if not outermost or not path.startswith(outermost[-1].rstrip('/') + '/'):
+            outermost.append(path)
+    return outermost
@@ -0,0 +1,253 @@
+from collections import deque
+from fuse import FuseOSError
+from typing import List, Optional
+import errno
+import threading
+import time
+
+from . import SlaveOperationCommands
+from .SlaveQueue import SlaveQueue
+from .SlaveRequestPipeline import SlaveRequestPipeline
+
+# Failed requests in a row after which a slave is evicted
+MAX_ERRORS = 3
+# Read latencies kept per slave, and needed before its p95 is trusted
+LATENCY_SAMPLES = 256
+MIN_SAMPLES = 32
+# A slave whose p95 is this many times that of the fastest one is evicted
+SLOW_FACTOR = 8
+# Hedged reads never wait less than this for the first answer
+MIN_HEDGE_DELAY = 0.001
+
+EVICTED_STALLED = 'stalled'
+EVICTED_ERRORS = 'errors'
+EVICTED_SLOW = 'slow'
+# Slaves attached while running stay out until caught up with the master,
+# detached ones for good.
+EVICTED_JOINING = 'joining'
+EVICTED_DETACHED = 'detached'
+
+
+def is_slave_fault(exception: BaseException) -> bool:
+    # ENOENT, EBADF, ... are answers of the file system, not of a broken slave.
+    if isinstance(exception, TimeoutError):
+        return True
+    if isinstance(exception, (FuseOSError, OSError)):
+        return exception.errno in (errno.EIO, errno.ENOTCONN, errno.EPIPE, None)
+    return True
+
+
+def _p95(latencies) -> Optional[float]:
+    if len(latencies) < MIN_SAMPLES:
+        return None
+    latencies = sorted(latencies)
+    return latencies[int(len(latencies) * 0.95)]
+
+
+class _Slave:
+    __slots__ = ('latencies', 'errors', 'failures', 'evictions', 'evicted', 'evicted_at', 'ping_sent',
+                 'last_pong')
+
+    def __init__(self):
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        # Failures in a row, and in total
+        self.errors = 0
+        self.failures = 0
+        self.evictions = 0
+        # Reason the slave is out of the read rotation, if it is
+        self.evicted: Optional[str] = None
+        self.evicted_at = 0.0
+        # When the outstanding heartbeat was sent
+        self.ping_sent: Optional[float] = None
+        self.last_pong: Optional[float] = None
+
+
+class SlaveHealth:
+    """
+    Tells which slaves may serve reads. Every slave is sent a Ping through
+    its queue each timeout / 4 seconds; one left unanswered for timeout
+    seconds gets the slave evicted as stalled, as do MAX_ERRORS failed reads
+    in a row or a p95 read latency SLOW_FACTOR times the fastest slave's.
+    An evicted slave is taken back once it has been out for timeout seconds
+    and answers its heartbeat again. With hedge, reads are sent again once
+    they have taken longer than 95% of recent reads on any slave.
+    """
+
+    def __init__(self, queues: List[SlaveQueue], timeout: float, hedge: bool = False):
+        self.queues = queues
+        self.timeout = timeout
+        self.hedge = hedge
+        self._slaves = [_Slave() for _ in queues]
+        # Recomputed on every eviction and readmission, read on every read
+        self._healthy = list(range(len(queues)))
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # p95 of the recent reads of all healthy slaves, refreshed every
+        # MIN_SAMPLES reads
+        self._p95_all: Optional[float] = None
+        self._samples = 0
+
+        self.hedged_reads = 0
+        self.local_reads = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='slave-health', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def add_slave(self) -> int:
+        # Its queue is already in queues.
+        with self._lock:
+            slave = _Slave()
+            slave.evicted = EVICTED_JOINING
+            self._slaves.append(slave)
+            return len(self._slaves) - 1
+
+    def admit(self, n: int):
+        with self._lock:
+            slave = self._slaves[n]
+            slave.evicted = None
+            slave.errors = 0
+            self._update_healthy()
+
+    def detach(self, n: int):
+        with self._lock:
+            self._slaves[n].evicted = EVICTED_DETACHED
+            self._update_healthy()
+
+    def healthy(self) -> List[int]:
+        return self._healthy
+
+    def is_healthy(self, n: int) -> bool:
+        return n in self._healthy
+
+    def succeeded(self, n: int, elapsed: float):
+        with self._lock:
+            slave = self._slaves[n]
+            slave.errors = 0
+            slave.latencies.append(elapsed)
+            self._samples += 1
+            if self._samples % MIN_SAMPLES == 0:
+                # None when too few of the reads were on healthy slaves, as
+                # when a read completes on a slave evicted since.
+                self._p95_all = _p95([
+                    latency for slave in self._slaves if slave.evicted is None for latency in slave.latencies
+                ])
+
+    def failed(self, n: int, exception: BaseException):
+        if not is_slave_fault(exception):
+            return
+        with self._lock:
+            slave = self._slaves[n]
+            slave.errors += 1
+            slave.failures += 1
+            if slave.errors >= MAX_ERRORS:
+                self._evict(n, EVICTED_ERRORS)
+
+    def hedge_delay(self) -> float:
+        """How long to wait for a slave before asking another one."""
+        p95 = self._p95_all
+        if not self.hedge or p95 is None:
+            return self.timeout
+        return min(max(p95, MIN_HEDGE_DELAY), self.timeout)
+
+    def note_hedged(self):
+        with self._lock:
+            self.hedged_reads += 1
+
+    def note_local(self):
+        with self._lock:
+            self.local_reads += 1
+
+    def check(self):
+        """Sends the heartbeats and evicts or takes back slaves."""
+        now = time.monotonic()
+        pings = []
+        with self._lock:
+            for n, slave in enumerate(self._slaves):
+                if slave.evicted == EVICTED_DETACHED:
+                    continue
+                if slave.ping_sent is None:
+                    slave.ping_sent = now
+                    pings.append(n)
+                elif now - slave.ping_sent > self.timeout and slave.evicted is None:
+                    self._evict(n, EVICTED_STALLED)
+            self._evict_slow()
+            self._readmit(now)
+
+        for n in pings:
+            pipeline = SlaveRequestPipeline()
+            command = SlaveOperationCommands.Ping()
+            command.pipeline = pipeline
+            pipeline.on_done(lambda done, n=n: self._pong(n, done))
+            self.queues[n].put(command)
+
+    def _pong(self, n: int, pipeline: SlaveRequestPipeline):
+        with self._lock:
+            slave = self._slaves[n]
+            slave.ping_sent = None
+            if pipeline.exception is None:
+                slave.last_pong = time.monotonic()
+
+    def _run(self):
+        while not self._stopped.wait(self.timeout / 4):
+            self.check()
+
+    def _evict(self, n: int, reason: str):
+        slave = self._slaves[n]
+        if slave.evicted is not None:
+            return
+        slave.evicted = reason
+        slave.evicted_at = time.monotonic()
+        slave.evictions += 1
+        self._update_healthy()
+
+    def _update_healthy(self):
+        self._healthy = [n for n, slave in enumerate(self._slaves) if slave.evicted is None]
+
+    def _evict_slow(self):
+        p95s = {
+            n: p95 for n, p95 in ((n, _p95(slave.latencies)) for n, slave in enumerate(self._slaves)
+                                  if slave.evicted is None)
+            if p95 is not None
+        }
+        if len(p95s) < 2:
+            return
+        fastest = min(p95s.values())
+        for n, p95 in p95s.items():
+            if p95 > SLOW_FACTOR * fastest:
+                self._evict(n, EVICTED_SLOW)
+
+    def _readmit(self, now: float):
+        for slave in self._slaves:
+            if slave.evicted in (None, EVICTED_JOINING, EVICTED_DETACHED) or now - slave.evicted_at < self.timeout:
+                continue
+            # Only on a heartbeat answered since the eviction
+            if slave.last_pong is None or slave.last_pong <= slave.evicted_at:
+                continue
+            slave.evicted = None
+            slave.errors = 0
+            slave.latencies.clear()
+            self._update_healthy()
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [
+                {
+                    'healthy': slave.evicted is None,
+                    'evicted': slave.evicted,
+                    'evictions': slave.evictions,
+                    'failures': slave.failures,
+                    'p95_seconds': _p95(slave.latencies),
+                } for slave in self._slaves
+            ]
+
+    def read_stats(self) -> dict:
+        with self._lock:
+            return {'hedged': self.hedged_reads, 'local': self.local_reads}
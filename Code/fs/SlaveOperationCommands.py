@@ -1,128 +1,180 @@
 from abc import ABC
 from dataclasses import dataclass
-import threading
+import dataclasses
 import typing
 
+from .ReplicationAck import ReplicationAck
 from .SlaveRequestPipeline import SlaveRequestPipeline
 
 
+def slotted(cls):
+    # dataclass(slots=True) for the Python versions that lack it: a command
+    # is queued once per slave and many may be pending, so instances carry
+    # no __dict__.
+    cls = dataclass(cls)
+    names = tuple(field.name for field in dataclasses.fields(cls))
+    namespace = {key: value for key, value in cls.__dict__.items() if key not in names + ('__dict__', '__weakref__')}
+    namespace['__slots__'] = names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
 class Command(ABC):
-    slave_i: int = None
-    event: threading.Event = None
-    condition: threading.Condition = None
-    pipeline: SlaveRequestPipeline = None
+    # A command object is shared by all slaves: they only read it, and
+    # report completion through the shared ack (None when nobody waits).
+    __slots__ = ()
 
 
-@dataclass
+@slotted
 class Mkdir(Command):
     path: str
     mode: 'typing.Any'
-    slave_i: int = None
-    event: threading.Event = None
-    condition: threading.Condition = None
+    seq: int = None
+    ack: ReplicationAck = None
     pipeline: SlaveRequestPipeline = None
 
 
-@dataclass
+@slotted
 class Create(Command):
     path: str
     mode: 'typing.Any'
     fi: 'typing.Any'
     ret_fd: 'typing.Any'
-    slave_i: int = None
-    event: threading.Event = None
-    condition: threading.Condition = None
+    seq: int = None
+    ack: ReplicationAck = None
     pipeline: SlaveRequestPipeline = None
 
 
-@dataclass
+@slotted
 class Open(Command):
     path: str
     flags: 'typing.Any'
     ret_fd: 'typing.Any'
-    slave_i: int = None
-    event: threading.Event = None
-    condition: threading.Condition = None
+    seq: int = None
+    ack: ReplicationAck = None
     pipeline: SlaveRequestPipeline = None
 
 
-@dataclass
+@slotted
 class Write(Command):
     path: str
     buf: 'typing.Any'
     offset: int
     fh: 'typing.Any'
-    slave_i: int = None
-    event: threading.Event = None
-    condition: threading.Condition = None
+    seq: int = None
+    ack: ReplicationAck = None
     pipeline: SlaveRequestPipeline = None
 
 
-@dataclass
+@slotted
 class Truncate(Command):
     path: str
     length: int
     fh: 'typing.Any'
-    slave_i: int = None
-    event: threading.Event = None
-    condition: threading.Condition = None
+    seq: int = None
+    ack: ReplicationAck = None
 
 
-@dataclass
+@slotted
 class Rename(Command):
     old: str
     new: str
-    slave_i: int = None
-    event: threading.Event = None
-    condition: threading.Condition = None
+    seq: int = None
+    ack: ReplicationAck = None
     pipeline: SlaveRequestPipeline = None
 
 
-@dataclass
+@slotted
 class Release(Command):
     path: str
     fh: 'typing.Any'
-    slave_i: int = None
-    event: threading.Event = None
-    condition: threading.Condition = None
+    seq: int = None
+    ack: ReplicationAck = None
     pipeline: SlaveRequestPipeline = None
 
 
-@dataclass
+@slotted
 class Rmdir(Command):
     path: str
-    slave_i: int = None
-    event: threading.Event = None
-    condition: threading.Condition = None
+    seq: int = None
+    ack: ReplicationAck = None
     pipeline: SlaveRequestPipeline = None
 
 
-@dataclass
+@slotted
 class Unlink(Command):
     path: str
-    slave_i: int = None
-    event: threading.Event = None
-    condition: threading.Condition = None
+    seq: int = None
+    ack: ReplicationAck = None
     pipeline: SlaveRequestPipeline = None
 
 
-@dataclass
+@slotted
 class Chmod(Command):
     path: str
     mode: 'typing.Any'
-    slave_i: int = None
-    event: threading.Event = None
-    condition: threading.Condition = None
+    seq: int = None
+    ack: ReplicationAck = None
     pipeline: SlaveRequestPipeline = None
 
 
-@dataclass
+@slotted
 class Read(Command):
     path: str
     length: int
     offset: int
     fh: 'typing.Any'
-    slave_i: int = None
-    event: threading.Event = None
-    condition: threading.Condition = None
+    # When set, the result is a list of blocks of this size read with preadv
+    block_size: typing.Optional[int] = None
+    seq: int = None
+    ack: ReplicationAck = None
+    pipeline: SlaveRequestPipeline = None
+
+
+@slotted
+class Checksum(Command):
+    # Answered with the digests of the blocks of block_size in the range,
+    # a short or empty last one marking the end of the file.
+    path: str
+    length: int
+    offset: int
+    block_size: int
+    seq: int = None
+    ack: ReplicationAck = None
+    pipeline: SlaveRequestPipeline = None
+
+
+@slotted
+class Ping(Command):
+    # Answered once every command queued before it has been applied.
+    seq: int = None
+    ack: ReplicationAck = None
     pipeline: SlaveRequestPipeline = None
+
+
+def is_replicated(command: typing.Optional[Command]) -> bool:
+    return command is not None and not isinstance(command, (Read, Checksum, Ping))
+
+
+def payload_size(command: Command) -> int:
+    if isinstance(command, Write):
+        return len(command.buf)
+    return 0
+
+
+_RUNTIME_FIELDS = {'seq', 'ack', 'pipeline'}
+
+
+def data_fields(command: Command) -> dict:
+    """
+    The fields describing the operation itself, without the ones used to
+    track it inside this process.
+    """
+    fields = {}
+    for field in dataclasses.fields(command):
+        if field.name not in _RUNTIME_FIELDS:
+            fields[field.name] = getattr(command, field.name)
+    return fields
+
+
+def from_data_fields(name: str, fields: dict) -> Command:
+    return globals()[name](**fields)
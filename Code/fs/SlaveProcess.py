@@ -0,0 +1,87 @@
+from fuse import FUSE
+from multiprocessing import shared_memory
+import logging
+import multiprocessing
+import threading
+import typing
+
+from fs.config import ReplicaFSConfig
+from .ChunkedReplicaFSSlave import make_slave
+from .RemoteSlave import RemoteSlaveProxy, RemoteSlaveQueue, serve_master
+from .ReplicationJournal import ReplicationJournal
+from .SharedRing import SharedRing
+from .SlaveQueue import SlaveQueue
+from .Watermark import Watermark
+
+
+class SlaveProcessProxy(RemoteSlaveProxy):
+    """
+    Master side of a slave running in its own process. Commands travel over
+    a pipe and write payloads through a shared memory ring.
+    """
+
+    def __init__(self,
+                 config: ReplicaFSConfig,
+                 slave_n: int,
+                 queue: SlaveQueue,
+                 journal: ReplicationJournal = None,
+                 mount: bool = True,
+                 log_file: typing.Optional[str] = None,
+                 ):
+        ring = SharedRing(config.shm_ring_bytes)
+        context = multiprocessing.get_context('spawn')
+        conn, child_conn = context.Pipe()
+        super().__init__(slave_n, queue, conn, journal=journal, ring=ring)
+
+        watermark_path = None
+        if journal is not None:
+            watermark_path = journal.slave_watermark_path(slave_n)
+        self.process = context.Process(
+            target=run_slave_process,
+            args=(config, slave_n, child_conn, ring.name, mount, log_file, watermark_path),
+            name=f'replicafs-slave-{slave_n}',
+            daemon=True,
+        )
+        self._child_conn = child_conn
+
+    def start(self):
+        self.process.start()
+        self._child_conn.close()
+        super().start()
+
+    def stop(self):
+        super().stop()
+        self.process.join()
+        self.ring.close()
+
+
+def create_slave_logger(name: str, log_file: typing.Optional[str]) -> logging.Logger:
+    logger = logging.getLogger(name)
+    if log_file is not None:
+        logger.setLevel(logging.DEBUG)
+        fh = logging.FileHandler(log_file)
+        fh.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+        logger.addHandler(fh)
+    return logger
+
+
+def run_slave_process(config: ReplicaFSConfig, slave_n: int, conn, ring_name: str, mount: bool,
+                      log_file: typing.Optional[str], watermark_path: typing.Optional[str] = None):
+    logger = create_slave_logger(f'replica_fs.slave{slave_n}', log_file)
+    shm = shared_memory.SharedMemory(name=ring_name)
+    queue = RemoteSlaveQueue()
+    slave = make_slave(config, queue=queue, slave_n=slave_n, logger=logger, watermark=Watermark(watermark_path))
+
+    if not mount:
+        serve_master(conn, slave, queue, shm)
+        slave.stop()
+        return
+
+    receive_thread = threading.Thread(target=serve_master, args=(conn, slave, queue, shm), daemon=True)
+    receive_thread.start()
+    FUSE(
+        slave,
+        config.slave_mount_points[slave_n],
+        nothreads=not config.threaded,
+        foreground=True,
+    )
@@ -0,0 +1,104 @@
+from queue import Queue
+import threading
+import typing
+
+from . import SlaveOperationCommands
+
+
+class SlaveQueue(Queue):
+    """
+    Command queue of a single slave. Besides the queued commands it keeps
+    track of how many replicated operations (and payload bytes) have been
+    handed to the slave but not yet applied, i.e. the slave's lag, which is
+    what the master holds in memory for it whether the commands are still
+    queued or already sent.
+
+    The lag is bounded by max_ops and max_bytes: a writer waits for room
+    before changing anything. The bound is checked, not reserved, so
+    concurrent writers may each overshoot it by one command.
+    """
+
+    def __init__(self, max_ops: typing.Optional[int] = None, max_bytes: typing.Optional[int] = None):
+        super().__init__()
+        self._lag_condition = threading.Condition()
+        self.max_ops = max_ops
+        self.max_bytes = max_bytes
+        self.pending_ops = 0
+        self.pending_bytes = 0
+        self.peak_ops = 0
+        self.peak_bytes = 0
+        # Writers that had to wait for room, and those that gave up
+        self.full_waits = 0
+        self.full_timeouts = 0
+
+    @property
+    def bounded(self) -> bool:
+        return self.max_ops is not None or self.max_bytes is not None
+
+    def put(self, command, block=True, timeout=None):
+        if SlaveOperationCommands.is_replicated(command):
+            with self._lag_condition:
+                self.pending_ops += 1
+                self.pending_bytes += SlaveOperationCommands.payload_size(command)
+                self.peak_ops = max(self.peak_ops, self.pending_ops)
+                self.peak_bytes = max(self.peak_bytes, self.pending_bytes)
+        super().put(command, block, timeout)
+
+    def applied(self, command: SlaveOperationCommands.Command):
+        if not SlaveOperationCommands.is_replicated(command):
+            return
+        with self._lag_condition:
+            self.pending_ops -= 1
+            self.pending_bytes -= SlaveOperationCommands.payload_size(command)
+            self._lag_condition.notify_all()
+
+    def batch_applied(self):
+        # Called by the slave after each batch of applied commands.
+        pass
+
+    def lag(self) -> dict:
+        with self._lag_condition:
+            return {'ops': self.pending_ops, 'bytes': self.pending_bytes}
+
+    def occupancy(self) -> dict:
+        with self._lag_condition:
+            return {
+                'peak_ops': self.peak_ops,
+                'peak_bytes': self.peak_bytes,
+                'full_waits': self.full_waits,
+                'full_timeouts': self.full_timeouts,
+            }
+
+    def wait_for_room(self, nbytes: int, timeout: typing.Optional[float] = None) -> bool:
+        """
+        Waits until one more command of nbytes payload fits within max_ops
+        and max_bytes, for at most timeout seconds; False if it still does
+        not. A command larger than max_bytes fits once nothing else is
+        pending.
+        """
+        def has_room():
+            if not self.pending_ops:
+                return True
+            return (self.max_ops is None or self.pending_ops < self.max_ops) and \
+                   (self.max_bytes is None or self.pending_bytes + nbytes <= self.max_bytes)
+
+        with self._lag_condition:
+            if has_room():
+                return True
+            self.full_waits += 1
+            if self._lag_condition.wait_for(has_room, timeout):
+                return True
+            self.full_timeouts += 1
+            return False
+
+    def wait_for_lag(self,
+                     max_ops: typing.Optional[int] = None,
+                     max_bytes: typing.Optional[int] = None,
+                     timeout: typing.Optional[float] = None,
+                     ) -> bool:
+        def below_limits():
+            return (max_ops is None or self.pending_ops < max_ops) and \
+                   (max_bytes is None or self.pending_bytes < max_bytes)
+
+        with self._lag_condition:
+            return self._lag_condition.wait_for(below_limits, timeout)
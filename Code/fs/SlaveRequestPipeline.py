@@ -3,19 +3,58 @@ import typing
 
 
 class SlaveRequestPipeline:
-    _slave_lock = threading.Lock()
-    _master_lock = threading.Lock()
-    result: 'typing.Any' = None
+    """
+    Completion object for a single request handed to a slave. The slave
+    calls provide() or fail(); the requester blocks in get() until one of
+    them has happened.
+    """
 
-    def get(self) -> 'typing.Any':
-        self._master_lock.acquire()
-        result = self.result
-        if self._slave_lock.locked():
-            self._slave_lock.release()
-        return result
+    def __init__(self):
+        # Held until the request completes, then passed on from waiter to
+        # waiter; much cheaper to create than an Event, and one is created
+        # for every read.
+        self._latch = threading.Lock()
+        self._latch.acquire()
+        self._done = False
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.result: 'typing.Any' = None
+        self.exception: typing.Optional[BaseException] = None
+
+    def done(self) -> bool:
+        return self._done
+
+    def get(self, timeout: typing.Optional[float] = None) -> 'typing.Any':
+        if not self._done:
+            if not self._latch.acquire(timeout=-1 if timeout is None else timeout):
+                raise TimeoutError('Slave did not answer in time')
+            self._latch.release()
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def on_done(self, callback: typing.Callable[['SlaveRequestPipeline'], None]):
+        # Runs callback once the request completes, right away if it
+        # already has.
+        with self._lock:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
 
     def provide(self, result: 'typing.Any'):
-        self._slave_lock.acquire()
         self.result = result
-        if self._master_lock.locked():
-            self._master_lock.release()
+        self._complete()
+
+    def fail(self, exception: BaseException):
+        self.exception = exception
+        self._complete()
+
+    def _complete(self):
+        with self._lock:
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = []
+        self._latch.release()
+        for callback in callbacks:
+            callback(self)
@@ -0,0 +1,114 @@
+from fuse import Operations, FuseOSError
+from typing import Callable, Dict
+import errno
+import itertools
+import os
+import stat
+import threading
+import time
+
+
+STATS_DIR = '/.replicafs'
+
+_PAGE = 4096
+
+
+def is_stats_path(op: str, args: tuple) -> bool:
+    if op in ('rename', 'link'):
+        paths = args[:2]
+    elif op == 'symlink':
+        paths = args[1:2]
+    else:
+        paths = args[:1]
+    return any(isinstance(path, str) and (path == STATS_DIR or path.startswith(STATS_DIR + '/'))
+               for path in paths)
+
+
+class StatsFiles(Operations):
+    """
+    Virtual directory STATS_DIR of the master mount. Each file is rendered
+    when it is opened and read from that snapshot until released. Files
+    with a control are also writable: every line written to them is passed
+    to it, and a line it rejects with ValueError fails the write with
+    EINVAL.
+    """
+
+    def __init__(self, files: Dict[str, Callable[[], bytes]], controls: Dict[str, Callable[[str], None]] = None):
+        self.files = files
+        self.controls = controls or {}
+        self._lock = threading.Lock()
+        self._snapshots: Dict[int, bytes] = {}
+        self._fhs = itertools.count(1)
+
+    def _render(self, path) -> bytes:
+        render = self.files.get(path[len(STATS_DIR) + 1:])
+        if render is None:
+            raise FuseOSError(errno.ENOENT)
+        return render()
+
+    def _control(self, path) -> Callable[[str], None]:
+        control = self.controls.get(path[len(STATS_DIR) + 1:])
+        if control is None:
+            raise FuseOSError(errno.EROFS)
+        return control
+
+    def access(self, path, mode):
+        if path != STATS_DIR:
+            self._render(path)
+        if mode & os.W_OK:
+            self._control(path)
+
+    def getattr(self, path, fh=None):
+        now = time.time()
+        attrs = dict(st_atime=now, st_ctime=now, st_mtime=now, st_uid=os.getuid(), st_gid=os.getgid())
+        if path == STATS_DIR:
+            return dict(attrs, st_mode=stat.S_IFDIR | 0o555, st_nlink=2, st_size=0)
+        # The contents change from one rendering to the next, so the size
+        # is a bound with a page to spare; the short read at the actual end
+        # tells the kernel where the file stops.
+        size = (len(self._render(path)) // _PAGE + 2) * _PAGE
+        mode = 0o644 if path[len(STATS_DIR) + 1:] in self.controls else 0o444
+        return dict(attrs, st_mode=stat.S_IFREG | mode, st_nlink=1, st_size=size)
+
+    def readdir(self, path, fh):
+        if path != STATS_DIR:
+            raise FuseOSError(errno.ENOTDIR)
+        return ['.', '..'] + sorted(self.files)
+
+    def open(self, path, flags):
+        if flags & os.O_ACCMODE != os.O_RDONLY:
+            self._control(path)
+        data = self._render(path)
+        with self._lock:
+            fh = next(self._fhs)
+            self._snapshots[fh] = data
+        return fh
+
+    def read(self, path, length, offset, fh):
+        with self._lock:
+            data = self._snapshots.get(fh)
+        if data is None:
+            data = self._render(path)
+        return data[offset:offset + length]
+
+    def write(self, path, buf, offset, fh):
+        control = self._control(path)
+        for line in bytes(buf).decode(errors='replace').splitlines():
+            if not line.strip():
+                continue
+            try:
+                control(line.strip())
+            except ValueError:
+                raise FuseOSError(errno.EINVAL)
+            except OSError as e:
+                raise FuseOSError(e.errno or errno.EIO)
+        return len(buf)
+
+    def truncate(self, path, length, fh=None):
+        # Opening for writing truncates; there is nothing to cut.
+        self._control(path)
+
+    def release(self, path, fh):
+        with self._lock:
+            self._snapshots.pop(fh, None)
+        return 0
@@ -0,0 +1,59 @@
+import os
+
+
+class Watermark:
+    """
+    Highest sequence number of the replication journal applied by a slave,
+    kept in a file rewritten in place by a single write every time it
+    moves: a crash of the process loses at most the last operation's
+    record, and applying that operation once more changes nothing. journal
+    is the id of the journal the sequence numbers belong to, '' when the
+    file lives in the journal itself. Without a path it is only kept in
+    memory.
+    """
+
+    # Fixed width, so every write replaces the whole record
+    _FORMAT = '{journal:32} {seq:020d}\n'
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.journal = ''
+        self.seq = 0
+        self._fd = None
+        if path is None:
+            return
+        try:
+            with open(path) as f:
+                record = f.read()
+        except FileNotFoundError:
+            record = ''
+        if record:
+            journal, _, seq = record.rpartition(' ')
+            self.journal = journal.strip()
+            self.seq = int(seq)
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+
+    def mark(self, seq: int):
+        if seq is not None and seq > self.seq:
+            self.set(seq)
+
+    def set(self, seq: int):
+        self.seq = seq
+        if self._fd is not None:
+            os.pwrite(self._fd, self._FORMAT.format(journal=self.journal, seq=seq).encode(), 0)
+
+    def follow(self, journal: str) -> bool:
+        """
+        Switches to the journal with id journal; the sequence numbers of
+        another one say nothing about it. True if it was followed already.
+        """
+        if journal == self.journal:
+            return True
+        self.journal = journal
+        self.set(0)
+        return False
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,91 @@
+from typing import Dict, List, Optional
+import time
+
+from . import SlaveOperationCommands
+
+
+class WriteCoalescer:
+    """
+    Holds back the most recent write of each handle so that following
+    writes to the same handle which touch or overlap it can be merged into
+    one command. A held write is released once it reaches max_bytes, at the
+    next barrier, or max_delay seconds after it was first held.
+    """
+
+    def __init__(self, max_bytes: int, max_delay: float):
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        # Handle -> held write, in the order the writes were first held
+        self.pending: Dict[int, SlaveOperationCommands.Write] = {}
+        self._held_since: Dict[int, float] = {}
+        self.merged = 0
+        self.dispatched = 0
+
+    def add(self, command: SlaveOperationCommands.Write) -> List[SlaveOperationCommands.Write]:
+        pending = self.pending.get(command.fh)
+        if pending is not None and self._can_merge(pending, command):
+            self._merge(pending, command)
+            self.merged += 1
+            return self._flush_if_full(command.fh)
+
+        # A write held for another handle on the same file must reach the
+        # slaves first, in case the two overlap.
+        ready = self.flush(command.fh)
+        for fh in [fh for fh, held in self.pending.items() if held.path == command.path]:
+            ready += self.flush(fh)
+        self.pending[command.fh] = command
+        self._held_since[command.fh] = time.monotonic()
+        return ready + self._flush_if_full(command.fh)
+
+    def flush(self, fh: Optional[int] = None) -> List[SlaveOperationCommands.Write]:
+        """Releases the write held for fh, or every held write."""
+        if fh is None:
+            return [command for fh in list(self.pending) for command in self.flush(fh)]
+
+        command = self.pending.pop(fh, None)
+        if command is None:
+            return []
+        del self._held_since[fh]
+        self.dispatched += 1
+        if isinstance(command.buf, bytearray):
+            # Every slave reads the merged buffer in place; nothing may
+            # change it once it is dispatched.
+            command.buf = memoryview(command.buf).toreadonly()
+        return [command]
+
+    def expired(self) -> List[SlaveOperationCommands.Write]:
+        """Releases the writes held for max_delay seconds or more."""
+        deadline = time.monotonic() - self.max_delay
+        return [
+            command for fh, since in list(self._held_since.items()) if since <= deadline
+            for command in self.flush(fh)
+        ]
+
+    def stats(self) -> dict:
+        return {'merged': self.merged, 'dispatched': self.dispatched}
+
+    def _flush_if_full(self, fh: int) -> List[SlaveOperationCommands.Write]:
+        if len(self.pending[fh].buf) >= self.max_bytes:
+            return self.flush(fh)
+        return []
+
+    @staticmethod
+    def _can_merge(pending: SlaveOperationCommands.Write, command: SlaveOperationCommands.Write) -> bool:
+        if pending.fh != command.fh or pending.path != command.path:
+            return False
+        return command.offset <= pending.offset + len(pending.buf) and \
+            pending.offset <= command.offset + len(command.buf)
+
+    @staticmethod
+    def _merge(pending: SlaveOperationCommands.Write, command: SlaveOperationCommands.Write):
+        if not isinstance(pending.buf, bytearray):
+            pending.buf = bytearray(pending.buf)
+
+        if command.offset < pending.offset:
+            pending.buf[0:0] = bytes(pending.offset - command.offset)
+            pending.offset = command.offset
+
+        # Later data wins where the two writes overlap, exactly as it would
+        # if both were applied in order.
+        start = command.offset - pending.offset
+        pending.buf[start:start + len(command.buf)] = command.buf
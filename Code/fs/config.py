@@ -1,5 +1,23 @@
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+REPLICATION_SYNC = 'sync'
+REPLICATION_QUORUM = 'quorum'
+REPLICATION_ASYNC = 'async'
+REPLICATION_MODES = [REPLICATION_SYNC, REPLICATION_QUORUM, REPLICATION_ASYNC]
+
+READ_ROUND_ROBIN = 'round-robin'
+READ_LEAST_OUTSTANDING = 'least-outstanding'
+READ_EWMA = 'ewma'
+READ_POLICIES = [READ_ROUND_ROBIN, READ_LEAST_OUTSTANDING, READ_EWMA]
+
+DURABILITY_FSYNC = 'fsync'
+DURABILITY_FDATASYNC = 'fdatasync'
+DURABILITY_GROUP = 'group'
+DURABILITY_NONE = 'none'
+DURABILITY_POLICIES = [DURABILITY_FSYNC, DURABILITY_FDATASYNC, DURABILITY_GROUP, DURABILITY_NONE]
+SLAVE_DURABILITY_POLICIES = DURABILITY_POLICIES
 
 
 @dataclass
@@ -10,3 +28,152 @@ class ReplicaFSConfig:
     slave_backings: List[str]
 
     nbr_slaves: int
+
+    # Addresses (host:port or unix:/path) of slave daemons on other nodes.
+    # They are counted in nbr_slaves and numbered after the local slaves.
+    remote_slaves: List[str] = field(default_factory=list)
+    # Secret the master proves it knows to the slave daemons that ask for
+    # it, those attached later included.
+    remote_secret: Optional[bytes] = field(default=None, repr=False)
+
+    # sync waits for every slave, quorum for write_quorum of them and async
+    # for none; async writers are held back once a slave lags by
+    # max_lag_ops operations or max_lag_bytes payload bytes. A writer fails
+    # with EIO when the acks it waits for have not come after ack_timeout
+    # seconds, or can no longer come as slaves disconnected (None waits as
+    # long as it takes).
+    replication_mode: str = REPLICATION_SYNC
+    write_quorum: Optional[int] = None
+    ack_timeout: Optional[float] = 60.0
+    max_lag_ops: Optional[int] = None
+    max_lag_bytes: Optional[int] = None
+
+    # Keep every file on replication_factor of the slaves, chosen by
+    # consistent hashing, instead of on all of them; directories are on all.
+    # Quorums count the owners of the file only.
+    replication_factor: Optional[int] = None
+
+    # Bound, in every replication mode, on the operations and payload bytes
+    # the master holds for a slave that has not applied them yet; writers
+    # wait for room, and fail with EAGAIN after queue_timeout seconds (None
+    # waits as long as it takes).
+    queue_max_ops: Optional[int] = None
+    queue_max_bytes: Optional[int] = None
+    queue_timeout: Optional[float] = None
+
+    # Serve each mount from several FUSE threads; slaves then also answer
+    # reads from the master on slave_read_threads worker threads.
+    threaded: bool = False
+    slave_read_threads: int = 4
+
+    # How reads through the master are spread over the slaves
+    read_policy: str = READ_ROUND_ROBIN
+
+    # A slave that leaves a heartbeat unanswered for slave_timeout seconds,
+    # fails reads in a row or is far slower than the others serves no reads
+    # until it has recovered; with no slave left reads go to the master's
+    # backing store. A read is sent again to another slave when the first
+    # has not answered within slave_timeout, or within its p95 read latency
+    # with hedge_reads.
+    slave_timeout: float = 10.0
+    hedge_reads: bool = False
+
+    # Reads of at least stripe_threshold bytes are split into stripes of
+    # stripe_bytes fetched from several slaves at once; 0 disables striping.
+    stripe_threshold: int = 0
+    stripe_bytes: int = 256 * 1024
+
+    # Bytes kept in flight ahead of a handle that is read sequentially;
+    # 0 disables readahead.
+    readahead_bytes: int = 0
+
+    # Byte budget of the master's read block cache; 0 disables it.
+    cache_bytes: int = 0
+    cache_block_size: int = 64 * 1024
+
+    # Number of getattr results and directory listings each mount caches;
+    # 0 disables the metadata cache.
+    metadata_cache_entries: int = 0
+
+    # Merge contiguous writes to a handle into dispatches of up to this many
+    # bytes before they reach the slaves; 0 replicates every write as is. A
+    # write is held back for coalesce_ms at most. Async replication only, as
+    # a held write has returned before any slave or the journal has it.
+    coalesce_bytes: int = 0
+    coalesce_ms: float = 10.0
+
+    # Directory of the replication journal; None keeps commands in memory only.
+    journal_path: Optional[str] = None
+    journal_segment_bytes: int = 64 * 1024 * 1024
+
+    # What flush and fsync do on the master: fsync or fdatasync the handle,
+    # fdatasync the handles flushed within group_commit_ms of each other
+    # together (group) or nothing (none). Slaves sync the handles the master
+    # released with slave_durability after each batch of applied commands.
+    durability: str = DURABILITY_FSYNC
+    slave_durability: str = DURABILITY_NONE
+    group_commit_ms: float = 2.0
+
+    # Store slave file contents as content-addressed chunks of this many
+    # bytes, each identical chunk once; 0 keeps plain copies of the files.
+    slave_chunk_bytes: int = 0
+
+    # Drop from each batch of commands a slave takes from its queue those
+    # that later commands of the batch make irrelevant (overwritten writes,
+    # files created and unlinked again, repeated chmods and truncates).
+    slave_compaction: bool = False
+
+    # Check the slaves' copies against the master every scrub_interval
+    # seconds (None disables scrubbing), comparing blocks of scrub_block_bytes
+    # on scrub_workers threads that read at most scrub_rate_bytes a second;
+    # blocks that differ are rewritten from the master.
+    scrub_interval: Optional[float] = None
+    scrub_block_bytes: int = 64 * 1024
+    scrub_workers: int = 2
+    scrub_rate_bytes: int = 32 * 1024 * 1024
+
+    # Directory holding the persisted hash trees used to resync slaves;
+    # None disables tracking on the master.
+    merkle_path: Optional[str] = None
+
+    # Run every slave in its own process; write payloads are handed over
+    # through a shared memory ring of shm_ring_bytes per slave.
+    slave_processes: bool = False
+    shm_ring_bytes: int = 64 * 1024 * 1024
+
+    def __post_init__(self):
+        if self.replication_mode not in REPLICATION_MODES:
+            raise ValueError(f'Unknown replication mode {self.replication_mode}')
+        if self.read_policy not in READ_POLICIES:
+            raise ValueError(f'Unknown read policy {self.read_policy}')
+        if self.durability not in DURABILITY_POLICIES:
+            raise ValueError(f'Unknown durability policy {self.durability}')
+        if self.slave_durability not in SLAVE_DURABILITY_POLICIES:
+            raise ValueError(f'Unknown slave durability policy {self.slave_durability}')
+        if self.slave_chunk_bytes < 0:
+            raise ValueError('Chunk size must not be negative')
+        if self.slave_timeout <= 0:
+            raise ValueError('Slave timeout must be positive')
+        if self.ack_timeout is not None and self.ack_timeout <= 0:
+            raise ValueError('Ack timeout must be positive')
+        if self.scrub_block_bytes <= 0 or self.scrub_workers <= 0:
+            raise ValueError('Scrub block size and workers must be positive')
+        if any(value is not None and value <= 0 for value in (self.queue_max_ops, self.queue_max_bytes,
+                                                               self.queue_timeout)):
+            raise ValueError('Queue bounds and timeout must be positive')
+        if self.coalesce_bytes > 0:
+            if self.coalesce_ms <= 0:
+                raise ValueError('Coalescing delay must be positive')
+            if self.replication_mode != REPLICATION_ASYNC or self.journal_path is not None:
+                raise ValueError('Write coalescing needs async replication without the replication journal')
+        if self.stripe_bytes <= 0:
+            raise ValueError('Stripe size must be positive')
+        if self.replication_mode == REPLICATION_QUORUM and \
+                not (self.write_quorum and 1 <= self.write_quorum <= self.nbr_slaves):
+            raise ValueError(f'Write quorum must be between 1 and {self.nbr_slaves}')
+        if self.replication_factor is not None:
+            if not 1 <= self.replication_factor <= self.nbr_slaves:
+                raise ValueError(f'Replication factor must be between 1 and {self.nbr_slaves}')
+            if self.journal_path is not None:
+                # Replay cannot tell which slaves own a file.
+                raise ValueError('A replication factor cannot be used with the replication journal')
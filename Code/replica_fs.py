@@ -1,5 +1,4 @@
 from fuse import FUSE
-from queue import Queue
 from typing import List
 import click
 import logging
@@ -7,9 +6,16 @@ import os
 import pathlib
 import threading
 
+from fs.ChunkedReplicaFSSlave import make_slave
+from fs.MerkleTree import MerkleTree, resync_backing_store, state_path_for
 from fs.ReplicaFSMaster import ReplicaFSMaster
-from fs.ReplicaFSSlave import ReplicaFSSlave
-from fs.config import ReplicaFSConfig
+from fs.RemoteSlave import RemoteSlaveProxy
+from fs.ReplicationJournal import ReplicationJournal
+from fs.ReplicationProtocol import connect, read_secret
+from fs.SlaveProcess import SlaveProcessProxy
+from fs.SlaveQueue import SlaveQueue
+from fs.config import ReplicaFSConfig, DURABILITY_FSYNC, DURABILITY_NONE, DURABILITY_POLICIES, READ_POLICIES, \
+    READ_ROUND_ROBIN, REPLICATION_MODES, REPLICATION_SYNC, SLAVE_DURABILITY_POLICIES
 import constants
 
 
@@ -31,15 +37,32 @@ def create_dirs(config: ReplicaFSConfig):
     for mp in config.slave_backings:
         pathlib.Path(mp).mkdir(parents=True, exist_ok=True)
 
+    if config.merkle_path is not None:
+        pathlib.Path(config.merkle_path).mkdir(parents=True, exist_ok=True)
+
+
+def resync_slaves(config: ReplicaFSConfig, journal: ReplicationJournal):
+    master_tree = MerkleTree(
+        config.master_backing, state_path_for(config.merkle_path, config.master_backing),
+    )
+
+    for n, slave_backing in enumerate(config.slave_backings):
+        slave_tree = MerkleTree(slave_backing, state_path_for(config.merkle_path, slave_backing))
+        _, stats = resync_backing_store(master_tree, slave_tree)
+        print(f'Slave {n} resynchronised: {stats}', flush=True)
+        if journal is not None:
+            journal.skip_to(n, journal.recovered_seq)
+
 
 def create_master_fuse(
         config: ReplicaFSConfig,
         foreground: bool,
-        queues: List[Queue],
+        queues: List[SlaveQueue],
+        journal: ReplicationJournal,
 ):
-    fs = ReplicaFSMaster(config, queues=queues, nbr_slaves=config.nbr_slaves)
+    fs = ReplicaFSMaster(config, queues=queues, nbr_slaves=config.nbr_slaves, journal=journal)
     print(f'Master FUSE initializing foreground={foreground}', flush=True)
-    FUSE(fs, config.master_mount_point, nothreads=True, foreground=foreground)
+    FUSE(fs, config.master_mount_point, nothreads=not config.threaded, foreground=foreground)
     print(f'Master FUSE initialized foreground={foreground}', flush=True)
 
 
@@ -47,15 +70,16 @@ def create_slave_fuse(
         config: ReplicaFSConfig,
         n: int,
         foreground: bool,
-        queues: List[Queue],
+        queues: List[SlaveQueue],
         logger: logging.Logger,
+        journal: ReplicationJournal,
 ):
-    fs = ReplicaFSSlave(config, queue=queues[n], slave_n=n, logger=logger)
+    fs = make_slave(config, queue=queues[n], slave_n=n, logger=logger, journal=journal)
     print(f'Slave FUSE initializing foreground={foreground}', flush=True)
     FUSE(
         fs,
         config.slave_mount_points[n],
-        nothreads=True,
+        nothreads=not config.threaded,
         foreground=foreground,
     )
     print(f'Slave FUSE initialized foreground={foreground}', flush=True)
@@ -86,8 +110,210 @@ def create_logger() -> logging.Logger:
     default=1,
     help='Number of slaves'
 )
+@click.option(
+    '--remote-slave',
+    multiple=True,
+    help='Address of a slave daemon (host:port or unix:/path), in addition to the local slaves; repeatable'
+)
+@click.option(
+    '--secret-file',
+    default=None,
+    help='File holding the secret slave daemons started with --secret-file check'
+)
+@click.option(
+    '--replication',
+    'replication_mode',
+    type=click.Choice(REPLICATION_MODES),
+    default=REPLICATION_SYNC,
+    help='Wait for all slaves (sync), for --write-quorum slaves (quorum) or for none (async)'
+)
+@click.option(
+    '--write-quorum',
+    type=int,
+    default=None,
+    help='Number of slaves that must apply a write in quorum mode'
+)
+@click.option(
+    '--replication-factor',
+    type=int,
+    default=None,
+    help='Keep every file on this many of the slaves, placed by consistent hashing (default: all of them)'
+)
+@click.option(
+    '--max-lag-ops',
+    type=int,
+    default=None,
+    help='Block writers while a slave lags by this many operations (async mode)'
+)
+@click.option(
+    '--max-lag-bytes',
+    type=int,
+    default=None,
+    help='Block writers while a slave lags by this many payload bytes (async mode)'
+)
+@click.option(
+    '--queue-max-ops',
+    type=int,
+    default=None,
+    help='Most operations held for a slave that has not applied them, in every mode'
+)
+@click.option(
+    '--queue-max-bytes',
+    type=int,
+    default=None,
+    help='Most payload bytes held for a slave that has not applied them, in every mode'
+)
+@click.option(
+    '--ack-timeout',
+    type=float,
+    default=60.0,
+    help='Seconds a writer waits for the slaves to apply its operation before failing with EIO'
+)
+@click.option(
+    '--queue-timeout',
+    type=float,
+    default=None,
+    help='Seconds a writer waits for room in a full slave queue before failing with EAGAIN'
+)
+@click.option(
+    '--threads',
+    'threaded',
+    default=False,
+    is_flag=True,
+    help='Serve every mount from multiple FUSE threads'
+)
+@click.option(
+    '--read-policy',
+    type=click.Choice(READ_POLICIES),
+    default=READ_ROUND_ROBIN,
+    help='How reads through the master are spread over the slaves'
+)
+@click.option(
+    '--slave-timeout',
+    default=10.0,
+    help='Seconds a slave may leave a heartbeat or read unanswered before reads go elsewhere'
+)
+@click.option(
+    '--hedge-reads',
+    default=False,
+    is_flag=True,
+    help='Send a read to a second slave when the first has not answered within its p95 latency'
+)
+@click.option(
+    '--stripe-threshold',
+    default=0,
+    help='Split reads of at least this many bytes into stripes read from several slaves (0 disables)'
+)
+@click.option(
+    '--stripe-bytes',
+    default=256 * 1024,
+    help='Size of a read stripe'
+)
+@click.option(
+    '--readahead-bytes',
+    default=0,
+    help='Bytes fetched ahead of a handle that is read sequentially (0 disables)'
+)
+@click.option(
+    '--cache-bytes',
+    default=0,
+    help='Byte budget of the master read block cache (0 disables)'
+)
+@click.option(
+    '--metadata-cache',
+    'metadata_cache_entries',
+    default=0,
+    help='Number of getattr results and directory listings cached per mount (0 disables)'
+)
+@click.option(
+    '--coalesce-bytes',
+    default=0,
+    help='Merge contiguous writes to a handle into dispatches of up to this many bytes '
+         '(async replication without --journal only, 0 disables)'
+)
+@click.option(
+    '--coalesce-ms',
+    default=10.0,
+    help='Longest time a write is held back for coalescing'
+)
+@click.option(
+    '--journal',
+    'journal_path',
+    default=None,
+    help='Directory of the on-disk replication journal replayed by slaves on restart'
+)
+@click.option(
+    '--durability',
+    type=click.Choice(DURABILITY_POLICIES),
+    default=DURABILITY_FSYNC,
+    help='What flush and fsync do on the master'
+)
+@click.option(
+    '--slave-durability',
+    type=click.Choice(SLAVE_DURABILITY_POLICIES),
+    default=DURABILITY_NONE,
+    help='How slaves sync the files the master closed'
+)
+@click.option(
+    '--slave-chunk-bytes',
+    default=0,
+    help='Store slave files as deduplicated chunks of this many bytes (0 keeps plain copies)'
+)
+@click.option(
+    '--slave-compaction',
+    default=False,
+    is_flag=True,
+    help='Skip queued commands that later queued commands make irrelevant on the slaves'
+)
+@click.option(
+    '--group-commit-ms',
+    default=2.0,
+    help='Time the group durability policy waits for other flushes to join a sync'
+)
+@click.option(
+    '--scrub-interval',
+    default=None,
+    type=float,
+    help='Check the slaves against the master every this many seconds and repair what differs'
+)
+@click.option(
+    '--scrub-rate-bytes',
+    default=32 * 1024 * 1024,
+    help='Bytes per second the scrubber reads at most (0 for no limit)'
+)
+@click.option(
+    '--scrub-workers',
+    default=2,
+    help='Threads checking ranges of files in parallel during a scrub'
+)
+@click.option(
+    '--resync',
+    default=False,
+    is_flag=True,
+    help='Bring the slave backing stores up to date with the master before mounting (implies --track-changes)'
+)
+@click.option(
+    '--track-changes',
+    default=False,
+    is_flag=True,
+    help='Keep a hash tree of the master backing store so that the next --resync only reads the blocks written'
+)
+@click.option(
+    '--slave-processes',
+    default=False,
+    is_flag=True,
+    help='Run every slave in its own process'
+)
+@click.option(
+    '--shm-bytes',
+    'shm_ring_bytes',
+    default=64 * 1024 * 1024,
+    help='Size of the shared memory ring handing write payloads to each slave process'
+)
 @click.argument('backing_store')
-def init_replica_fs(foreground: bool, backing_store: str, nbr_slaves: int):
+def init_replica_fs(foreground: bool, backing_store: str, nbr_slaves: int, remote_slave: List[str], secret_file: str,
+                    resync: bool, track_changes: bool, **options):
+    # Every other option is named after the configuration field it sets.
     config = ReplicaFSConfig(
         master_mount_point=constants.MASTER_MOUNT_PATH,
         master_backing=os.path.join(
@@ -104,21 +330,53 @@ def init_replica_fs(foreground: bool, backing_store: str, nbr_slaves: int):
             ),
             n=nbr_slaves,
         ),
-        nbr_slaves=nbr_slaves,
+        nbr_slaves=nbr_slaves + len(remote_slave),
+        remote_slaves=list(remote_slave),
+        remote_secret=read_secret(secret_file) if secret_file is not None else None,
+        merkle_path=os.path.join(backing_store, 'merkle') if resync or track_changes else None,
+        **options,
     )
     create_dirs(config)
 
-    queues: List[Queue] = []
+    replication_journal = None
+    if config.journal_path is not None:
+        replication_journal = ReplicationJournal(
+            config.journal_path, config.nbr_slaves, segment_bytes=config.journal_segment_bytes,
+        )
+
+    if resync:
+        if config.slave_chunk_bytes:
+            raise click.UsageError('--resync compares plain file copies and cannot be used with --slave-chunk-bytes')
+        if config.replication_factor is not None:
+            raise click.UsageError('--resync copies every file to every slave and cannot be used with '
+                                   '--replication-factor')
+        resync_slaves(config, replication_journal)
+
+    queues: List[SlaveQueue] = []
 
-    for i in range(nbr_slaves):
-        queue = Queue()
+    for i in range(config.nbr_slaves):
+        queue = SlaveQueue(config.queue_max_ops, config.queue_max_bytes)
         queues.append(queue)
 
+    for i, address in enumerate(config.remote_slaves):
+        n = nbr_slaves + i
+        RemoteSlaveProxy(n, queues[n], connect(address, config.remote_secret), journal=replication_journal).start()
+
+    if config.slave_processes:
+        # Start the slaves first; they are daemon processes and go away
+        # with the master.
+        for i in range(nbr_slaves):
+            SlaveProcessProxy(
+                config, i, queues[i], journal=replication_journal, log_file=f'replicafs.slave{i}.log',
+            ).start()
+        create_master_fuse(config, foreground, queues, replication_journal)
+        return
+
     logger = create_logger()
 
     master_thread = threading.Thread(
         target=create_master_fuse,
-        args=(config, foreground, queues),
+        args=(config, foreground, queues, replication_journal),
         daemon=True,
     )
 
@@ -126,7 +384,7 @@ def init_replica_fs(foreground: bool, backing_store: str, nbr_slaves: int):
         threading.Thread(
             target=create_slave_fuse,
             daemon=True,
-            args=(config, i, foreground, queues, logger),
+            args=(config, i, foreground, queues, logger, replication_journal),
         ) for i in range(nbr_slaves)
     ]
 
@@ -0,0 +1,134 @@
+from fuse import FUSE
+import click
+import os
+import pathlib
+import threading
+
+from fs.RemoteSlave import RemoteSlaveQueue, serve_master
+from fs.ChunkedReplicaFSSlave import make_slave
+from fs.ReplicaFSSlave import ReplicaFSSlave
+from fs.ReplicationProtocol import accept, is_local, listen, read_secret
+from fs.SlaveProcess import create_slave_logger
+from fs.Watermark import Watermark
+from fs.config import ReplicaFSConfig, DURABILITY_NONE, SLAVE_DURABILITY_POLICIES
+
+
+def serve(slave: ReplicaFSSlave, queue: RemoteSlaveQueue, address: str, secret: bytes = None):
+    server = listen(address)
+    print(f'Slave listening on {address}', flush=True)
+    while True:
+        try:
+            conn, peer = accept(server, secret)
+        except PermissionError as e:
+            print(e, flush=True)
+            continue
+        print(f'Master connected from {peer or address}', flush=True)
+        serve_master(conn, slave, queue)
+
+        # Apply and acknowledge the commands already received, then drop
+        # the handles of that master before accepting the next one.
+        queue.drain()
+        conn.close()
+        slave._forget_handles()
+        print('Master disconnected', flush=True)
+
+
+@click.command()
+@click.option(
+    '--listen',
+    'address',
+    required=True,
+    help='Address to accept the master on: host:port (host defaults to 127.0.0.1) or unix:/path/to/socket'
+)
+@click.option(
+    '--secret-file',
+    default=None,
+    help='File holding a secret the master must prove it knows; required to listen beyond this node'
+)
+@click.option(
+    '--mount-point',
+    default=None,
+    help='Also serve the replica read-only at this mount point'
+)
+@click.option(
+    '--threads',
+    default=False,
+    is_flag=True,
+    help='Serve the mount from multiple FUSE threads'
+)
+@click.option(
+    '--metadata-cache',
+    default=0,
+    help='Number of getattr results and directory listings cached (0 disables)'
+)
+@click.option(
+    '--durability',
+    type=click.Choice(SLAVE_DURABILITY_POLICIES),
+    default=DURABILITY_NONE,
+    help='How the files the master closed are synced'
+)
+@click.option(
+    '--chunk-bytes',
+    default=0,
+    help='Store files as deduplicated chunks of this many bytes (0 keeps plain copies)'
+)
+@click.option(
+    '--compaction',
+    default=False,
+    is_flag=True,
+    help='Skip queued commands that later queued commands make irrelevant'
+)
+@click.option(
+    '--watermark',
+    'watermark_path',
+    default=None,
+    help='File recording the last journal entry applied, so that a restarted slave replays only the rest'
+)
+@click.option(
+    '--log-file',
+    default='replicafs_slave.log',
+    help='Log file of the slave'
+)
+@click.argument('backing_store')
+def init_slave_daemon(address: str, secret_file: str, mount_point: str, threads: bool, metadata_cache: int,
+                      durability: str, chunk_bytes: int, compaction: bool, watermark_path: str, log_file: str,
+                      backing_store: str):
+    secret = None
+    if secret_file is not None:
+        secret = read_secret(secret_file)
+    elif not is_local(address):
+        raise click.UsageError(f'Listening on {address} takes a --secret-file')
+
+    pathlib.Path(backing_store).mkdir(parents=True, exist_ok=True)
+    if mount_point is not None:
+        pathlib.Path(mount_point).mkdir(parents=True, exist_ok=True)
+
+    # A standalone slave only uses the slave half of the configuration.
+    config = ReplicaFSConfig(
+        master_mount_point='',
+        slave_mount_points=[mount_point or ''],
+        master_backing='',
+        slave_backings=[backing_store],
+        nbr_slaves=1,
+        threaded=threads,
+        metadata_cache_entries=metadata_cache,
+        slave_durability=durability,
+        slave_chunk_bytes=chunk_bytes,
+        slave_compaction=compaction,
+    )
+    queue = RemoteSlaveQueue()
+    slave = make_slave(
+        config, queue=queue, slave_n=0, logger=create_slave_logger('replica_fs.slave', log_file),
+        watermark=Watermark(watermark_path),
+    )
+
+    if mount_point is None:
+        serve(slave, queue, address, secret)
+        return
+
+    threading.Thread(target=serve, args=(slave, queue, address, secret), daemon=True).start()
+    FUSE(slave, os.path.realpath(mount_point), nothreads=not threads, foreground=True)
+
+
+if __name__ == '__main__':
+    init_slave_daemon()
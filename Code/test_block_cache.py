@@ -0,0 +1,92 @@
+import os
+
+from fs.BlockCache import BlockCache
+from fs import SlaveOperationCommands
+
+from conftest import local_replica
+
+
+def test_block_cache_invalidation(tmp_path):
+    block = 4096
+    with local_replica(str(tmp_path), cache_bytes=1024 * 1024, cache_block_size=block) as (master, _):
+        def read_all(path):
+            fh = master.open(path, os.O_RDONLY)
+            try:
+                return master.read(path, 8 * block, 0, fh)
+            finally:
+                master.release(path, fh)
+
+        def write(path, data, offset, flags=os.O_WRONLY):
+            fh = master.open(path, flags)
+            master.write(path, data, offset, fh)
+            master.release(path, fh)
+
+        master.release('/f', master.create('/f', 0o644))
+        write('/f', b'a' * (2 * block + 100), 0)
+        assert read_all('/f') == b'a' * (2 * block + 100)
+        misses = master.cache_stats()['misses']
+        assert read_all('/f') == b'a' * (2 * block + 100)
+        assert master.cache_stats()['misses'] == misses
+
+        # Growing the file drops its cached short last block.
+        write('/f', b'b' * block, 2 * block + 100)
+        assert read_all('/f') == b'a' * (2 * block + 100) + b'b' * block
+        write('/f', b'c' * 10, block + 5)
+        assert read_all('/f')[block:block + 20] == b'a' * 5 + b'c' * 10 + b'a' * 5
+        master.truncate('/f', block + 10)
+        assert read_all('/f') == b'a' * (block + 5) + b'c' * 5
+
+        # The old and new names of a rename, an unlinked path and a file
+        # opened with O_TRUNC are read again.
+        master.rename('/f', '/g')
+        master.release('/f', master.create('/f', 0o644))
+        write('/f', b'd' * 10, 0)
+        assert read_all('/f') == b'd' * 10
+        assert read_all('/g') == b'a' * (block + 5) + b'c' * 5
+        master.unlink('/g')
+        master.release('/g', master.create('/g', 0o644))
+        write('/g', b'e' * 10, 0)
+        assert read_all('/g') == b'e' * 10
+        write('/g', b'f' * 5, 0, os.O_WRONLY | os.O_TRUNC)
+        assert read_all('/g') == b'f' * 5
+
+    # Least recently used blocks are evicted, and data fetched across an
+    # invalidation is not cached.
+    cache = BlockCache(2 * block, block)
+    data = b''.join(bytes([i]) * block for i in range(3))
+    fetch = lambda start, size: [data[i:i + block] for i in range(start, min(start + size, len(data)), block)]
+    assert cache.read('/f', 3 * block, 0, fetch) == data
+    assert cache.stats()['evictions'] == 1 and cache.stats()['blocks'] == 2
+    cache.invalidate_path('/f')
+
+    def invalidated_fetch(start, size):
+        cache.invalidate('/f', 0, 1)
+        return fetch(start, size)
+
+    assert cache.read('/f', block, 0, invalidated_fetch) == data[:block]
+    assert cache.stats()['blocks'] == 0
+
+
+def test_block_cache_read_during_write(tmp_path):
+    with local_replica(str(tmp_path), cache_bytes=1024 * 1024, cache_block_size=4096) as (master, _):
+        fh = master.create('/f', 0o644)
+        master.write('/f', b'a' * 4096, 0, fh)
+        reader = master.open('/f', os.O_RDONLY)
+        assert master.read('/f', 4096, 0, reader) == b'a' * 4096
+
+        # Another reader gets in between the write on the master and its
+        # replication.
+        notify = master._notify_slaves
+
+        def read_first(command, key=None):
+            if type(command) == SlaveOperationCommands.Write:
+                master.read('/f', 4096, 0, reader)
+            notify(command, key)
+
+        master._notify_slaves = read_first
+        master.write('/f', b'b' * 4096, 0, fh)
+        master._notify_slaves = notify
+
+        assert master.read('/f', 4096, 0, reader) == b'b' * 4096
+        master.release('/f', reader)
+        master.release('/f', fh)
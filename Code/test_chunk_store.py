@@ -0,0 +1,63 @@
+import os
+
+from fs.ChunkStore import ChunkStore, chunk_digest
+
+from conftest import local_replica, poll
+
+
+def test_chunk_store_refcounts(tmp_path):
+    chunk = 4096
+    with local_replica(str(tmp_path), nbr_slaves=1, slave_chunk_bytes=chunk) as (master, slaves):
+        slave = slaves[0]
+        store = slave.chunk_store
+
+        def settled(**expected):
+            # Released handles are committed after the batch they came in.
+            slave.queue.wait_for_lag(max_ops=1)
+            poll(lambda: all(store.stats()[key] == value for key, value in expected.items()))
+
+        def write_file(path, data, offset=0):
+            fh = master.create(path, 0o644)
+            master.write(path, data, offset, fh)
+            master.release(path, fh)
+
+        a, b, c = (bytes([i + 1]) * chunk for i in range(3))
+        write_file('/a', a + b)
+        write_file('/b', a + b)
+        settled(chunks=2, stored_bytes=2 * chunk, deduplicated_bytes=2 * chunk)
+        # Zeros are never stored.
+        write_file('/zeros', bytes(chunk))
+        settled(chunks=2, stored_bytes=2 * chunk, written_bytes=2 * chunk)
+
+        write_file('/b', c, chunk)
+        master.unlink('/a')
+        settled(chunks=2, stored_bytes=2 * chunk)
+        assert not os.path.exists(store._chunk_path(chunk_digest(b)))
+
+        # An unlinked file keeps its chunks until its last handle goes.
+        fh = master.open('/b', os.O_RDONLY)
+        master.unlink('/b')
+        settled(chunks=2)
+        assert master.read('/b', 2 * chunk, 0, fh) == a + c
+        master.release('/b', fh)
+        settled(chunks=0, stored_bytes=0)
+
+        # A restarted slave counts the references of its manifests again
+        # and drops the chunks none of them lists.
+        write_file('/d', a + a)
+        settled(chunks=1)
+        # The manifest replaces the old one after the chunks are stored.
+        poll(lambda: chunk_digest(a) in list(slave._manifest_digests()))
+        orphan = store._chunk_path(chunk_digest(b))
+        os.makedirs(os.path.dirname(orphan), exist_ok=True)
+        with open(orphan, 'wb') as f:
+            f.write(b)
+        rebuilt = ChunkStore(store.path)
+        rebuilt.rebuild(slave._manifest_digests())
+        assert rebuilt.stats()['chunks'] == 1
+        assert rebuilt.stats()['stored_bytes'] == chunk
+        assert not os.path.exists(orphan)
+        rebuilt.release(chunk_digest(a))
+        assert os.path.exists(rebuilt._chunk_path(chunk_digest(a)))
+        rebuilt.release(chunk_digest(a))
+        assert not os.path.exists(rebuilt._chunk_path(chunk_digest(a)))
@@ -0,0 +1,75 @@
+import os
+import pytest
+import time
+
+from fs.SlaveOperationCommands import Write
+from fs.WriteCoalescer import WriteCoalescer
+from fs.config import REPLICATION_ASYNC
+
+from conftest import assert_same_tree, local_config, local_replica, poll
+
+
+def test_write_coalescing():
+    coalescer = WriteCoalescer(max_bytes=10, max_delay=60)
+    assert coalescer.add(Write('/f', b'abcd', 0, 3)) == []
+    # Later data wins where writes overlap, and touching writes are merged.
+    assert coalescer.add(Write('/f', b'XY', 2, 3)) == []
+    assert coalescer.add(Write('/f', b'ef', 4, 3)) == []
+    # Every handle has a write of its own held.
+    assert coalescer.add(Write('/g', b'z', 1, 4)) == []
+    (held,) = coalescer.add(Write('/f', b'gap', 20, 3))
+    assert (held.path, held.offset, bytes(held.buf)) == ('/f', 0, b'abXYef')
+    # Once max_bytes are held they go at once.
+    (held,) = coalescer.add(Write('/g', b'y' * 9, 2, 4))
+    assert (held.offset, bytes(held.buf)) == (1, b'z' + b'y' * 9)
+    # A write through another handle on the same file goes after the one
+    # held for the first.
+    (held,) = coalescer.add(Write('/f', b'h', 0, 5))
+    assert (held.fh, bytes(held.buf)) == (3, b'gap')
+    assert [command.fh for command in coalescer.flush()] == [5]
+    assert coalescer.stats() == {'merged': 3, 'dispatched': 4}
+
+    coalescer = WriteCoalescer(max_bytes=10, max_delay=0.05)
+    coalescer.add(Write('/f', b'a', 0, 3))
+    assert coalescer.expired() == []
+    time.sleep(0.06)
+    assert [bytes(command.buf) for command in coalescer.expired()] == [b'a']
+
+
+def test_coalesced_writes_flushed_in_order(tmp_path):
+    # A held write has returned before the slaves have it, which only async
+    # replication allows.
+    with pytest.raises(ValueError):
+        local_config(str(tmp_path), coalesce_bytes=1024)
+    with pytest.raises(ValueError):
+        local_config(str(tmp_path), coalesce_bytes=1024, replication_mode=REPLICATION_ASYNC,
+                     journal_path=str(tmp_path / 'journal'))
+
+    settings = dict(coalesce_bytes=1024 * 1024, replication_mode=REPLICATION_ASYNC)
+    with local_replica(str(tmp_path), **settings) as (master, slaves):
+        fh = master.create('/f', 0o644)
+        for i in range(8):
+            master.write('/f', bytes([i]) * 100, i * 100, fh)
+        # The writes held back reach the slaves before what follows them.
+        master.truncate('/f', 250, fh)
+        master.write('/f', b'end', 250, fh)
+        master.rename('/f', '/g')
+        master.write('/g', b'after', 253, fh)
+        master.release('/g', fh)
+        for slave in slaves:
+            slave.queue.wait_for_lag(max_ops=1)
+
+        assert master.coalescing_stats()['merged'] == 7
+        assert_same_tree(master.backing_store, [slave.backing_store for slave in slaves])
+        with open(os.path.join(slaves[0].backing_store, 'g'), 'rb') as f:
+            assert f.read() == bytes(100) + b'\x01' * 100 + b'\x02' * 50 + b'endafter'
+
+    # Without a barrier, a held write still reaches the slaves after
+    # coalesce_ms.
+    with local_replica(str(tmp_path / 'delay'), coalesce_ms=20, **settings) as (master, slaves):
+        fh = master.create('/f', 0o644)
+        master.write('/f', b'held', 0, fh)
+        for slave in slaves:
+            path = os.path.join(slave.backing_store, 'f')
+            poll(lambda: os.path.exists(path) and os.path.getsize(path) == 4)
+        master.release('/f', fh)
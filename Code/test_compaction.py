@@ -0,0 +1,152 @@
+import os
+import pytest
+import stat
+
+from fs.CommandCompactor import CommandCompactor, Compacted
+from fs.SlaveOperationCommands import Checksum, Chmod, Create, Open, Ping, Read, Release, Rename, Truncate, Unlink, \
+    Write
+from fs.SlaveRequestPipeline import SlaveRequestPipeline
+from fs.config import REPLICATION_ASYNC
+
+from conftest import assert_same_tree, local_replica, poll, stall_slave
+
+
+def compact(commands: list, exists=lambda path: False) -> list:
+    # What the slave applies, after checking every command is accounted for
+    compacted = CommandCompactor(exists).compact(commands)
+    accounted = [command for item in compacted for command in (item.replaces if isinstance(item, Compacted) else [item])]
+    assert sorted(map(id, accounted)) == sorted(map(id, [command for command in commands if command is not None]))
+    return [item.command if isinstance(item, Compacted) else item for item in compacted]
+
+
+def test_command_compaction():
+    commands = [
+        Create('/tmp', 0o644, None, 3),
+        Write('/tmp', b'a' * 10, 0, 3),
+        Write('/tmp', b'b' * 20, 0, 3),
+        Release('/tmp', 3),
+        Rename('/tmp', '/file'),
+        Unlink('/file'),
+        # The same handle number again, for another file
+        Open('/kept', os.O_WRONLY, 3),
+        Write('/kept', b'c' * 10, 5, 3),
+        Write('/kept', b'd' * 10, 0, 3),
+        Write('/kept', b'e' * 20, 0, 3),
+        Release('/kept', 3),
+    ]
+    assert compact(commands) == [Unlink('/file'), None, commands[6], commands[9], commands[10]]
+
+
+def test_compaction_of_handle_opened_before_batch():
+    commands = [
+        # Handle 7 is in the slave's fd_map.
+        Write('/outer', b'a' * 10, 0, 7),
+        Write('/outer', b'b' * 10, 0, 7),
+        Write('/outer', b'c' * 10, 20, 7),
+        Truncate('/outer', 20, 7),
+        Write('/outer', b'd' * 10, 30, 7),
+        Release('/outer', 7),
+        # A new file behind the same number; its write covers the last one
+        # through the old handle.
+        Open('/other', os.O_WRONLY, 7),
+        Write('/other', b'e' * 40, 0, 7),
+        Release('/other', 7),
+    ]
+    assert compact(commands) == [commands[1], commands[3], commands[4], commands[5]] + commands[6:]
+
+
+def test_compaction_of_truncate_and_chmod():
+    commands = [
+        Truncate('/f', 100, None),
+        Chmod('/f', 0o600),
+        Truncate('/f', 50, None),
+        Chmod('/f', 0o640),
+        # A file of the same name after the rename, changed again
+        Rename('/g', '/f'),
+        Truncate('/f', 10, None),
+        Chmod('/f', 0o644),
+        # A longer truncate does not cover a shorter one.
+        Truncate('/f', 20, None),
+    ]
+    assert compact(commands, lambda path: True) == commands[2:]
+
+
+def test_compaction_of_rename_over_existing_file():
+    commands = [
+        Create('/tmp', 0o644, None, 3),
+        Write('/tmp', b'a' * 10, 0, 3),
+        Release('/tmp', 3),
+        Rename('/tmp', '/existing'),
+        Rename('/existing', '/final'),
+        Unlink('/final'),
+    ]
+    # Both names the file was renamed over lose what they held.
+    assert compact(commands, lambda path: path in ('/existing', '/final')) == \
+        [Unlink('/existing'), Unlink('/final'), None]
+
+
+@pytest.mark.parametrize('barrier', [
+    Read('/f', 10, 0, 3),
+    Checksum('/f', 10, 0, 4096),
+    Ping(),
+])
+def test_compaction_barriers(barrier):
+    commands = [
+        Create('/f', 0o644, None, 3),
+        Write('/f', b'a' * 10, 0, 3),
+        barrier,
+        Write('/f', b'b' * 10, 0, 3),
+        Release('/f', 3),
+        Unlink('/f'),
+    ]
+    # The barrier sees the first write, and the file it reads.
+    assert compact(commands) == commands
+    # Compaction goes on after it.
+    commands[3:3] = [Write('/f', b'c' * 10, 0, 3)]
+    assert compact(commands) == commands[:3] + commands[4:]
+
+
+def test_compaction_on_slave(tmp_path):
+    with local_replica(str(tmp_path), slave_compaction=True, replication_mode=REPLICATION_ASYNC) as (master, slaves):
+        for path in ['/existing', '/kept']:
+            fh = master.create(path, 0o644)
+            master.write(path, path.encode() * 10, 0, fh)
+            master.release(path, fh)
+        outer = master.open('/kept', os.O_WRONLY)
+        poll(lambda: all(slave.queue.lag()['ops'] == 0 for slave in slaves))
+
+        dispatched = []
+        for slave in slaves:
+            dispatch = slave._dispatch_command
+            slave._dispatch_command = lambda command, dispatch=dispatch: dispatch(dispatched.append(command) or command)
+        stalled = [stall_slave(slave) for slave in slaves]
+        # Each slave drains the ping alone and holds it, so that what follows
+        # is drained in one batch.
+        for slave in slaves:
+            slave.queue.put(Ping(pipeline=SlaveRequestPipeline()))
+        poll(lambda: all(slave.queue.empty() for slave in slaves))
+
+        master.write('/kept', b'a' * 10, 0, outer)
+        master.write('/kept', b'b' * 20, 0, outer)
+        master.truncate('/kept', 100)
+        master.truncate('/kept', 15)
+        master.chmod('/kept', 0o600)
+        master.chmod('/kept', 0o640)
+        master.release('/kept', outer)
+        fh = master.create('/tmp', 0o644)
+        master.write('/tmp', b'c' * 10, 0, fh)
+        master.release('/tmp', fh)
+        master.rename('/tmp', '/existing')
+        master.unlink('/existing')
+
+        for event in stalled:
+            event.set()
+        poll(lambda: all(slave.queue.lag()['ops'] == 0 for slave in slaves))
+        # Of the 12 commands each slave was sent, the rename is applied as
+        # an unlink and the last write, truncate, chmod and release of /kept
+        # are left, after the ping.
+        assert len(dispatched) == 6 * len(slaves)
+        assert_same_tree(master.backing_store, [slave.backing_store for slave in slaves])
+        for slave in slaves:
+            assert not os.path.exists(os.path.join(slave.backing_store, 'existing'))
+            assert stat.S_IMODE(os.stat(os.path.join(slave.backing_store, 'kept')).st_mode) == 0o640
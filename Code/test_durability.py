@@ -0,0 +1,98 @@
+from typing import List
+import errno
+import os
+import pytest
+import threading
+
+from fs.Durability import GroupCommitDurability
+
+from conftest import poll
+
+
+def open_files(tmp_path, count: int) -> List[int]:
+    return [os.open(str(tmp_path / f'f{i}'), os.O_CREAT | os.O_WRONLY) for i in range(count)]
+
+
+def test_group_commit_concurrent_callers(tmp_path):
+    durability = GroupCommitDurability(window=0.2)
+    fhs = open_files(tmp_path, 8)
+    arrived = threading.Barrier(len(fhs))
+
+    def sync(fh):
+        arrived.wait()
+        durability.sync(fh)
+
+    threads = [threading.Thread(target=sync, args=(fh,)) for fh in fhs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Callers arriving within the leader's window share its commit.
+    stats = durability.stats()
+    assert stats['syncs'] == len(fhs) and stats['commits'] <= 2
+
+    # A batch of handles is a single commit.
+    durability.sync_many(fhs[:4] + fhs[:2])
+    assert durability.stats() == {'commits': stats['commits'] + 1, 'syncs': stats['syncs'] + 4}
+    for fh in fhs:
+        os.close(fh)
+
+
+def test_group_commit_leader_hand_off(tmp_path):
+    durability = GroupCommitDurability(window=0)
+    first, second = open_files(tmp_path, 2)
+    committing = threading.Event()
+    release = threading.Event()
+    batches = []
+    sync_all = durability._sync_all
+
+    def slow_sync_all(pending):
+        batches.append(sorted(pending))
+        committing.set()
+        release.wait()
+        return sync_all(pending)
+
+    durability._sync_all = slow_sync_all
+    leader = threading.Thread(target=durability.sync, args=(first,))
+    leader.start()
+    committing.wait()
+    # Arriving during a commit, the follower waits for it, then leads the
+    # next one for its own handle.
+    follower = threading.Thread(target=durability.sync, args=(second,))
+    follower.start()
+    poll(lambda: durability._pending)
+    release.set()
+    leader.join()
+    follower.join()
+    assert batches == [[first], [second]]
+    assert durability.stats() == {'commits': 2, 'syncs': 2}
+    os.close(first)
+    os.close(second)
+
+
+def test_group_commit_errors(tmp_path):
+    durability = GroupCommitDurability(window=0.1)
+    (good,) = open_files(tmp_path, 1)
+    bad = os.open(str(tmp_path / 'closed'), os.O_CREAT | os.O_WRONLY)
+    os.close(bad)
+    arrived = threading.Barrier(2)
+    errors = {}
+
+    def sync(fh):
+        arrived.wait()
+        try:
+            durability.sync(fh)
+        except OSError as e:
+            errors[fh] = e.errno
+
+    threads = [threading.Thread(target=sync, args=(fh,)) for fh in (good, bad)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Only the caller whose handle failed sees the error.
+    assert errors == {bad: errno.EBADF}
+    with pytest.raises(OSError) as raised:
+        durability.sync_many([good, bad])
+    assert raised.value.errno == errno.EBADF
+    os.close(good)
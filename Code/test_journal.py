@@ -0,0 +1,149 @@
+import logging
+import os
+
+from fs.ChunkedReplicaFSSlave import make_slave
+from fs.ReplicaFSSlave import ReplicaFSSlave
+from fs.ReplicationJournal import ReplicationJournal
+from fs.SlaveOperationCommands import Create, Mkdir, Release, Rename, Write
+from fs.SlaveQueue import SlaveQueue
+from fs.Watermark import Watermark
+
+from conftest import local_config
+
+
+class Crash(BaseException):
+    pass
+
+
+def test_journal_replay_after_crash(tmp_path, monkeypatch):
+    config = local_config(str(tmp_path), nbr_slaves=1)
+    path = os.path.join(str(tmp_path), 'journal')
+    commands = [
+        Create('/a', 0o644, None, 1), Write('/a', b'old', 0, 1), Release('/a', 1),
+        # Applied twice, the rename would move the new /a over /b.
+        Rename('/a', '/b'), Create('/a', 0o644, None, 2), Write('/a', b'new', 0, 2), Release('/a', 2),
+    ]
+    dispatched = []
+    dispatch = ReplicaFSSlave._dispatch_command
+
+    def dispatch_until_crash(slave, command):
+        if command.seq == crash_at:
+            raise Crash()
+        dispatched.append(command.seq)
+        dispatch(slave, command)
+
+    monkeypatch.setattr(ReplicaFSSlave, '_dispatch_command', dispatch_until_crash)
+    monkeypatch.setattr('threading.excepthook', lambda args: None)
+
+    def replay():
+        # A slave replays the journal as it starts.
+        journal = ReplicationJournal(path, 1)
+        slave = make_slave(config, queue=SlaveQueue(), slave_n=0, logger=logging.getLogger('replica_fs.test'),
+                           journal=journal)
+        slave.stop()
+        journal.close()
+
+    journal = ReplicationJournal(path, 1)
+    for command in commands[:3]:
+        command.seq = journal.append(command)
+    journal.close()
+    crash_at = None
+    replay()
+    journal = ReplicationJournal(path, 1)
+    for command in commands[3:]:
+        command.seq = journal.append(command)
+    journal.close()
+    # The slave dies before the release, in the middle of a batch.
+    crash_at = 7
+    replay()
+    crash_at = None
+    replay()
+
+    assert dispatched == [1, 2, 3, 4, 5, 6, 7]
+    slave_backing = config.slave_backings[0]
+    for name, data in (('a', b'new'), ('b', b'old')):
+        with open(os.path.join(slave_backing, name), 'rb') as f:
+            assert f.read() == data
+
+    # A slave in another process skips what its own watermark records,
+    # until it follows another journal.
+    watermark = Watermark(os.path.join(str(tmp_path), 'watermark'))
+    slave = make_slave(config, queue=SlaveQueue(), slave_n=0, logger=logging.getLogger('replica_fs.test'),
+                       watermark=watermark)
+    assert not watermark.follow('journal')
+    for command in commands:
+        slave._replay_command(command.seq, command)
+        if command.seq == 6:
+            break
+    reopened = Watermark(watermark.path)
+    assert (reopened.journal, reopened.seq) == ('journal', 6)
+    reopened.close()
+    dispatched.clear()
+    slave.start_replay(known=watermark.follow('journal'))
+    for command in commands[3:]:
+        slave._replay_command(command.seq, command)
+    assert dispatched == [7]
+    slave.start_replay(known=watermark.follow('another journal'))
+    slave._replay_command(1, commands[0])
+    assert dispatched == [7, 1]
+    slave.stop()
+    watermark.close()
+
+
+def test_journal_torn_and_corrupt_records(tmp_path):
+    path = str(tmp_path)
+    journal = ReplicationJournal(path, 1)
+    for i in range(3):
+        journal.append(Mkdir(f'/d{i}', 0o755))
+    journal.close()
+    (segment,) = [os.path.join(path, name) for name in os.listdir(path) if name.endswith('.seg')]
+    size = os.path.getsize(segment)
+
+    # A record torn by a crash in the middle of an append
+    with open(segment, 'ab') as f:
+        f.write(b'\x10\x00\x00')
+    journal = ReplicationJournal(path, 1)
+    assert journal.recovered_seq == 3 and os.path.getsize(segment) == size
+    assert [seq for seq, _ in journal.replay(0)] == [1, 2, 3]
+    journal.close()
+
+    # The last byte of the last record flipped
+    with open(segment, 'r+b') as f:
+        f.seek(size - 1)
+        byte = f.read(1)[0]
+        f.seek(size - 1)
+        f.write(bytes([byte ^ 0xff]))
+    journal = ReplicationJournal(path, 1)
+    assert journal.recovered_seq == 2
+    assert [command.path for _, command in journal.replay(0)] == ['/d0', '/d1']
+    assert journal.append(Mkdir('/d2', 0o755)) == 3
+    journal.close()
+
+
+def test_journal_segment_truncation(tmp_path):
+    path = str(tmp_path)
+
+    def segments():
+        return sorted(int(name[:-len('.seg')]) for name in os.listdir(path) if name.endswith('.seg'))
+
+    # One record per segment
+    journal = ReplicationJournal(path, 2, segment_bytes=1)
+    for i in range(5):
+        journal.append(Mkdir(f'/d{i}', 0o755))
+    assert segments() == [1, 2, 3, 4, 5]
+
+    journal.mark_applied(0, 5)
+    journal.mark_applied(1, 2)
+    journal.release_segments()
+    # The lagging slave holds back what it has not applied yet.
+    assert segments() == [3, 4, 5]
+    assert [seq for seq, _ in journal.replay(2)] == []
+    journal.remove_slave(1)
+    # The segment being appended to stays.
+    assert segments() == [5]
+    journal.close()
+
+    journal = ReplicationJournal(path, 2, segment_bytes=1)
+    assert journal.applied == [5, 2] and journal.recovered_seq == 5
+    assert [seq for seq, _ in journal.replay(2)] == [5]
+    journal.close()
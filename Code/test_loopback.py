@@ -0,0 +1,385 @@
+from fuse import FuseOSError
+from typing import List
+import errno
+import os
+import pytest
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from fs.RemoteSlave import RemoteSlaveProxy
+from fs.ReplicaFSMaster import ReplicaFSMaster
+from fs.ReplicationProtocol import connect, decode_message, encode_message, is_local, parse_address
+from fs.Scrubber import Scrubber
+from fs.SlaveQueue import SlaveQueue
+from fs.config import ReplicaFSConfig
+
+from conftest import NBR_SLAVES, assert_same_tree
+
+
+# The master runs in the test process, every slave is a slave_daemon.py
+# process reached over a Unix socket; nothing is mounted.
+DAEMON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'slave_daemon.py')
+
+
+def wait_for(path: str, timeout: float = 10):
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        assert time.time() < deadline, f'{path} did not appear'
+        time.sleep(0.05)
+
+
+@pytest.fixture(scope='module')
+def loopback():
+    with tempfile.TemporaryDirectory() as root:
+        master_backing = os.path.join(root, 'master')
+        os.mkdir(master_backing)
+        slave_backings = [os.path.join(root, f'slave_{i}') for i in range(NBR_SLAVES)]
+        sockets = [os.path.join(root, f'slave_{i}.sock') for i in range(NBR_SLAVES)]
+
+        daemons = [
+            subprocess.Popen([
+                sys.executable, DAEMON,
+                '--listen', f'unix:{sockets[i]}',
+                '--log-file', os.path.join(root, f'slave_{i}.log'),
+                # The last slave compacts its batches, the others apply every command.
+                *(['--compaction'] if i == NBR_SLAVES - 1 else []),
+                slave_backings[i],
+            ]) for i in range(NBR_SLAVES)
+        ]
+        try:
+            for path in sockets:
+                wait_for(path)
+
+            config = ReplicaFSConfig(
+                master_mount_point=os.path.join(root, 'mnt'),
+                slave_mount_points=[],
+                master_backing=master_backing,
+                slave_backings=[],
+                nbr_slaves=NBR_SLAVES,
+                remote_slaves=[f'unix:{path}' for path in sockets],
+                stripe_threshold=64 * 1024,
+                stripe_bytes=16 * 1024,
+            )
+            queues = [SlaveQueue() for _ in range(NBR_SLAVES)]
+            proxies = [
+                RemoteSlaveProxy(n, queues[n], connect(address))
+                for n, address in enumerate(config.remote_slaves)
+            ]
+            for proxy in proxies:
+                proxy.start()
+
+            yield ReplicaFSMaster(config, queues=queues, nbr_slaves=NBR_SLAVES), master_backing, slave_backings
+
+            for proxy in proxies:
+                proxy.stop()
+        finally:
+            for daemon in daemons:
+                daemon.terminate()
+                daemon.wait()
+
+
+def test_protocol_round_trip():
+    messages = [
+        ('command', 7, 'Write', {'path': '/d/é', 'buf': b'x' * 1000, 'offset': 12, 'fh': None, 'seq': 40}, None),
+        ('command', 8, 'Create', {'path': '/f', 'mode': 0o644, 'fi': None, 'ret_fd': 5, 'seq': None}, None),
+        ('journal', '0123456789abcdef0123456789abcdef'),
+        ('replay', 9, 'Rename', {'old': '/a', 'new': '/b', 'seq': 9}, None),
+        ('command', 10, 'Read', {'path': '/f', 'length': 10, 'offset': 0, 'fh': 5, 'block_size': 4, 'seq': None}, None),
+        ('command', 11, 'Checksum', {'path': '/f', 'length': 10, 'offset': 4, 'block_size': 4, 'seq': None}, None),
+        ('replayed', 9),
+        ('ack', [1, 2, 3]),
+        ('result', 10, b'data'),
+        ('result', 11, [b'abcd', b'ef']),
+        ('error', 12, 9),
+        None,
+    ]
+    for message in messages:
+        header, *body = encode_message(message)
+        decoded = decode_message(header[4], memoryview(b''.join(body)))
+        if message is not None and message[0] in ('command', 'replay'):
+            fields = {name: bytes(value) if isinstance(value, memoryview) else value
+                      for name, value in decoded[3].items()}
+            decoded = decoded[:3] + (fields,) + decoded[4:]
+        assert decoded == message
+
+
+def test_slave_daemon_secret(tmp_path):
+    assert parse_address('7000')[1] == ('127.0.0.1', 7000)
+    assert is_local(':7000') and is_local('unix:/tmp/s') and not is_local('0.0.0.0:7000')
+    refused = subprocess.run([sys.executable, DAEMON, '--listen', '0.0.0.0:0', str(tmp_path / 'refused')],
+                             capture_output=True)
+    assert refused.returncode != 0 and b'--secret-file' in refused.stderr
+
+    secret_file = tmp_path / 'secret'
+    secret_file.write_bytes(b'correct horse\n')
+    socket_path = str(tmp_path / 'slave.sock')
+    daemon = subprocess.Popen([
+        sys.executable, DAEMON, '--listen', f'unix:{socket_path}', '--secret-file', str(secret_file),
+        '--log-file', str(tmp_path / 'slave.log'), str(tmp_path / 'slave'),
+    ])
+    try:
+        wait_for(socket_path)
+        with pytest.raises(PermissionError):
+            connect(f'unix:{socket_path}', b'battery staple')
+        # A master without the secret is dropped before its commands are read.
+        conn = connect(f'unix:{socket_path}')
+        conn.send(('command', 0, 'Ping', {}, None))
+        conn.send(('command', 1, 'Ping', {}, None))
+        with pytest.raises((EOFError, ConnectionResetError)):
+            while True:
+                conn.recv()
+        conn.close()
+        conn = connect(f'unix:{socket_path}', b'correct horse')
+        conn.send(('command', 0, 'Ping', {}, None))
+        assert conn.recv() == ('result', 0, b'')
+        conn.close()
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def test_writer_released_when_slave_goes(tmp_path):
+    socket_path = str(tmp_path / 'slave.sock')
+    daemon = subprocess.Popen([
+        sys.executable, DAEMON, '--listen', f'unix:{socket_path}', '--log-file', str(tmp_path / 'slave.log'),
+        str(tmp_path / 'slave'),
+    ])
+    try:
+        wait_for(socket_path)
+        config = ReplicaFSConfig(
+            master_mount_point=str(tmp_path / 'mnt'),
+            slave_mount_points=[],
+            master_backing=str(tmp_path / 'master'),
+            slave_backings=[],
+            nbr_slaves=1,
+            remote_slaves=[f'unix:{socket_path}'],
+            ack_timeout=0.5,
+        )
+        os.mkdir(config.master_backing)
+        queue = SlaveQueue()
+        proxy = RemoteSlaveProxy(0, queue, connect(config.remote_slaves[0]))
+        proxy.start()
+        master = ReplicaFSMaster(config, queues=[queue], nbr_slaves=1)
+        fh = master.create('/f', 0o644)
+        master.write('/f', b'a', 0, fh)
+
+        # A slave that stops answering times the writer out...
+        os.kill(daemon.pid, signal.SIGSTOP)
+        start = time.monotonic()
+        with pytest.raises(FuseOSError) as raised:
+            master.write('/f', b'b', 1, fh)
+        assert raised.value.errno == errno.EIO and time.monotonic() - start < 5
+        # ...and one that is gone fails it, however long it would wait.
+        config.ack_timeout = None
+        daemon.kill()
+        daemon.wait()
+        for offset in (2, 3):
+            with pytest.raises(FuseOSError):
+                master.write('/f', b'c', offset, fh)
+        assert not proxy.connected() and queue.lag()['ops'] == 0
+        master.destroy('/')
+        proxy.stop()
+    finally:
+        daemon.kill()
+        daemon.wait()
+
+
+def test_loopback_replication(loopback):
+    master, master_backing, slave_backings = loopback
+
+    master.mkdir('/dir', 0o755)
+    fh = master.create('/dir/file', 0o644)
+    payload = os.urandom(512 * 1024)
+    master.write('/dir/file', payload, 0, fh)
+    master.write('/dir/file', b'tail', len(payload), fh)
+    master.release('/dir/file', fh)
+
+    fh = master.create('/gone', 0o644)
+    master.release('/gone', fh)
+    master.unlink('/gone')
+    master.rename('/dir/file', '/dir/renamed')
+    master.chmod('/dir/renamed', 0o600)
+
+    fh = master.open('/dir/renamed', os.O_RDWR)
+    master.truncate('/dir/renamed', 300 * 1024, fh)
+    master.release('/dir/renamed', fh)
+
+    assert_same_tree(master_backing, slave_backings)
+    for slave_backing in slave_backings:
+        assert os.stat(os.path.join(slave_backing, 'dir', 'renamed')).st_mode & 0o777 == 0o600
+
+
+def test_loopback_reads(loopback):
+    master, _, _ = loopback
+
+    fh = master.create('/read', 0o644)
+    payload = os.urandom(200 * 1024)
+    master.write('/read', payload, 0, fh)
+    master.release('/read', fh)
+
+    fh = master.open('/read', os.O_RDONLY)
+    # Striped over both slaves
+    assert master.read('/read', len(payload) + 10, 0, fh) == payload
+    assert master.read('/read', 100, 1000, fh) == payload[1000:1100]
+    master.release('/read', fh)
+    assert all(stats['served'] for stats in master.read_distribution())
+
+
+def test_loopback_scrub(loopback):
+    master, master_backing, slave_backings = loopback
+
+    fh = master.create('/scrubbed', 0o644)
+    master.write('/scrubbed', os.urandom(300 * 1024), 0, fh)
+    master.release('/scrubbed', fh)
+    assert_same_tree(master_backing, slave_backings)
+
+    with open(os.path.join(slave_backings[1], 'scrubbed'), 'r+b') as f:
+        f.seek(100 * 1024)
+        f.write(b'bit rot')
+        f.seek(0, os.SEEK_END)
+        f.write(b'tail')
+
+    scrubber = Scrubber(master, 16 * 1024, 0, 2, timeout=10)
+    scrubber.run_pass()
+    stats = scrubber.stats()
+    assert stats['mismatched_blocks'] == [0, 2]
+    assert stats['repaired_blocks'] == [0, 2]
+    assert stats['progress'] == 1.0
+
+    # The repairs are queued ahead of the next command.
+    fh = master.create('/barrier', 0o644)
+    master.release('/barrier', fh)
+    assert_same_tree(master_backing, slave_backings)
+
+
+def test_loopback_attach(loopback):
+    master, master_backing, slave_backings = loopback
+
+    master.mkdir('/attached', 0o700)
+    fh = master.create('/attached/sparse', 0o640)
+    master.write('/attached/sparse', os.urandom(64 * 1024), 0, fh)
+    master.write('/attached/sparse', b'end', 4 * 1024 * 1024, fh)
+    master.release('/attached/sparse', fh)
+
+    with tempfile.TemporaryDirectory() as root:
+        socket = os.path.join(root, 'attached.sock')
+        backing = os.path.join(root, 'attached')
+        daemon = subprocess.Popen([
+            sys.executable, DAEMON, '--listen', f'unix:{socket}', '--log-file', os.path.join(root, 'attached.log'),
+            backing,
+        ])
+        try:
+            wait_for(socket)
+            stats_files = master.stats_files
+            fh = stats_files('open', '/.replicafs/control', os.O_WRONLY)
+            stats_files('write', '/.replicafs/control', f'attach unix:{socket}\n'.encode(), 0, fh)
+            stats_files('release', '/.replicafs/control', fh)
+            n = len(slave_backings)
+
+            # Written while the copy may still be going on
+            fh = master.create('/attached/live', 0o644)
+            master.write('/attached/live', os.urandom(10 * 1024), 0, fh)
+            master.release('/attached/live', fh)
+
+            deadline = time.time() + 10
+            while master.bootstraps[n].state != 'joined':
+                assert time.time() < deadline, master.bootstraps[n].stats()
+                time.sleep(0.05)
+            assert master.slave_states()[n] == 'healthy'
+
+            fh = master.create('/attached/joined', 0o644)
+            master.release('/attached/joined', fh)
+            assert_same_tree(master_backing, slave_backings + [backing])
+            assert os.stat(os.path.join(backing, 'attached')).st_mode & 0o777 == 0o700
+            assert os.stat(os.path.join(backing, 'attached', 'sparse')).st_blocks * 512 < 1024 * 1024
+
+            master.control(f'detach {n}')
+            assert master.slave_states()[n] == 'detached'
+            fh = master.create('/attached/detached', 0o644)
+            master.release('/attached/detached', fh)
+            assert not os.path.exists(os.path.join(backing, 'attached', 'detached'))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+
+def test_loopback_replication_factor():
+    with tempfile.TemporaryDirectory() as root:
+        master_backing = os.path.join(root, 'master')
+        os.mkdir(master_backing)
+        slave_backings = [os.path.join(root, f'slave_{i}') for i in range(3)]
+        sockets = [os.path.join(root, f'slave_{i}.sock') for i in range(3)]
+        daemons = [
+            subprocess.Popen([
+                sys.executable, DAEMON, '--listen', f'unix:{sockets[i]}',
+                '--log-file', os.path.join(root, f'slave_{i}.log'), slave_backings[i],
+            ]) for i in range(3)
+        ]
+        try:
+            for path in sockets:
+                wait_for(path)
+            config = ReplicaFSConfig(
+                master_mount_point=os.path.join(root, 'mnt'),
+                slave_mount_points=[],
+                master_backing=master_backing,
+                slave_backings=[],
+                nbr_slaves=2,
+                remote_slaves=[f'unix:{path}' for path in sockets[:2]],
+                replication_factor=1,
+            )
+            queues = [SlaveQueue() for _ in range(2)]
+            for n, address in enumerate(config.remote_slaves):
+                RemoteSlaveProxy(n, queues[n], connect(address)).start()
+            master = ReplicaFSMaster(config, queues=queues, nbr_slaves=2)
+
+            master.mkdir('/placed', 0o755)
+            contents = {}
+            for i in range(20):
+                path = f'/placed/f{i}'
+                contents[path] = os.urandom(1000 + i)
+                fh = master.create(path, 0o644)
+                master.write(path, contents[path], 0, fh)
+                master.release(path, fh)
+            master.rename('/placed/f0', '/placed/f1')
+            contents['/placed/f1'] = contents.pop('/placed/f0')
+            master.unlink('/placed/f2')
+            del contents['/placed/f2']
+
+            def assert_placed(slaves: List[int]):
+                for queue in master.queues:
+                    queue.wait_for_lag(max_ops=1)
+                ring = master._rings[0]
+                for path, data in contents.items():
+                    owners = ring.owners(os.lstat(master_backing + path).st_ino)
+                    assert len(owners) == 1
+                    for n in slaves:
+                        slave_path = slave_backings[n] + path
+                        if n in owners:
+                            with open(slave_path, 'rb') as f:
+                                assert f.read() == data
+                        else:
+                            assert not os.path.exists(slave_path)
+                    assert os.path.isdir(os.path.join(slave_backings[owners[0]], 'placed'))
+
+                    fh = master.open(path, os.O_RDONLY)
+                    assert master.read(path, len(data), 0, fh) == data
+                    master.release(path, fh)
+
+            assert_placed([0, 1])
+            assert master.health.read_stats()['local'] == 0
+
+            n = master.attach_slave(f'unix:{sockets[2]}')
+            deadline = time.time() + 10
+            while master.rebalancer.running():
+                assert time.time() < deadline, master.rebalancer.stats()
+                time.sleep(0.05)
+            assert master.rebalancer.state == 'done'
+            assert master.slave_states()[n] == 'healthy'
+            assert_placed([0, 1, 2])
+        finally:
+            for daemon in daemons:
+                daemon.terminate()
+                daemon.wait()
@@ -0,0 +1,80 @@
+import os
+
+from fs.MerkleTree import BLOCK_SIZE, MerkleTree, resync_backing_store
+
+from conftest import assert_same_tree, local_replica
+
+
+def test_merkle_resync(tmp_path):
+    block = 4096
+    master_backing = tmp_path / 'master'
+    slave_backing = tmp_path / 'slave'
+    master_backing.mkdir()
+    slave_backing.mkdir()
+    blocks = [bytes([i]) * block for i in range(4)]
+    (master_backing / 'big').write_bytes(b''.join(blocks))
+    (master_backing / 'sub').mkdir()
+    (master_backing / 'sub' / 'small').write_bytes(b'small')
+    os.symlink('big', master_backing / 'link')
+    # One block differs, a mode differs, one file is stale and the rest is
+    # missing.
+    (slave_backing / 'big').write_bytes(b''.join(blocks[:2] + [b'x' * block] + blocks[3:]))
+    os.chmod(slave_backing / 'big', 0o600)
+    (slave_backing / 'stale').write_bytes(b'stale')
+
+    master = MerkleTree(str(master_backing), str(tmp_path / 'master.merkle'), block_size=block)
+    slave = MerkleTree(str(slave_backing), str(tmp_path / 'slave.merkle'), block_size=block)
+    digest, stats = resync_backing_store(master, slave)
+    assert digest == master.refresh()
+    assert stats == {'blocks_copied': 2, 'bytes_copied': block + 5, 'entries_created': 3, 'entries_removed': 1}
+    assert_same_tree(str(master_backing), [str(slave_backing)])
+    assert os.stat(slave_backing / 'big').st_mode == os.stat(master_backing / 'big').st_mode
+    assert os.readlink(slave_backing / 'link') == 'big'
+
+    # Nothing left to copy, and the trees reload from their state.
+    master = MerkleTree(str(master_backing), str(tmp_path / 'master.merkle'), block_size=block)
+    slave = MerkleTree(str(slave_backing), str(tmp_path / 'slave.merkle'), block_size=block)
+    assert master.nodes and slave.nodes
+    _, stats = resync_backing_store(master, slave)
+    assert stats == {'blocks_copied': 0, 'bytes_copied': 0, 'entries_created': 0, 'entries_removed': 0}
+
+    # A write the size and mtime do not show is still found through the
+    # invalidation hook.
+    st = os.stat(master_backing / 'big')
+    fd = os.open(master_backing / 'big', os.O_WRONLY)
+    os.pwrite(fd, b'y' * 10, block + 1)
+    os.close(fd)
+    os.utime(master_backing / 'big', ns=(st.st_atime_ns, st.st_mtime_ns))
+    master.invalidate('/big', block + 1, 10)
+    digest, stats = resync_backing_store(master, slave)
+    assert stats['blocks_copied'] == 1
+    assert digest == master.refresh()
+    assert (slave_backing / 'big').read_bytes() == (master_backing / 'big').read_bytes()
+
+
+def test_merkle_tracks_written_blocks(tmp_path, monkeypatch):
+    merkle_path = str(tmp_path / 'merkle')
+    os.mkdir(merkle_path)
+    with local_replica(str(tmp_path), merkle_path=merkle_path) as (master, _):
+        fh = master.create('/f', 0o644)
+        master.write('/f', os.urandom(8 * BLOCK_SIZE), 0, fh)
+        master.release('/f', fh)
+
+    rehashed = []
+    pread = os.pread
+
+    def counting_pread(fd, length, offset):
+        rehashed.append(offset // BLOCK_SIZE)
+        return pread(fd, length, offset)
+
+    # Reopened from the saved state, only the written block is read again.
+    with local_replica(str(tmp_path), merkle_path=merkle_path) as (master, _):
+        master._merkle_refresh.join()
+        fh = master.open('/f', os.O_WRONLY)
+        master.write('/f', b'x', 3 * BLOCK_SIZE + 1, fh)
+        master.release('/f', fh)
+        monkeypatch.setattr(os, 'pread', counting_pread)
+        digest = master.merkle_tree.refresh()
+        monkeypatch.undo()
+    assert rehashed == [3]
+    assert digest == MerkleTree(master.backing_store).refresh()
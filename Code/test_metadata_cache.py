@@ -0,0 +1,49 @@
+import pytest
+
+from conftest import local_replica, poll
+
+
+def test_metadata_cache_invalidation(tmp_path):
+    with local_replica(str(tmp_path), metadata_cache_entries=64) as (master, slaves):
+        def listing(fs, path='/'):
+            return sorted(fs.readdir(path, None))
+
+        master.mkdir('/d', 0o755)
+        fh = master.create('/d/f', 0o644)
+        assert listing(master, '/d') == ['.', '..', 'f']
+        assert master.getattr('/d/f')['st_size'] == 0
+        hits = master.metadata_cache_stats()['hits']
+        assert master.getattr('/d/f')['st_size'] == 0
+        assert master.metadata_cache_stats()['hits'] == hits + 1
+
+        master.write('/d/f', b'data', 0, fh)
+        assert master.getattr('/d/f')['st_size'] == 4
+        master.truncate('/d/f', 2, fh)
+        assert master.getattr('/d/f')['st_size'] == 2
+        master.release('/d/f', fh)
+        master.chmod('/d/f', 0o600)
+        assert master.getattr('/d/f')['st_mode'] & 0o777 == 0o600
+        master.utimens('/d/f', (1, 1))
+        assert master.getattr('/d/f')['st_mtime'] == 1
+
+        # Entries created and removed change their parent's listing, and a
+        # rename or rmdir forgets everything below the old path.
+        for fs in [master] + slaves:
+            assert listing(fs, '/d') == ['.', '..', 'f']
+            fs.getattr('/d/f')
+        master.release('/d/g', master.create('/d/g', 0o644))
+        master.rename('/d', '/e')
+        poll(lambda: all(listing(fs, '/e') == ['.', '..', 'f', 'g'] for fs in slaves))
+        for fs in [master] + slaves:
+            assert listing(fs) == ['.', '..', 'e']
+            assert listing(fs, '/e') == ['.', '..', 'f', 'g']
+            with pytest.raises(FileNotFoundError):
+                fs.getattr('/d/f')
+        master.unlink('/e/f')
+        master.unlink('/e/g')
+        master.rmdir('/e')
+        poll(lambda: all(listing(fs) == ['.', '..'] for fs in slaves))
+        for fs in [master] + slaves:
+            assert listing(fs) == ['.', '..']
+            with pytest.raises(FileNotFoundError):
+                fs.getattr('/e')
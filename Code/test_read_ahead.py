@@ -0,0 +1,78 @@
+import os
+
+from fs.ReadAhead import ReadAhead, ReadPart, assemble
+from fs.SlaveRequestPipeline import SlaveRequestPipeline
+
+from conftest import local_replica
+
+
+def provided(data: bytes) -> SlaveRequestPipeline:
+    pipeline = SlaveRequestPipeline()
+    pipeline.provide(data)
+    return pipeline
+
+
+def test_assemble():
+    parts = [ReadPart(0, 4, provided(b'abcd')), ReadPart(4, 4, provided(b'ef')), ReadPart(8, 4, provided(b'ijkl'))]
+    assert assemble(parts, 2, 4) == b'cdef'
+    # A part cut short by the end of the file is the last one.
+    assert assemble(parts, 0, 12) == b'abcdef'
+    assert assemble(parts, 8, 4) == b'ijkl'
+
+
+def test_read_ahead():
+    data = bytes(range(256)) * 16
+    submitted = []
+    registrations = []
+
+    def submit(offset, length):
+        submitted.append((offset, length))
+        return [ReadPart(offset, length, provided(data[offset:offset + length]))]
+
+    def prefetch(offset, length, register):
+        registrations.append(lambda: register(submit(offset, length)))
+
+    read_ahead = ReadAhead(window_bytes=1024, trigger=2)
+    for offset in range(0, 300, 100):
+        assert read_ahead.read('/f', 3, 100, offset, submit, prefetch) == data[offset:offset + 100]
+    # The third sequential read starts prefetching, the fourth is served
+    # from it.
+    registrations.pop()()
+    assert submitted[-1] == (300, 1024)
+    assert read_ahead.read('/f', 3, 100, 300, submit, prefetch) == data[300:400]
+    assert submitted[-1] == (300, 1024)
+
+    # A write drops the prefetched parts, and those in flight when it does.
+    read_ahead.invalidate('/f')
+    assert read_ahead.read('/f', 3, 100, 400, submit, prefetch) == data[400:500]
+    assert submitted[-1] == (400, 100)
+    read_ahead.read('/f', 3, 100, 500, submit, prefetch)
+    read_ahead.read('/f', 3, 100, 600, submit, prefetch)
+    read_ahead.invalidate('/f')
+    registrations.pop()()
+    assert read_ahead.read('/f', 3, 100, 700, submit, prefetch) == data[700:800]
+    assert submitted[-1] == (700, 100)
+    assert read_ahead.stats() == {'hits': 1, 'misses': 7, 'prefetched_bytes': 1024, 'streams': 1}
+
+
+def test_striped_reads(tmp_path):
+    data = os.urandom(100_000)
+    settings = dict(stripe_threshold=40_000, stripe_bytes=10_000)
+    with local_replica(str(tmp_path), **settings) as (master, slaves):
+        fh = master.create('/f', 0o644)
+        master.write('/f', data, 0, fh)
+        master.release('/f', fh)
+        fh = master.open('/f', os.O_RDONLY)
+
+        # Reads below the threshold go to a single slave...
+        assert [(part.offset, part.length) for part in master._submit_read('/f', 39_999, 0, fh)] == [(0, 39_999)]
+        # ...larger ones are striped, in whole blocks for the block cache.
+        parts = master._submit_read('/f', 40_000, 5, fh)
+        assert [(part.offset, part.length) for part in parts] == [(5 + i * 10_000, 10_000) for i in range(4)]
+        assert assemble(parts, 5, 40_000) == data[5:40_005]
+        parts = master._submit_read('/f', 40_000, 0, fh, block_size=4096)
+        assert [part.length for part in parts] == [8192] * 4 + [7232]
+
+        # The stripe reaching past the end of the file ends the read.
+        assert master.read('/f', 50_000, 85_000, fh) == data[85_000:]
+        master.release('/f', fh)
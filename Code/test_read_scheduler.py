@@ -0,0 +1,70 @@
+from fs.ReadScheduler import make_read_scheduler
+from fs.SlaveOperationCommands import Ping
+from fs.SlaveQueue import SlaveQueue
+from fs.config import READ_EWMA, READ_LEAST_OUTSTANDING, READ_ROUND_ROBIN
+
+
+def test_round_robin_over_candidates():
+    scheduler = make_read_scheduler(READ_ROUND_ROBIN, [SlaveQueue() for _ in range(4)])
+    assert [scheduler.choose([0, 1, 2, 3]) for _ in range(5)] == [0, 1, 2, 3, 0]
+    # Slaves left out are skipped, and the rotation goes on after the last
+    # one chosen.
+    assert [scheduler.choose([0, 2, 3]) for _ in range(4)] == [2, 3, 0, 2]
+    assert scheduler.choose([1]) == 1
+    assert scheduler.choose([0, 1, 2, 3]) == 2
+
+
+def test_least_outstanding_counts_queue_depth():
+    queues = [SlaveQueue() for _ in range(3)]
+    scheduler = make_read_scheduler(READ_LEAST_OUTSTANDING, queues)
+    scheduler.started(0)
+    queues[1].put(Ping())
+    queues[1].put(Ping())
+    assert scheduler.choose([0, 1, 2]) == 2
+    assert scheduler.choose([0, 1]) == 0
+
+    # A finished read no longer counts.
+    scheduler.finished(0, 0.01)
+    scheduler.started(2)
+    scheduler.started(2)
+    assert scheduler.choose([0, 1, 2]) == 0
+    assert scheduler.stats()[1]['queue_depth'] == 2
+
+
+def test_ewma_tries_unsampled_slave_first():
+    queues = [SlaveQueue() for _ in range(3)]
+    scheduler = make_read_scheduler(READ_EWMA, queues)
+    for n, elapsed in [(0, 0.01), (1, 0.05)]:
+        scheduler.started(n)
+        scheduler.finished(n, elapsed)
+    assert scheduler.choose([0, 1, 2]) == 2
+
+    scheduler.started(2)
+    scheduler.finished(2, 0.02)
+    assert scheduler.ewma == [0.01, 0.05, 0.02]
+    assert scheduler.choose([0, 1, 2]) == 0
+    # Scaled by the depth, a fast slave with a backlog loses to a slower
+    # idle one.
+    queues[0].put(Ping())
+    queues[0].put(Ping())
+    assert scheduler.choose([0, 1, 2]) == 2
+
+    scheduler.started(2)
+    scheduler.finished(2, 0.12)
+    assert abs(scheduler.ewma[2] - 0.04) < 1e-9
+    assert scheduler.served == [1, 1, 2]
+
+
+def test_add_slave():
+    queues = [SlaveQueue() for _ in range(2)]
+    scheduler = make_read_scheduler(READ_EWMA, queues)
+    for n in range(2):
+        scheduler.started(n)
+        scheduler.finished(n, 0.01)
+    queues.append(SlaveQueue())
+    scheduler.add_slave()
+    assert scheduler.outstanding == [0, 0, 0]
+    assert scheduler.served == [1, 1, 0]
+    assert scheduler.ewma == [0.01, 0.01, None]
+    assert scheduler.choose([0, 1, 2]) == 2
+    assert len(scheduler.stats()) == 3
@@ -0,0 +1,198 @@
+from fuse import FuseOSError
+import errno
+import os
+import pytest
+import threading
+import time
+
+from fs.ReplicationAck import ReplicationAck
+from fs.SlaveOperationCommands import Ping, Read, Write
+from fs.SlaveQueue import SlaveQueue
+from fs.SlaveRequestPipeline import SlaveRequestPipeline
+from fs.config import REPLICATION_ASYNC, REPLICATION_QUORUM
+
+from conftest import assert_same_tree, local_replica, poll, stall_slave
+
+
+def test_replication_ack():
+    ack = ReplicationAck(2, slaves=3)
+    ack.applied()
+    assert not ack.wait(timeout=0)
+    ack.applied()
+    assert ack.wait(timeout=0)
+    # Once too few slaves are left to reach required, waiting is over.
+    ack = ReplicationAck(2, slaves=3)
+    ack.applied()
+    ack.abandoned()
+    assert not ack.wait(timeout=0)
+    ack.abandoned()
+    assert not ack.wait()
+
+
+def test_quorum_replication(tmp_path):
+    settings = dict(replication_mode=REPLICATION_QUORUM, write_quorum=2)
+    with local_replica(str(tmp_path), nbr_slaves=3, **settings) as (master, slaves):
+        # Two acks of three are enough for the writer...
+        stalled = stall_slave(slaves[0])
+        try:
+            master.mkdir('/a', 0o755)
+            assert [os.path.isdir(os.path.join(slave.backing_store, 'a')) for slave in slaves] == \
+                [False, True, True]
+        finally:
+            stalled.set()
+        slaves[0].queue.wait_for_lag(max_ops=1)
+        assert_same_tree(master.backing_store, [slave.backing_store for slave in slaves])
+
+        # ...and with two slaves lost it fails at once, ack timeout or not.
+        for slave in slaves[1:]:
+            slave._execute_command = lambda command: command.ack.abandoned()
+        with pytest.raises(FuseOSError) as raised:
+            master.mkdir('/b', 0o755)
+        assert raised.value.errno == errno.EIO
+
+
+@pytest.mark.parametrize('settings', [dict(max_lag_ops=2), dict(max_lag_bytes=100)])
+def test_async_replication_lag(tmp_path, settings):
+    with local_replica(str(tmp_path), nbr_slaves=1, replication_mode=REPLICATION_ASYNC,
+                       **settings) as (master, (slave,)):
+        fh = master.create('/f', 0o644)
+        slave.queue.wait_for_lag(max_ops=1)
+        stalled = stall_slave(slave)
+        try:
+            # Writers return before the slave applies anything...
+            master.write('/f', bytes(60), 0, fh)
+            master.write('/f', bytes(60), 60, fh)
+            # ...until it lags by max_lag_ops commands or max_lag_bytes.
+            blocked = threading.Thread(target=master.write, args=('/f', b'x', 120, fh))
+            blocked.start()
+            time.sleep(0.2)
+            assert blocked.is_alive() and os.path.getsize(os.path.join(master.backing_store, 'f')) == 120
+        finally:
+            stalled.set()
+        blocked.join()
+        master.release('/f', fh)
+        slave.queue.wait_for_lag(max_ops=1)
+        assert_same_tree(master.backing_store, [slave.backing_store])
+
+
+def test_ack_wait_outside_path_locks(tmp_path):
+    with local_replica(str(tmp_path), nbr_slaves=1) as (master, slaves):
+        fh = master.create('/f', 0o644)
+        master.release('/f', fh)
+        stalled = stall_slave(slaves[0])
+        # A mkdir waiting for its ack holds no lock, so a rename (which
+        # excludes every other operation) changes the master meanwhile.
+        waiting = [threading.Thread(target=master.mkdir, args=('/d', 0o755)),
+                   threading.Thread(target=master.rename, args=('/f', '/g'))]
+        try:
+            waiting[0].start()
+            poll(lambda: os.path.isdir(os.path.join(master.backing_store, 'd')))
+            waiting[1].start()
+            poll(lambda: os.path.exists(os.path.join(master.backing_store, 'g')))
+            assert all(thread.is_alive() for thread in waiting)
+        finally:
+            stalled.set()
+            for thread in waiting:
+                thread.join()
+        assert_same_tree(master.backing_store, [slaves[0].backing_store])
+
+
+def test_queue_backpressure(tmp_path):
+    queue = SlaveQueue(max_ops=2, max_bytes=100)
+    writes = [Write('/f', bytes(40), 40 * i, 1) for i in range(3)]
+    queue.put(writes[0])
+    assert queue.wait_for_room(40, timeout=0)
+    queue.put(writes[1])
+    assert not queue.wait_for_room(0, timeout=0.05)
+    queue.applied(writes[0])
+    # Room for one more op, but not for its bytes.
+    assert not queue.wait_for_room(61, timeout=0)
+    assert queue.wait_for_room(60, timeout=0)
+    # A command larger than max_bytes waits for an empty queue.
+    assert not queue.wait_for_room(200, timeout=0)
+    queue.applied(writes[1])
+    assert queue.wait_for_room(200, timeout=0)
+    assert queue.occupancy() == {'peak_ops': 2, 'peak_bytes': 80, 'full_waits': 3, 'full_timeouts': 3}
+
+    # A writer facing a full queue fails with EAGAIN once queue_timeout is
+    # over, without changing the master.
+    settings = dict(queue_max_ops=2, queue_timeout=0.2, replication_mode=REPLICATION_ASYNC)
+    with local_replica(str(tmp_path), nbr_slaves=1, **settings) as (master, slaves):
+        stalled = threading.Event()
+        dispatch = slaves[0]._dispatch_command
+
+        def stall(command):
+            stalled.wait()
+            dispatch(command)
+
+        slaves[0]._dispatch_command = stall
+        try:
+            master.mkdir('/a', 0o755)
+            master.mkdir('/b', 0o755)
+            with pytest.raises(FuseOSError) as e:
+                master.mkdir('/c', 0o755)
+            assert e.value.errno == errno.EAGAIN
+            assert not os.path.exists(os.path.join(master.backing_store, 'c'))
+            assert master.queues[0].occupancy()['full_timeouts'] == 1
+        finally:
+            stalled.set()
+
+        master.mkdir('/c', 0o755)
+        slaves[0].queue.wait_for_lag(max_ops=1)
+        assert_same_tree(master.backing_store, [slaves[0].backing_store])
+        assert sorted(os.listdir(slaves[0].backing_store)) == ['a', 'b', 'c']
+
+
+def open_file(fd: int):
+    try:
+        return os.readlink(f'/proc/self/fd/{fd}')
+    except OSError:
+        return None
+
+
+def test_pooled_read_outlives_release(tmp_path, monkeypatch):
+    # A Release queued behind a Read still on the read pool leaves closing
+    # the slave's handle to the read.
+    with local_replica(str(tmp_path), nbr_slaves=1, threaded=True) as (master, [slave]):
+        fh = master.create('/f', 0o644)
+        master.write('/f', b'data', 0, fh)
+        master.release('/f', fh)
+        fh = master.open('/f', os.O_RDONLY)
+        slave_fd = slave.fd_map[fh]
+
+        reading = threading.Event()
+        resume = threading.Event()
+        pread = os.pread
+
+        def held_pread(fd, length, offset):
+            if threading.current_thread().name.startswith('slave-0-read'):
+                reading.set()
+                resume.wait(timeout=10)
+            return pread(fd, length, offset)
+
+        monkeypatch.setattr(os, 'pread', held_pread)
+        read = Read('/f', 4, 0, fh, pipeline=SlaveRequestPipeline())
+        slave.queue.put(read)
+        assert reading.wait(timeout=10)
+        master.release('/f', fh)
+        # The second ping is drained after the batch holding the Release
+        # has been closed.
+        for _ in range(2):
+            ping = Ping(pipeline=SlaveRequestPipeline())
+            slave.queue.put(ping)
+            ping.pipeline.get(timeout=10)
+        assert slave._closing == {slave_fd}
+
+        resume.set()
+        assert read.pipeline.get(timeout=10) == b'data'
+        poll(lambda: open_file(slave_fd) != os.path.join(slave.backing_store, 'f'))
+
+
+def test_paths_stay_in_backing_store(tmp_path):
+    with local_replica(str(tmp_path), nbr_slaves=1) as (master, (slave,)):
+        for path in ('//etc/passwd', '/../escaped', '/dir/../../escaped'):
+            with pytest.raises(FuseOSError):
+                slave._get_real_path(path)
+            with pytest.raises(FuseOSError):
+                master.create(path, 0o644)
+        assert slave._get_real_path('/dir/..name') == os.path.join(slave.backing_store, 'dir/..name')
@@ -0,0 +1,65 @@
+from fuse import FuseOSError
+import errno
+import os
+import threading
+
+from fs.SlaveHealth import MAX_ERRORS, MIN_SAMPLES, SlaveHealth
+from fs.SlaveQueue import SlaveQueue
+
+from conftest import NBR_SLAVES, local_replica, poll
+
+
+def test_slave_health_evictions():
+    health = SlaveHealth([SlaveQueue() for _ in range(2)], timeout=10)
+    # Answers of the file system say nothing of the slave.
+    for _ in range(MAX_ERRORS):
+        health.failed(0, FuseOSError(errno.ENOENT))
+    assert health.healthy() == [0, 1]
+    for _ in range(MAX_ERRORS):
+        health.failed(0, FuseOSError(errno.EIO))
+    assert health.healthy() == [1]
+
+    health.admit(0)
+    for _ in range(MIN_SAMPLES):
+        health.succeeded(0, 0.001)
+        health.succeeded(1, 0.1)
+    health.check()
+    assert [slave['evicted'] for slave in health.stats()] == [None, 'slow']
+
+    # Reads may complete on slaves evicted since they were sent.
+    health.detach(0)
+    for _ in range(MIN_SAMPLES):
+        health.succeeded(1, 0.1)
+    assert health.healthy() == [] and health.hedge_delay() == 10
+
+
+def test_slave_health_hedging(tmp_path):
+    with local_replica(str(tmp_path), slave_timeout=0.2, hedge_reads=True) as (master, slaves):
+        fh = master.create('/f', 0o644)
+        master.write('/f', b'x' * 4096, 0, fh)
+        master.release('/f', fh)
+
+        stalled = threading.Event()
+        distrib_read = slaves[0]._distrib_read
+
+        def stall(*args):
+            stalled.wait()
+            distrib_read(*args)
+
+        slaves[0]._distrib_read = stall
+        fh = master.open('/f', os.O_RDONLY)
+        try:
+            # The reads sent to the stalled slave are sent again to the
+            # other one after the hedge delay, slave_timeout until there is
+            # a p95.
+            for _ in range(NBR_SLAVES):
+                assert master.read('/f', 4096, 0, fh) == b'x' * 4096
+            assert master.health.read_stats()['hedged'] >= 1
+            # Its heartbeat waits behind the read, it gets evicted...
+            poll(lambda: master.health.healthy() == [1])
+            assert master.health.stats()[0]['evicted'] == 'stalled'
+        finally:
+            stalled.set()
+        # ...and taken back once it answers again.
+        poll(lambda: master.health.healthy() == [0, 1])
+        master.release('/f', fh)
@@ -0,0 +1,57 @@
+import os
+import threading
+import time
+
+from fs.ReplicaFSMaster import ReplicaFSMaster
+from fs.SharedRing import SharedRing
+from fs.SlaveProcess import SlaveProcessProxy
+from fs.SlaveQueue import SlaveQueue
+
+from conftest import assert_same_tree, local_config
+
+
+def test_shared_ring():
+    ring = SharedRing(64)
+    try:
+        assert [ring.store(bytes([i]) * 20) for i in range(3)] == [(0, 20), (20, 20), (40, 20)]
+        # A payload of more than half the ring goes inline instead.
+        assert ring.store(bytes(33)) is None
+        # One that does not fit before the end skips to the start, once
+        # the oldest payload is released (release frees in store order).
+        stored = []
+        waiting = threading.Thread(target=lambda: stored.append(ring.store(b'x' * 10)))
+        waiting.start()
+        time.sleep(0.1)
+        assert waiting.is_alive()
+        ring.release()
+        waiting.join()
+        assert stored == [(0, 10)] and bytes(ring.shm.buf[:20]) == b'x' * 10 + bytes([0]) * 10
+        # The padding stays used until the payload after it is released.
+        assert ring.occupancy() == 54
+        for _ in range(3):
+            ring.release()
+        assert ring.occupancy() == 0
+    finally:
+        ring.close()
+
+
+def test_slave_processes(tmp_path):
+    # A small ring, so that writes wrap around it or go inline.
+    config = local_config(str(tmp_path), nbr_slaves=1, slave_processes=True, shm_ring_bytes=64 * 1024)
+    queue = SlaveQueue()
+    proxy = SlaveProcessProxy(config, 0, queue, mount=False)
+    proxy.start()
+    try:
+        master = ReplicaFSMaster(config, queues=[queue], nbr_slaves=1)
+        fh = master.create('/f', 0o644)
+        offset = 0
+        for size in [20_000, 20_000, 20_000, 40_000, 100, 20_000]:
+            master.write('/f', os.urandom(size), offset, fh)
+            offset += size
+        master.release('/f', fh)
+        master.mkdir('/d', 0o755)
+        assert_same_tree(config.master_backing, config.slave_backings)
+        assert proxy.ring.occupancy() == 0
+        master.destroy('/')
+    finally:
+        proxy.stop()
@@ -0,0 +1,59 @@
+import json
+import os
+import pytest
+import re
+
+from fs.OperationMetrics import BUCKETS
+from fs.ReplicaFSMaster import ReplicaFSMaster
+from fs.StatsFiles import STATS_DIR
+
+from conftest import NBR_SLAVES, local_replica
+
+
+def read_stats_file(master: ReplicaFSMaster, name: str) -> str:
+    path = f'{STATS_DIR}/{name}'
+    fh = master('open', path, os.O_RDONLY)
+    try:
+        return master('read', path, 1 << 20, 0, fh).decode()
+    finally:
+        master('release', path, fh)
+
+
+def test_stats_files(tmp_path):
+    with local_replica(str(tmp_path)) as (master, slaves):
+        fh = master('create', '/f', 0o644)
+        master('write', '/f', b'x' * 100, 0, fh)
+        master('release', '/f', fh)
+        with pytest.raises(OSError):
+            master('mkdir', '/f', 0o755)
+
+        stats = json.loads(read_stats_file(master, 'stats'))
+        assert stats['operations']['mkdir'] == dict(stats['operations']['mkdir'], count=1, errors=1)
+        assert len(stats['slaves']) == NBR_SLAVES
+
+        declared = {}
+        samples = {}
+        for line in read_stats_file(master, 'metrics').splitlines():
+            if line.startswith('# '):
+                kind, name, rest = line[2:].split(' ', 2)
+                assert kind in ('HELP', 'TYPE') and rest
+                if kind == 'TYPE':
+                    declared[name] = rest
+                continue
+            # Every sample belongs to a family declared before it.
+            match = re.fullmatch(r'([a-z_]+)(?:\{([^}]*)\})? (\S+)', line)
+            assert match, line
+            name, labels, value = match.groups()
+            float(value)
+            family = re.sub(r'_(bucket|sum|count)$', '', name) if name not in declared else name
+            assert family in declared, line
+            samples[name, labels] = value
+
+        # Cumulative buckets grow with le, and the +Inf one holds them all.
+        for op in stats['operations']:
+            buckets = [int(value) for (name, labels), value in samples.items()
+                       if name == 'replicafs_operation_seconds_bucket' and labels.startswith(f'op="{op}",')]
+            assert len(buckets) == len(BUCKETS) + 1 and buckets == sorted(buckets)
+            assert samples['replicafs_operation_seconds_bucket', f'op="{op}",le="+Inf"'] == \
+                samples['replicafs_operation_seconds_count', f'op="{op}"'] == str(stats['operations'][op]['count'])
+        assert samples['replicafs_operation_errors_total', 'op="mkdir"'] == '1'